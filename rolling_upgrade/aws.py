@@ -0,0 +1,793 @@
+import functools
+import logging
+import re
+import threading
+from time import sleep, time
+
+import botocore
+import botocore.config
+import botocore.session
+import boto3.session
+from retrying import retry
+
+from .common import InstanceSnapshot
+
+
+logger = logging.getLogger(__name__)
+
+THROTTLING_ERROR_CODES = frozenset([
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'PriorRequestNotComplete',
+])
+
+
+def retry_if_throttled(exception):
+    """Whether to retry a particular operation when an exception occurs.
+
+    Currently only AWS throttling exceptions will trigger the retry
+    mechanism. These are recognised either by their error code (e.g.
+    'Throttling' from autoscaling or 'RequestLimitExceeded' from EC2) or,
+    for older services, by the error message.
+    """
+    if not isinstance(exception, botocore.exceptions.ClientError):
+        return False
+    error_code = exception.response.get('Error', {}).get('Code', '')
+    return error_code in THROTTLING_ERROR_CODES or \
+        'throttling' in str(exception).lower()
+
+
+class AdaptiveRateLimiter(object):
+    """ A client-side token bucket whose refill rate adapts to throttling.
+
+    The rate follows an AIMD (additive increase, multiplicative decrease)
+    scheme: every successful call nudges the rate up by a fixed amount, every
+    throttled call cuts it by a factor. Callers therefore converge on the
+    highest rate AWS will tolerate, however many threads share the limiter.
+    """
+
+    def __init__(
+        self,
+        rate=10.0,
+        min_rate=0.5,
+        max_rate=50.0,
+        burst=5,
+        increase=0.5,
+        decrease_factor=0.5,
+        clock=time,
+        sleeper=sleep
+    ):
+        """
+        Args:
+            rate: initial number of calls allowed per second.
+            min_rate: the rate will never drop below this.
+            max_rate: the rate will never rise above this.
+            burst: maximum number of tokens that can be saved up.
+            increase: calls per second added to the rate on success.
+            decrease_factor: the rate is multiplied by this on throttling.
+            clock: Use to override the time source.
+            sleeper: Use to override the sleep function.
+        """
+        self._rate = float(rate)
+        self._min_rate = float(min_rate)
+        self._max_rate = float(max_rate)
+        self._burst = float(burst)
+        self._increase = float(increase)
+        self._decrease_factor = float(decrease_factor)
+        self._clock = clock
+        self._sleeper = sleeper
+        self._tokens = self._burst
+        self._last_refill = clock()
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def _refill(self):
+        now = self._clock()
+        elapsed = max(0.0, now - self._last_refill)
+        self._tokens = min(self._burst, self._tokens + elapsed * self._rate)
+        self._last_refill = now
+
+    def acquire(self):
+        """ Blocks until a call may be made, then consumes a token. """
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_s = (1 - self._tokens) / self._rate
+            self._sleeper(wait_s)
+
+    def on_success(self):
+        """ Additively increases the rate after a successful call. """
+        with self._lock:
+            self._rate = min(self._max_rate, self._rate + self._increase)
+
+    def on_throttle(self):
+        """ Multiplicatively decreases the rate after a throttled call, and
+        drops any saved-up burst so the next calls are spaced out.
+        """
+        with self._lock:
+            self._rate = max(self._min_rate,
+                             self._rate * self._decrease_factor)
+            self._tokens = min(self._tokens, 0.0)
+
+
+RATE_LIMITER_DEFAULTS = {
+    'autoscaling': {'rate': 5.0, 'max_rate': 20.0},
+    'ec2-describe': {'rate': 10.0, 'max_rate': 100.0},
+    'ec2-mutate': {'rate': 2.0, 'max_rate': 10.0},
+    'elbv2': {'rate': 10.0, 'max_rate': 50.0},
+    'ssm': {'rate': 5.0, 'max_rate': 20.0},
+}
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(api_family):
+    """ Gets the process-wide rate limiter for an AWS API family, creating it
+    on first use.
+
+    Args:
+        api_family: one of the keys of RATE_LIMITER_DEFAULTS.
+    Returns:
+        the shared AdaptiveRateLimiter.
+    """
+    with _rate_limiters_lock:
+        if api_family not in _rate_limiters:
+            _rate_limiters[api_family] = AdaptiveRateLimiter(
+                **RATE_LIMITER_DEFAULTS.get(api_family, {}))
+        return _rate_limiters[api_family]
+
+
+# Throttled calls are given up on, and the throttling error raised, after
+# this many attempts or this long
+MAX_THROTTLED_ATTEMPTS = 10
+MAX_THROTTLED_DELAY_MS = 120000
+
+
+def aws_api_call(api_family):
+    """ Decorates an AwsManager method that calls AWS.
+
+    Each attempt first waits for the shared rate limiter of the given API
+    family and reports back whether it was throttled. Throttled attempts are
+    retried with exponential backoff, up to MAX_THROTTLED_ATTEMPTS times and
+    for up to MAX_THROTTLED_DELAY_MS.
+
+    A method should make a single AWS request, so that every request is rate
+    limited and only the throttled one is retried. Paged operations are
+    called with get_all_pages() instead.
+
+    Args:
+        api_family: one of the keys of RATE_LIMITER_DEFAULTS.
+    """
+    def decorator(func):
+        @retry(
+            wait_exponential_multiplier=500,
+            wait_exponential_max=10000,
+            stop_max_attempt_number=MAX_THROTTLED_ATTEMPTS,
+            stop_max_delay=MAX_THROTTLED_DELAY_MS,
+            retry_on_exception=retry_if_throttled
+        )
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            limiter = get_rate_limiter(api_family)
+            limiter.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except botocore.exceptions.ClientError as client_error:
+                if retry_if_throttled(client_error):
+                    limiter.on_throttle()
+                raise
+            limiter.on_success()
+            return result
+        return wrapper
+    return decorator
+
+
+def get_all_pages(api_family, operation, result_key, **request):
+    """ Calls a paged AWS operation page by page, following NextToken.
+
+    Each page is requested as its own rate limited call, so that every page
+    counts against the rate limit, and a throttled page is retried on its
+    own rather than starting over from the first.
+
+    Args:
+        api_family: one of the keys of RATE_LIMITER_DEFAULTS.
+        operation: the boto3 client method, e.g.
+                   client.describe_auto_scaling_groups.
+        result_key: key of the list of results in each page.
+        request: the parameters of the operation.
+    Returns:
+        a list of the results of every page, in order.
+    """
+    @aws_api_call(api_family)
+    def get_page(page_request):
+        return operation(**page_request)
+
+    results = []
+    while True:
+        response = get_page(request)
+        results.extend(response.get(result_key, []))
+        if not response.get('NextToken'):
+            return results
+        request = dict(request, NextToken=response['NextToken'])
+
+
+DESCRIBE_INSTANCES_BATCH_SIZE = 100
+
+FINISHED_ACTIVITY_STATUSES = frozenset(['Successful', 'Failed', 'Cancelled'])
+
+DESCRIBE_WARM_POOL_BATCH_SIZE = 100
+
+_aws_sessions = {}
+_aws_clients = {}
+_aws_connections_lock = threading.Lock()
+
+
+def get_aws_client_config(concurrency=10):
+    """ Builds the botocore client configuration for a given number of
+    concurrent callers.
+
+    The HTTP connection pool is sized so that no caller has to wait for a
+    connection, timeouts are kept short so that a stuck request fails fast,
+    and TCP keepalive is enabled so pooled connections survive between polls.
+    Botocore's own retries are turned off, so that every throttled call
+    reaches aws_api_call() and slows down the shared rate limiter instead of
+    being retried unseen. Options not understood by the installed botocore
+    version are left out.
+
+    Args:
+        concurrency: the number of threads expected to share a client.
+    Returns:
+        a botocore.config.Config
+    """
+    options = {
+        'max_pool_connections': max(10, concurrency),
+        'connect_timeout': 5,
+        'read_timeout': 30,
+        'tcp_keepalive': True,
+        # Retry attempts after the first one
+        'retries': {'max_attempts': 0},
+    }
+    supported_options = botocore.config.Config.OPTION_DEFAULTS
+    return botocore.config.Config(**{
+        name: value for name, value in options.items()
+        if name in supported_options
+    })
+
+
+def has_aws_operation(service_name, operation_name):
+    """ Whether the installed botocore knows an AWS operation. Older releases
+    have no client method for it, and drop the fields that only newer
+    operations use from responses.
+
+    Args:
+        service_name: e.g. 'autoscaling'
+        operation_name: e.g. 'PutWarmPool'
+    """
+    try:
+        service_model = botocore.session.get_session().get_service_model(
+            service_name)
+    except botocore.exceptions.UnknownServiceError:
+        return False
+    return operation_name in service_model.operation_names
+
+
+def get_aws_session(region_name=None):
+    """ Gets the process-wide boto3 session for a region, creating it on
+    first use.
+
+    Args:
+        region_name: the AWS region, or None for the default region.
+    """
+    with _aws_connections_lock:
+        if region_name not in _aws_sessions:
+            _aws_sessions[region_name] = boto3.session.Session(
+                region_name=region_name)
+        return _aws_sessions[region_name]
+
+
+def get_aws_client(service_name, region_name=None, concurrency=10):
+    """ Gets a boto3 client shared by everything in the process that talks to
+    the same service in the same region with the same concurrency.
+
+    Boto3 clients are thread safe, so sharing them lets all managers and
+    worker threads draw from one pool of HTTP connections.
+
+    Args:
+        service_name: e.g. 'ec2' or 'autoscaling'
+        region_name: the AWS region, or None for the default region.
+        concurrency: the number of threads expected to share the client.
+    """
+    session = get_aws_session(region_name)
+    key = (service_name, region_name, concurrency)
+    with _aws_connections_lock:
+        if key not in _aws_clients:
+            _aws_clients[key] = session.client(
+                service_name, config=get_aws_client_config(concurrency))
+        return _aws_clients[key]
+
+
+class AwsManager(object):
+    """ Handles interactions with AWS, and converts Boto responses into useful
+    objects.
+    """
+
+    def __init__(self, do_dry_run=False, region_name=None, concurrency=10,
+                 asg_index=None):
+        """
+        Args:
+            do_dry_run: if enabled, all operations are performed with a dry run
+                        flag, with no side effects. See AWS/Boto3 docs for more
+                        info.
+            region_name: the AWS region to connect to, or None to use the
+                         default region (e.g. from AWS_DEFAULT_REGION).
+            concurrency: the number of threads expected to make AWS calls
+                         through this manager at once. Sizes the HTTP
+                         connection pool.
+            asg_index: an AsgNameIndex to find autoscaling groups with, or
+                       None to always list every group in the account.
+        """
+        self._do_dry_run = do_dry_run
+        self._asg_index = asg_index
+        self._region_name = region_name
+        self._concurrency = concurrency
+
+    @retry(
+        wait_exponential_multiplier=500,
+        wait_exponential_max=10000,
+        retry_on_exception=retry_if_throttled
+    )
+    def connect(self, autoscaling_client=None, ec2_client=None,
+                elb_client=None):
+        """ Opens connections to AWS, specifically the autoscaling and EC2
+            clients. The load balancing client is only created when first
+            needed.
+
+        Args:
+            autoscaling_client: Override the autoscaling client.
+            ec2_client: Override the EC2 client.
+            elb_client: Override the elbv2 (load balancing) client.
+        """
+        logger.info('Connecting to AWS...')
+        self._as_client = autoscaling_client or get_aws_client(
+            'autoscaling', self._region_name, self._concurrency)
+        self._ec2_client = ec2_client or get_aws_client(
+            'ec2', self._region_name, self._concurrency)
+        self._elb_client = elb_client
+
+    def _get_elb_client(self):
+        if self._elb_client is None:
+            self._elb_client = get_aws_client(
+                'elbv2', self._region_name, self._concurrency)
+        return self._elb_client
+
+    def get_all_as_groups(self):
+        """ Retrieves all autoscaling groups accessible with the current
+            credentials from AWS.
+
+        Returns:
+            a list of autoscaling groups
+        """
+        return get_all_pages('autoscaling',
+                             self._as_client.describe_auto_scaling_groups,
+                             'AutoScalingGroups')
+
+    def get_as_groups(self, asg_names):
+        """ Retrieves the named autoscaling groups from AWS.
+
+        Args:
+            asg_names: the names of the autoscaling groups.
+        Returns:
+            a list of the autoscaling groups that still exist.
+        """
+        return get_all_pages('autoscaling',
+                             self._as_client.describe_auto_scaling_groups,
+                             'AutoScalingGroups',
+                             AutoScalingGroupNames=list(asg_names))
+
+    def _find_indexed_asg_groups(self, asg_regex_pat):
+        if self._asg_index is None or not self._asg_index.is_loaded():
+            return None
+
+        asg_names = self._asg_index.find_names(asg_regex_pat)
+        if not asg_names:
+            # The group may have been created since the index was refreshed
+            return None
+
+        self._asg_index.refresh_in_background(self.get_all_as_groups)
+        asgs = self.get_as_groups(asg_names)
+        if len(asgs) != len(asg_names):
+            return None
+        return sorted(asgs, key=lambda asg: asg['AutoScalingGroupName'])
+
+    def find_asg_group(self, asg_regex_pat):
+        """ Searches for an autoscaling group using the specified regex.
+
+        Groups are looked up in the autoscaling group index, if there is one,
+        and confirmed with AWS. Every group in the account is listed only if
+        the index finds none, or finds some that no longer exist.
+
+        Args:
+            asg_regex_pat: A Python regex string.
+        Returns:
+            a list of autoscaling groups where the AutoScalingGroupName matches
+            the given regex.
+        """
+        indexed_asgs = self._find_indexed_asg_groups(asg_regex_pat)
+        if indexed_asgs is not None:
+            return indexed_asgs
+
+        all_asgs = self.get_all_as_groups()
+        if self._asg_index is not None:
+            self._asg_index.update(all_asgs)
+
+        test_re = re.compile(asg_regex_pat)
+        filtered_asgs = filter(lambda asg: test_re.match(
+            asg['AutoScalingGroupName']), all_asgs)
+
+        if len(filtered_asgs) == 0:
+            return []
+        elif len(filtered_asgs) > 1:
+            return filtered_asgs
+        else:
+            return [filtered_asgs[0]]
+
+    def get_expected_num_of_instances(self, asg):
+        """ Gets the number of instances that we expect to be present in the
+        autoscaling group.
+
+        Args:
+            asg: the autoscaling group info as given by find_asg_group() or
+                 get_all_as_groups()
+        Returns:
+            the number of instances
+        """
+
+        return asg['DesiredCapacity']
+
+    @aws_api_call('ec2-mutate')
+    def terminate_instance(self, instance_id):
+        """ Terminates the EC2 instance with the given instance ID.
+
+        Args:
+            instance_id: the Amazon instance ID to terminate
+        """
+        try:
+            self._ec2_client.terminate_instances(
+                DryRun=self._do_dry_run,
+                InstanceIds=[
+                    instance_id
+                ]
+            )
+        except botocore.exceptions.ClientError as client_error:
+            # Boto raises an exception to let you know
+            # that the request would have succeeded
+            # if the dry run flag was not in place.
+            # Obviously.
+            if 'DryRunOperation' not in client_error.response['Error']['Code']:
+                raise client_error
+
+    @aws_api_call('autoscaling')
+    def get_launch_config_for_asg(self, asg):
+        """ Gets the launch configuration for the given autoscaling group.
+
+        Args:
+            asg: the autoscaling group info as given by find_asg_group() or
+                 get_all_as_groups()
+        Returns:
+            a dict containing the launch configuration.
+        """
+        config_name = asg['LaunchConfigurationName']
+
+        logger.info('Retrieving autoscaling group launch configuration %s...',
+                    config_name)
+
+        launch_configs = self._as_client.describe_launch_configurations(
+            LaunchConfigurationNames=[config_name])
+        return launch_configs[u'LaunchConfigurations'][0]
+
+    @aws_api_call('autoscaling')
+    def get_launch_configs(self, config_names):
+        """ Gets several launch configurations by name.
+
+        Args:
+            config_names: at most 50 launch configuration names.
+        Returns:
+            a dict of launch configuration name to launch configuration.
+            Launch configurations that no longer exist are left out.
+        """
+        launch_configs = self._as_client.describe_launch_configurations(
+            LaunchConfigurationNames=config_names)
+        return {config['LaunchConfigurationName']: config
+                for config in launch_configs['LaunchConfigurations']}
+
+    @aws_api_call('autoscaling')
+    def get_asg_members(self, asg):
+        """ Gets the instances an autoscaling group currently considers its
+        own, straight from the group description.
+
+        Args:
+            asg: the autoscaling group info as given by find_asg_group() or
+                 get_all_as_groups()
+        Returns:
+            a list of dicts with e.g. InstanceId and LifecycleState keys.
+        """
+        response = self._as_client.describe_auto_scaling_groups(
+            AutoScalingGroupNames=[asg['AutoScalingGroupName']])
+        groups = response['AutoScalingGroups']
+        return groups[0]['Instances'] if groups else []
+
+    @aws_api_call('ec2-describe')
+    def _describe_instances(self, **request):
+        response = self._ec2_client.describe_instances(**request)
+        return [description
+                for reservation in response['Reservations']
+                for description in reservation['Instances']]
+
+    def describe_running_instances(self, instance_ids):
+        """ Describes the given instances, if they are running.
+
+        EC2 is eventually consistent, so an instance the autoscaling group has
+        just launched may not be known to describe_instances yet. Asking for
+        it by ID then fails the whole call, so the instances are asked for
+        again by filter, which leaves the unknown ones out.
+
+        Args:
+            instance_ids: at most DESCRIBE_INSTANCES_BATCH_SIZE instance IDs.
+        Returns:
+            a list of instance descriptions as returned by describe_instances
+        """
+        running_filter = {'Name': 'instance-state-name', 'Values': ['running']}
+        try:
+            return self._describe_instances(
+                InstanceIds=instance_ids, Filters=[running_filter])
+        except botocore.exceptions.ClientError as client_error:
+            error_code = client_error.response.get('Error', {}).get('Code')
+            if error_code != 'InvalidInstanceID.NotFound':
+                raise
+
+        return self._describe_instances(Filters=[
+            {'Name': 'instance-id', 'Values': instance_ids},
+            running_filter
+        ])
+
+    def get_instances_for_asg(self, asg, instance_ids=None):
+        """ Gets all running instances belonging to an autoscaling group.
+
+        The group's own list of instances is used rather than searching EC2
+        by tag, so that instances are found before their tags have
+        propagated, and their lifecycle state (e.g. 'Pending', 'InService',
+        'Terminating') is known.
+
+        Args:
+            asg: the autoscaling group info as given by find_asg_group() or
+                 get_all_as_groups()
+            instance_ids: IDs of the only instances to get, e.g. those that
+                          have joined the group since it was last looked at,
+                          or None to get them all.
+        Returns:
+            a list of InstanceSnapshots, in the group's order.
+        """
+        members = self.get_asg_members(asg)
+        if instance_ids is not None:
+            wanted_ids = set(instance_ids)
+            members = [member for member in members
+                       if member['InstanceId'] in wanted_ids]
+        descriptions = self._describe_running_instances_by_id(
+            [member['InstanceId'] for member in members])
+
+        return [InstanceSnapshot.from_description(
+                    descriptions[member['InstanceId']],
+                    lifecycle_state=member.get('LifecycleState'),
+                    launch_configuration_name=member.get(
+                        'LaunchConfigurationName'))
+                for member in members
+                if member['InstanceId'] in descriptions]
+
+    def _describe_running_instances_by_id(self, instance_ids):
+        descriptions = {}
+        for start in range(0, len(instance_ids),
+                           DESCRIBE_INSTANCES_BATCH_SIZE):
+            for description in self.describe_running_instances(
+                    instance_ids[start:start + DESCRIBE_INSTANCES_BATCH_SIZE]):
+                descriptions[description['InstanceId']] = description
+        return descriptions
+
+    def get_in_service_instance_ids(self, asg):
+        """ Gets the IDs of the instances in service in an autoscaling group.
+
+        Only the group is described, not its instances, so this is cheaper
+        than get_instances_for_asg() to poll while instances boot.
+
+        Args:
+            asg: the autoscaling group info as given by find_asg_group() or
+                 get_all_as_groups()
+        Returns:
+            a list of instance IDs, in the group's order.
+        """
+        return [member['InstanceId'] for member in self.get_asg_members(asg)
+                if member.get('LifecycleState') in (None, 'InService')]
+
+    def get_remaining_instance_ids(self, asg):
+        """ Gets the IDs of the instances in an autoscaling group that are
+        not being terminated.
+
+        Only the group is described, not its instances, so that the caller
+        need only get the instances it has not seen before.
+
+        Args:
+            asg: the autoscaling group info as given by find_asg_group() or
+                 get_all_as_groups()
+        Returns:
+            a list of instance IDs, in the group's order.
+        """
+        return [member['InstanceId'] for member in self.get_asg_members(asg)
+                if not (member.get('LifecycleState') or '').startswith(
+                    'Terminat')]
+
+    def get_instances(self, instance_ids):
+        """ Gets the given instances, if they are running.
+
+        Args:
+            instance_ids: list of instance IDs, as many as needed.
+        Returns:
+            a list of InstanceSnapshots, in the order of instance_ids. Their
+            lifecycle state and launch configuration are not known.
+        """
+        descriptions = self._describe_running_instances_by_id(instance_ids)
+        return [InstanceSnapshot.from_description(descriptions[instance_id])
+                for instance_id in instance_ids
+                if instance_id in descriptions]
+
+    @aws_api_call('ec2-describe')
+    def get_volumes_dict_for_instance(self, instance):
+        """ Gets EBS volume information for an instance.
+
+        Args:
+            instance: the EC2 instance, as given by, e.g.
+            get_instances_for_asg()
+        Returns:
+            a dictionary with the device names as keys, and the corresponding
+            volume information as items, e.g. { "deviceName": { ... } }
+        """
+        volume_ids = [ebs['Ebs']['VolumeId']
+                      for ebs in instance.block_device_mappings]
+        volumes_response = \
+            self._ec2_client.describe_volumes(VolumeIds=volume_ids)['Volumes']
+
+        return {
+            current_volume['Attachments'][0]['Device']: current_volume
+            for current_volume in volumes_response
+        }
+
+    def config_volumes_to_dict(self, block_device_mapping_config):
+        """ Converts the block device mapping given in an autoscaling group
+        launch configuration to a dictionary, e.g. { "deviceName": { ... } }
+
+        Args:
+            block_device_mapping_config: The BlockDeviceMappings portion of the
+           7 autoscaling group launch configuration (as given by
+           get_launch_config_for_asg())
+        Returns:
+            a dictionary with the device names as keys, and the corresponding
+            volume information as items, e.g. { "deviceName": { ... } }
+        """
+        return {
+            current_volume['DeviceName']: current_volume
+            for current_volume in block_device_mapping_config
+        }
+
+    @aws_api_call('ec2-describe')
+    def get_userdata_for_instance(self, instance_id):
+        """ Gets the Base64-encoded AWS Userdata for a particular instance.
+
+        Args:
+            instance_id: Amazon EC2 instance ID.
+        Returns:
+            the userdata of the instance.
+        """
+        response = self._ec2_client.describe_instance_attribute(
+            InstanceId=instance_id, Attribute='userData')
+        return response['UserData']['Value']
+
+    @aws_api_call('autoscaling')
+    def get_scaling_activities_in_progress(self, asg):
+        """ Gets the scaling activities of an autoscaling group that have not
+        finished yet, e.g. launches, terminations or AZ rebalancing.
+
+        Args:
+            asg: the autoscaling group info as given by find_asg_group() or
+                 get_all_as_groups()
+        Returns:
+            a list of scaling activities
+        """
+        response = self._as_client.describe_scaling_activities(
+            AutoScalingGroupName=asg['AutoScalingGroupName'],
+            MaxRecords=20
+        )
+        return [activity for activity in response['Activities']
+                if activity['StatusCode'] not in FINISHED_ACTIVITY_STATUSES]
+
+    def get_warm_pool_instances(self, asg):
+        """ Gets the instances in the warm pool of an autoscaling group.
+
+        Args:
+            asg: the autoscaling group info as given by find_asg_group() or
+                 get_all_as_groups()
+        Returns:
+            a list of dicts with e.g. InstanceId, LifecycleState (such as
+            'Warmed:Pending' or 'Warmed:Stopped') and LaunchConfigurationName
+            keys.
+        """
+        return get_all_pages(
+            'autoscaling', self._as_client.describe_warm_pool, 'Instances',
+            AutoScalingGroupName=asg['AutoScalingGroupName'],
+            MaxRecords=DESCRIBE_WARM_POOL_BATCH_SIZE)
+
+    @aws_api_call('autoscaling')
+    def put_warm_pool(self, asg, min_size, pool_state='Stopped'):
+        """ Creates a warm pool for an autoscaling group, or changes its
+        existing one.
+
+        Args:
+            asg: the autoscaling group info as given by find_asg_group() or
+                 get_all_as_groups()
+            min_size: the least number of instances to keep in the pool.
+            pool_state: the state warmed instances are kept in, one of
+                        'Stopped', 'Running' or 'Hibernated'.
+        """
+        self._as_client.put_warm_pool(
+            AutoScalingGroupName=asg['AutoScalingGroupName'],
+            MinSize=min_size,
+            PoolState=pool_state
+        )
+
+    @aws_api_call('autoscaling')
+    def detach_instance(self, asg, instance_id):
+        """ Detaches an instance from its autoscaling group without lowering
+        the group's desired capacity, so that the group launches a
+        replacement straight away.
+
+        The group deregisters the instance from its target groups, which
+        start draining its connections. The instance keeps running.
+
+        Args:
+            asg: the autoscaling group info as given by find_asg_group() or
+                 get_all_as_groups()
+            instance_id: the Amazon instance ID to detach
+        """
+        self._as_client.detach_instances(
+            AutoScalingGroupName=asg['AutoScalingGroupName'],
+            InstanceIds=[instance_id],
+            ShouldDecrementDesiredCapacity=False
+        )
+
+    @aws_api_call('elbv2')
+    def get_target_states(self, target_group_arn, instance_ids):
+        """ Gets the state of several instances in a target group in a single
+        call.
+
+        Args:
+            target_group_arn: the ARN of the target group.
+            instance_ids: the Amazon instance IDs to check.
+        Returns:
+            a dict of instance ID to target state, e.g. 'healthy', 'draining'
+            or 'unused' for an instance not registered in the target group.
+        """
+        response = self._get_elb_client().describe_target_health(
+            TargetGroupArn=target_group_arn,
+            Targets=[{'Id': instance_id} for instance_id in instance_ids])
+        return {description['Target']['Id']:
+                description['TargetHealth']['State']
+                for description in response['TargetHealthDescriptions']}
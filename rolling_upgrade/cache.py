@@ -0,0 +1,290 @@
+import bisect
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+from time import time
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_default_cache_dir():
+    """ Gets the directory to keep caches in, following the XDG base
+    directory convention.
+    """
+    return os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+        'asg-rolling-upgrade')
+
+
+class DiffCache(object):
+    """ A persistent cache of the differences between instances and launch
+    configurations.
+
+    An instance's launched configuration never changes, so the differences
+    between an instance and a given launch configuration never change either.
+    Results are keyed by instance ID, launch time (instance IDs are unique,
+    but this guards against mix-ups between accounts) and launch
+    configuration fingerprint, and kept in a JSON file. Once the cache holds
+    more than max_entries results, the least recently used are evicted.
+
+    The file is only rewritten when results were added, so a run that finds
+    everything in the cache leaves it untouched. When it is rewritten, the
+    times results were last used in that run are saved along with it.
+    """
+
+    FILE_NAME = 'diffs.json'
+
+    def __init__(self, directory, max_entries=10000):
+        """
+        Args:
+            directory: the directory to keep the cache file in. Created if it
+                       does not exist. None keeps the cache in memory only.
+            max_entries: the number of results to keep.
+        """
+        self._directory = directory
+        self._path = directory and os.path.join(directory, DiffCache.FILE_NAME)
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = None
+        self._dirty = False
+
+    @staticmethod
+    def get_key(instance, config_fingerprint):
+        return '%s|%s|%s' % (instance.id, instance.launch_time,
+                             config_fingerprint)
+
+    def _load(self):
+        if self._entries is not None:
+            return self._entries
+
+        self._entries = {}
+        if self._path is None:
+            return self._entries
+        try:
+            with open(self._path) as cache_file:
+                self._entries = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            # A missing or corrupt cache is just an empty one
+            pass
+        return self._entries
+
+    def get(self, instance, config_fingerprint):
+        """ Gets the cached differences for an instance.
+
+        Returns:
+            a list of differences, or None if there are none cached.
+        """
+        with self._lock:
+            entry = self._load().get(
+                DiffCache.get_key(instance, config_fingerprint))
+            if entry is None:
+                return None
+            entry['used'] = time()
+            return list(entry['diffs'])
+
+    def put(self, instance, config_fingerprint, diffs):
+        """ Caches the differences for an instance. """
+        with self._lock:
+            self._load()[DiffCache.get_key(instance, config_fingerprint)] = {
+                'diffs': list(diffs),
+                'used': time()
+            }
+            self._dirty = True
+
+    def save(self):
+        """ Writes the cache to disk, evicting the least recently used
+        results if there are too many.
+
+        The file is replaced atomically, so concurrent runs never see a
+        partially written cache.
+        """
+        with self._lock:
+            if not self._dirty or self._path is None:
+                return
+
+            entries = self._load()
+            if len(entries) > self._max_entries:
+                by_age = sorted(entries, key=lambda key: entries[key]['used'])
+                for key in by_age[:len(entries) - self._max_entries]:
+                    del entries[key]
+
+            if not os.path.isdir(self._directory):
+                os.makedirs(self._directory)
+            file_descriptor, temp_path = tempfile.mkstemp(
+                dir=self._directory, prefix='.diffs-')
+            with os.fdopen(file_descriptor, 'w') as temp_file:
+                json.dump(entries, temp_file)
+            os.rename(temp_path, self._path)
+            self._dirty = False
+
+
+# Characters that end the literal prefix of a regular expression
+_REGEX_SPECIAL_CHARS = frozenset('.^$*+?{}[]\\|()')
+# Characters that make the character before them optional
+_REGEX_OPTIONAL_CHARS = frozenset('*?{')
+
+
+def get_literal_prefix(regex_pat):
+    """ Gets the literal text that every name matching a regex starts with.
+
+    Args:
+        regex_pat: A Python regex string, matched from the start of names as
+                   with re.match.
+    Returns:
+        the literal prefix, possibly empty.
+    """
+    if '|' in regex_pat:
+        return ''
+
+    pattern = regex_pat[1:] if regex_pat.startswith('^') else regex_pat
+    prefix = []
+    for char in pattern:
+        if char in _REGEX_SPECIAL_CHARS:
+            if char in _REGEX_OPTIONAL_CHARS and prefix:
+                prefix.pop()
+            break
+        prefix.append(char)
+    return ''.join(prefix)
+
+
+def get_asg_index_path(directory, profile_name, region_name):
+    """ Gets the file to keep the autoscaling group index for an AWS profile
+    and region in.
+    """
+    return os.path.join(directory, 'asg-index-%s-%s.json' % (
+        profile_name or 'default', region_name or 'default'))
+
+
+class AsgNameIndex(object):
+    """ A persistent index of autoscaling group names.
+
+    Holds the name, ARN, launch configuration and tags of every autoscaling
+    group in an account, sorted by name, so that groups can be found by a
+    name prefix without listing every group in the account. The index is only
+    a hint: callers confirm the groups it finds with AWS, and fall back to
+    listing every group when it finds none. Once it is older than ttl_s
+    seconds, it is refreshed in a background thread.
+    """
+
+    def __init__(self, path, ttl_s=3600):
+        """
+        Args:
+            path: the file to keep the index in.
+            ttl_s: the number of seconds after which the index is refreshed.
+        """
+        self._path = path
+        self._ttl_s = ttl_s
+        self._lock = threading.Lock()
+        self._refresh_thread = None
+        self._updated = None
+        self._names = []
+        self._groups = []
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self._path) as index_file:
+                index = json.load(index_file)
+            self._set_groups(index['groups'], index['updated'])
+        except (IOError, OSError, ValueError, KeyError):
+            # A missing or corrupt index is just an empty one
+            pass
+
+    def _set_groups(self, groups, updated):
+        groups = sorted(groups, key=lambda group: group['name'])
+        with self._lock:
+            self._groups = groups
+            self._names = [group['name'] for group in groups]
+            self._updated = updated
+
+    def is_loaded(self):
+        return self._updated is not None
+
+    def is_stale(self):
+        return self._updated is None or \
+            time() - self._updated > self._ttl_s
+
+    def find_names(self, regex_pat):
+        """ Finds the names of the indexed autoscaling groups that match a
+        regex.
+
+        Args:
+            regex_pat: A Python regex string.
+        Returns:
+            the matching names, sorted.
+        """
+        prefix = get_literal_prefix(regex_pat)
+        test_re = re.compile(regex_pat)
+        with self._lock:
+            names = self._names
+        matches = []
+        for name in names[bisect.bisect_left(names, prefix):]:
+            if not name.startswith(prefix):
+                break
+            if test_re.match(name):
+                matches.append(name)
+        return matches
+
+    def get(self, name):
+        """ Gets the indexed ARN, launch configuration name and tags of an
+        autoscaling group, or None if it is not indexed.
+        """
+        with self._lock:
+            position = bisect.bisect_left(self._names, name)
+            if position < len(self._names) and self._names[position] == name:
+                return self._groups[position]
+        return None
+
+    def update(self, asgs):
+        """ Replaces the index with a full list of autoscaling groups, as
+        given by AwsManager.get_all_as_groups(), and saves it.
+        """
+        groups = [{
+            'name': asg['AutoScalingGroupName'],
+            'arn': asg.get('AutoScalingGroupARN'),
+            'launch_configuration_name': asg.get('LaunchConfigurationName'),
+            'tags': dict((tag['Key'], tag.get('Value'))
+                         for tag in asg.get('Tags', []))
+        } for asg in asgs]
+        updated = time()
+        self._set_groups(groups, updated)
+
+        directory = os.path.dirname(self._path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        file_descriptor, temp_path = tempfile.mkstemp(
+            dir=directory or '.', prefix='.asg-index-')
+        with os.fdopen(file_descriptor, 'w') as temp_file:
+            json.dump({'updated': updated, 'groups': self._groups}, temp_file)
+        os.rename(temp_path, self._path)
+
+    def refresh_in_background(self, get_all_as_groups):
+        """ Refreshes the index in a background thread if it is stale.
+
+        Args:
+            get_all_as_groups: function listing every autoscaling group.
+        """
+        with self._lock:
+            if not self.is_stale() or (self._refresh_thread is not None and
+                                       self._refresh_thread.is_alive()):
+                return
+
+            def refresh():
+                try:
+                    self.update(get_all_as_groups())
+                except Exception as e:
+                    logger.debug('Failed to refresh the autoscaling group '
+                                 'index: %s', e)
+
+            self._refresh_thread = threading.Thread(target=refresh)
+            self._refresh_thread.start()
+
+    def wait_for_refresh(self):
+        """ Waits for a background refresh to finish, if one is running. """
+        refresh_thread = self._refresh_thread
+        if refresh_thread is not None:
+            refresh_thread.join()
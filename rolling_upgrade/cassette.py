@@ -0,0 +1,211 @@
+from datetime import datetime
+import gzip
+import json
+import threading
+from time import sleep, time
+
+from .common import InstanceSnapshot
+
+
+CASSETTE_VERSION = 1
+
+_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_value(value):
+    """ Converts a value returned by AwsManager or InstanceSshManager into
+    something JSON can hold, keeping enough to convert it back with
+    decode_value().
+    """
+    if isinstance(value, InstanceSnapshot):
+        return {'__snapshot__': [encode_value(field) for field in value]}
+    if isinstance(value, datetime):
+        # AWS times are in UTC
+        return {'__datetime__': value.replace(tzinfo=None).strftime(
+            _DATETIME_FORMAT), '__utc__': value.tzinfo is not None}
+    if isinstance(value, dict):
+        return dict((key, encode_value(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [encode_value(item) for item in value]
+    if value is None or isinstance(value, (bool, int, long, float,
+                                           basestring)):
+        return value
+    return repr(value)
+
+
+def decode_value(value):
+    """ Converts a value encoded by encode_value() back. """
+    if isinstance(value, dict):
+        if '__snapshot__' in value:
+            return InstanceSnapshot(*[decode_value(field)
+                                      for field in value['__snapshot__']])
+        if '__datetime__' in value:
+            decoded = datetime.strptime(value['__datetime__'],
+                                        _DATETIME_FORMAT)
+            if value['__utc__']:
+                from dateutil.tz import tzutc
+                decoded = decoded.replace(tzinfo=tzutc())
+            return decoded
+        return dict((key, decode_value(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [decode_value(item) for item in value]
+    return value
+
+
+def get_call_key(target_name, method_name, args, kwargs):
+    """ Gets the key identifying calls that should get the same response. """
+    return json.dumps([target_name, method_name, encode_value(args),
+                       encode_value(kwargs)], sort_keys=True)
+
+
+class ReplayedError(Exception):
+    """ Raised by a replayed call that raised an error when recorded. """
+
+    def __init__(self, error_type, message):
+        Exception.__init__(self, '%s: %s' % (error_type, message))
+        self.error_type = error_type
+
+
+class CassetteMismatch(Exception):
+    """ Raised when replaying a call that was never recorded. """
+
+
+class CassetteRecorder(object):
+    """ Records every call made through RecordingProxy objects, with its
+    result and timing, to a gzipped JSON lines cassette file.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path: the cassette file to write.
+        """
+        self._file = gzip.open(path, 'wb')
+        self._lock = threading.Lock()
+        self._started = time()
+        self._write({'version': CASSETTE_VERSION})
+
+    def _write(self, entry):
+        with self._lock:
+            self._file.write(json.dumps(entry, sort_keys=True) + '\n')
+
+    def record(self, target_name, method_name, args, kwargs, started,
+               result=None, error=None):
+        entry = {
+            'key': get_call_key(target_name, method_name, args, kwargs),
+            'at': started - self._started,
+            'duration_s': time() - started
+        }
+        if error is None:
+            entry['result'] = encode_value(result)
+        else:
+            entry['error'] = [type(error).__name__, str(error)]
+        self._write(entry)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class RecordingProxy(object):
+    """ Passes every public method call through to an AwsManager or
+    InstanceSshManager, recording it in a CassetteRecorder.
+    """
+
+    def __init__(self, target, recorder, target_name):
+        """
+        Args:
+            target: the object to record calls to.
+            recorder: the CassetteRecorder to record calls in.
+            target_name: what to call the target in the cassette, e.g. 'aws'.
+        """
+        self._target = target
+        self._recorder = recorder
+        self._target_name = target_name
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def record_call(*args, **kwargs):
+            started = time()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception as e:
+                self._recorder.record(self._target_name, name, args, kwargs,
+                                      started, error=e)
+                raise
+            self._recorder.record(self._target_name, name, args, kwargs,
+                                  started, result=result)
+            return result
+        return record_call
+
+
+class Cassette(object):
+    """ Calls recorded by a CassetteRecorder, to replay through
+    ReplayingProxy objects.
+
+    Calls are matched by target, method and arguments. Repeated calls get the
+    recorded responses in the order they were recorded, after which the last
+    response is repeated, so that replays stay deterministic even if the code
+    under test polls more or less often than when recording.
+    """
+
+    def __init__(self, path, speed=0):
+        """
+        Args:
+            path: the cassette file to read.
+            speed: how fast to replay, compared to the recording. 1 takes as
+                   long as each call did when recorded, 10 a tenth of that.
+                   0 replays instantly.
+        """
+        self._speed = speed
+        self._lock = threading.Lock()
+        self._responses = {}
+        with gzip.open(path, 'rb') as cassette_file:
+            header = json.loads(cassette_file.readline())
+            if header.get('version') != CASSETTE_VERSION:
+                raise ValueError('Unsupported cassette version %s' %
+                                 header.get('version'))
+            for line in cassette_file:
+                entry = json.loads(line)
+                self._responses.setdefault(entry['key'], []).append(entry)
+
+    def play(self, target_name, method_name, args, kwargs):
+        key = get_call_key(target_name, method_name, args, kwargs)
+        with self._lock:
+            responses = self._responses.get(key)
+            if not responses:
+                raise CassetteMismatch('No recorded call to %s.%s%r' % (
+                    target_name, method_name, args))
+            entry = responses[0]
+            if len(responses) > 1:
+                responses.pop(0)
+
+        if self._speed:
+            sleep(entry['duration_s'] / self._speed)
+        if 'error' in entry:
+            raise ReplayedError(*entry['error'])
+        return decode_value(entry['result'])
+
+
+class ReplayingProxy(object):
+    """ Stands in for an AwsManager or InstanceSshManager, answering every
+    public method call from a Cassette.
+    """
+
+    def __init__(self, cassette, target_name):
+        """
+        Args:
+            cassette: the Cassette to answer calls from.
+            target_name: what the target was called when recording.
+        """
+        self._cassette = cassette
+        self._target_name = target_name
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self._cassette.play(
+            self._target_name, name, args, kwargs)
@@ -0,0 +1,420 @@
+import argparse
+import json
+import logging
+import sys
+from time import sleep, time
+
+from .common import SshEnvConfig
+from .log import LazyPformat, configure_logging
+from .scheduler import DEFAULT_PRIORITY_TAG, REPLACEMENT_ORDERS
+
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+
+    parser = argparse.ArgumentParser('')
+    parser.add_argument(
+        'command',
+        nargs='?',
+        choices=('upgrade', 'plan', 'execute', 'watch', 'status', 'trigger',
+                 'simulate'),
+        help='upgrade (the default) performs the rolling upgrade, plan writes '
+             'what it would do to --plan_file and execute performs a plan '
+             'from --plan_file. watch upgrades the --limit groups (comma '
+             'separated) whenever their launch configuration changes, status '
+             'and trigger query and upgrade groups through a running watch. '
+             'simulate predicts how long upgrading a group of '
+             '--simulate_size instances would take',
+        default='upgrade')
+    parser.add_argument(
+        '-l', '--limit',
+        help='limit to these hosts only',
+        default='')
+    parser.add_argument(
+        '--ssh_tunnel',
+        help='the address of a bastion host to tunnel through'
+    )
+    parser.add_argument(
+        '--ssh_private_key',
+        help='The ssh key to be used',
+    )
+    parser.add_argument(
+        '--ssh_username',
+        help='The ssh username to be used',
+        default='centos'
+    )
+    parser.add_argument(
+        '--debug',
+        action='store_true',
+        help='Do some debugging'
+    )
+    parser.add_argument(
+        '--dry_run',
+        action='store_true',
+        help='Stop any actions being performed on the AWS account'
+    )
+    parser.add_argument(
+        '--max_wait_attempts',
+        help='The maximum number of attemts to wait for an instance before stopping',
+        default=40
+    )
+    parser.add_argument(
+        '--sleep',
+        help='The number of seconds to wait between attempts of checking the instances',
+        default=30
+    )
+    parser.add_argument(
+        '--diff_workers',
+        help='The number of instances to compare to the launch configuration concurrently',
+        default=10
+    )
+    parser.add_argument(
+        '--max_parallel_azs',
+        help='The number of Availability Zones to replace an instance in at the same time',
+        default=1
+    )
+    parser.add_argument(
+        '--replacement_order',
+        help='Which instances to replace first',
+        choices=REPLACEMENT_ORDERS,
+        default='oldest'
+    )
+    parser.add_argument(
+        '--priority_tag',
+        help='The instance tag holding the replacement priority for --replacement_order tag',
+        default=DEFAULT_PRIORITY_TAG
+    )
+    parser.add_argument(
+        '--journal',
+        help='A file to record progress in, so that an interrupted upgrade can be resumed',
+        default=None
+    )
+    parser.add_argument(
+        '--plan_file',
+        help='The file the plan command writes to and the execute command reads from',
+        default='upgrade-plan.json'
+    )
+    parser.add_argument(
+        '--diff_cache_dir',
+        help='The directory to cache the results of comparing instances to launch configurations in (defaults to ~/.cache/asg-rolling-upgrade)',
+        default=None
+    )
+    parser.add_argument(
+        '--no_diff_cache',
+        action='store_true',
+        help='Do not keep the results of comparing instances to the launch configuration between runs'
+    )
+    parser.add_argument(
+        '--asg_index_ttl',
+        help='The number of seconds after which the cached index of autoscaling group names is refreshed in the background, 0 to always list every group (defaults to 3600)',
+        default=3600
+    )
+    parser.add_argument(
+        '--warm_pool_size',
+        help='Create a warm pool of this many instances for an autoscaling group that has none, so that replacements come from instances that have booted already',
+        default=None
+    )
+    parser.add_argument(
+        '--overlap_draining',
+        action='store_true',
+        help='Detach instances so that their connections drain from the target groups while their replacements boot, and only terminate them afterwards'
+    )
+    parser.add_argument(
+        '--progress_events',
+        help='Write progress events to this file as lines of JSON, - for standard output',
+        default=None
+    )
+    parser.add_argument(
+        '--readiness',
+        help='How to check whether instances have finished booting: ssh into each one (the default), or ssm to run a single SSM command on all of them',
+        choices=('ssh', 'ssm'),
+        default='ssh'
+    )
+    parser.add_argument(
+        '--ssm_endpoint_url',
+        help='The SSM endpoint to use for --readiness ssm, e.g. a local stand-in for testing',
+        default=None
+    )
+    parser.add_argument(
+        '--watch_interval',
+        help='The time in seconds between checks for launch configuration changes in watch mode',
+        default=60
+    )
+    parser.add_argument(
+        '--control_socket',
+        help='The Unix socket a watch accepts status and trigger commands on',
+        default=None
+    )
+    parser.add_argument(
+        '--simulate_size',
+        help='The number of instances in the group to simulate upgrading',
+        default=10
+    )
+    parser.add_argument(
+        '--boot_time_mean',
+        help='The mean time in seconds simulated instances take to boot',
+        default=300
+    )
+    parser.add_argument(
+        '--boot_time_stddev',
+        help='The standard deviation of the time simulated instances take to boot',
+        default=60
+    )
+    parser.add_argument(
+        '--boot_times',
+        help='A JSON file holding a list of observed boot times in seconds for simulated instances to take instead',
+        default=None
+    )
+    parser.add_argument(
+        '--record',
+        help='Record every AWS response and SSH probe result, with timings, to this cassette file',
+        default=None
+    )
+    parser.add_argument(
+        '--replay',
+        help='Replay AWS responses and SSH probe results from this cassette file instead of using AWS and SSH',
+        default=None
+    )
+    parser.add_argument(
+        '--replay_speed',
+        help='How many times faster than recorded to replay calls and waits, 0 for no delays at all (the default)',
+        default=0
+    )
+    parser.add_argument(
+        '--aws_concurrency', '--aws-concurrency',
+        help='The number of concurrent AWS calls to size connection pools for (defaults to --diff_workers)',
+        default=None
+    )
+
+    return parser.parse_args()
+
+
+def simulate(args):
+    from .simulate import get_boot_time_sampler, simulate_upgrade
+
+    history = None
+    if args.boot_times:
+        with open(args.boot_times) as boot_times_file:
+            history = json.load(boot_times_file)
+
+    group_size = int(args.simulate_size)
+    report = simulate_upgrade(
+        group_size,
+        boot_time_sampler=get_boot_time_sampler(
+            float(args.boot_time_mean), float(args.boot_time_stddev), history,
+            seed=0),
+        sleep_time_s=int(args.sleep),
+        max_wait_attempts=int(args.max_wait_attempts),
+        max_parallel_azs=int(args.max_parallel_azs),
+        replacement_order=args.replacement_order,
+        priority_tag=args.priority_tag)
+
+    if not report.completed:
+        print('!!! The upgrade gave up waiting for instances after %d attempts'
+              % int(args.max_wait_attempts))
+    print('Replaced %d of %d instance(s) in %.0f minutes' % (
+        report.instances_replaced, group_size, report.duration_s / 60))
+    print('At least %d instance(s) ready at all times, fewer than %d for %.0f '
+          'minutes' % (report.min_ready_instances, group_size,
+                       report.reduced_capacity_s / 60))
+    print('%d AWS API calls:' % sum(report.api_calls.values()))
+    for operation, calls in sorted(report.api_calls.items()):
+        print('  %s: %d' % (operation, calls))
+    print('%d readiness probes' % report.readiness_probes)
+
+
+def main():
+    args = parse_args()
+
+    configure_logging(args.debug)
+
+    if args.command in ('status', 'trigger'):
+        # Only talks to a running watch, which has AWS and SSH set up already
+        from .watch import DEFAULT_CONTROL_SOCKET, send_watch_command
+        command = 'status' if args.command == 'status' else \
+            'upgrade %s' % args.limit
+        response = send_watch_command(
+            args.control_socket or DEFAULT_CONTROL_SOCKET, command)
+        print(json.dumps(response, indent=2, sort_keys=True))
+        if not response['ok']:
+            sys.exit(1)
+        return
+
+    if args.command == 'simulate':
+        simulate(args)
+        return
+
+    # Imported here rather than at the top so that --help stays fast
+    from .aws import get_aws_session, has_aws_operation
+    from .cache import (
+        AsgNameIndex,
+        DiffCache,
+        get_asg_index_path,
+        get_default_cache_dir
+    )
+    from .journal import UpgradeJournal
+    from .manager import RollingUpgradeManager, UpgradeFailed
+
+    ssh_config = SshEnvConfig(
+        username=args.ssh_username,
+        private_key_file_path=args.ssh_private_key,
+        remote_port=22,
+        environment=None,
+        use_bastion_tunnel=args.ssh_tunnel
+    )
+
+    if args.record and args.replay:
+        sys.exit('--record and --replay cannot be used together')
+    if args.warm_pool_size and not args.replay and \
+            not has_aws_operation('autoscaling', 'PutWarmPool'):
+        sys.exit('--warm_pool_size needs a botocore release that supports '
+                 'warm pools, see requirements.txt')
+    if args.overlap_draining and not args.replay and \
+            not has_aws_operation('elbv2', 'DescribeTargetHealth'):
+        sys.exit('--overlap_draining needs a botocore release that supports '
+                 'target groups, see requirements.txt')
+
+    cache_dir = args.diff_cache_dir or get_default_cache_dir()
+    overrides = {}
+    recorder = None
+    if args.replay:
+        overrides = get_replay_overrides(args)
+    else:
+        if int(args.asg_index_ttl) > 0:
+            session = get_aws_session()
+            overrides['asg_index'] = AsgNameIndex(
+                get_asg_index_path(cache_dir, session.profile_name,
+                                   session.region_name),
+                ttl_s=int(args.asg_index_ttl))
+        if args.readiness == 'ssm':
+            from .ssm import SsmReadinessChecker
+            overrides['readiness_checker'] = SsmReadinessChecker(
+                endpoint_url=args.ssm_endpoint_url)
+
+    if args.record:
+        from .aws import AwsManager
+        from .cassette import CassetteRecorder, RecordingProxy
+        from .ssh import InstanceSshManager
+        recorder = CassetteRecorder(args.record)
+        overrides['aws_manager'] = RecordingProxy(AwsManager(
+            args.dry_run,
+            concurrency=int(args.aws_concurrency or args.diff_workers),
+            asg_index=overrides.pop('asg_index', None)), recorder, 'aws')
+        overrides['instance_manager'] = RecordingProxy(
+            InstanceSshManager.get_instance(ssh_config), recorder, 'ssh')
+        if 'readiness_checker' in overrides:
+            overrides['readiness_checker'] = RecordingProxy(
+                overrides['readiness_checker'], recorder, 'readiness')
+
+    if 'diff_cache' not in overrides and not args.no_diff_cache:
+        overrides['diff_cache'] = DiffCache(cache_dir)
+
+    rum = RollingUpgradeManager(
+        ssh_config=ssh_config,
+        max_wait_attempts=int(args.max_wait_attempts),
+        sleep_time_s=int(args.sleep),
+        do_dry_run=args.dry_run,
+        diff_workers=int(args.diff_workers),
+        aws_concurrency=args.aws_concurrency and int(args.aws_concurrency),
+        max_parallel_azs=int(args.max_parallel_azs),
+        replacement_order=args.replacement_order,
+        priority_tag=args.priority_tag,
+        journal=args.journal and UpgradeJournal(args.journal),
+        warm_pool_size=args.warm_pool_size and int(args.warm_pool_size),
+        overlap_draining=args.overlap_draining,
+        # A watch keeps SSH sessions, and the bastion transport, between
+        # upgrades
+        close_sessions_after_upgrade=args.command != 'watch',
+        **overrides
+    )
+
+    logger.debug('Arguments passed:\n%s', LazyPformat(args))
+
+    from .events import ConsoleReporter
+    rum.events.subscribe(ConsoleReporter())
+
+    progress_sink = None
+    if args.progress_events:
+        from .events import JsonLinesSink
+        progress_sink = JsonLinesSink(args.progress_events)
+        rum.events.subscribe(progress_sink)
+
+    try:
+        run_command(args, rum)
+    except UpgradeFailed as e:
+        sys.exit('!!! %s' % e)
+    finally:
+        if recorder is not None:
+            recorder.close()
+        if progress_sink is not None:
+            progress_sink.close()
+
+
+def get_replay_overrides(args):
+    """ Gets the RollingUpgradeManager arguments that replay a cassette
+    instead of using AWS and SSH.
+    """
+    from .cache import DiffCache
+    from .cassette import Cassette, ReplayingProxy
+    from .simulate import VirtualClock
+
+    speed = float(args.replay_speed)
+    cassette = Cassette(args.replay, speed=speed)
+    if speed:
+        clock = time
+        sleeper = lambda seconds: sleep(seconds / speed)
+    else:
+        virtual_clock = VirtualClock()
+        clock, sleeper = virtual_clock.time, virtual_clock.sleep
+
+    overrides = {
+        'aws_manager': ReplayingProxy(cassette, 'aws'),
+        'instance_manager': ReplayingProxy(cassette, 'ssh'),
+        # Cached diffs would skip calls the recording made
+        'diff_cache': DiffCache(None),
+        'clock': clock,
+        'sleeper': sleeper
+    }
+    if args.readiness == 'ssm':
+        overrides['readiness_checker'] = ReplayingProxy(cassette, 'readiness')
+    return overrides
+
+
+def run_command(args, rum):
+    rum.connect()
+
+    if args.command == 'plan':
+        print('Planning rolling upgrade for host %s' % (
+            args.limit))
+        plan = rum.make_upgrade_plan(args.limit)
+        with open(args.plan_file, 'w') as plan_file:
+            json.dump(plan, plan_file, indent=2, sort_keys=True)
+        print('Wrote plan to replace %d instance(s) in %d batch(es) to %s' % (
+            len(plan['instances_to_upgrade']), len(plan['batches']),
+            args.plan_file))
+    elif args.command == 'execute':
+        with open(args.plan_file) as plan_file:
+            plan = json.load(plan_file)
+        print('Executing rolling upgrade plan for %s' % plan['asg_name'])
+        rum.execute_upgrade_plan(plan)
+    elif args.command == 'watch':
+        from .watch import DEFAULT_CONTROL_SOCKET, UpgradeWatcher
+        asg_slugs = [asg_slug for asg_slug in args.limit.split(',')
+                     if asg_slug]
+        print('Watching %s for launch configuration changes' %
+              ', '.join(asg_slugs))
+        watcher = UpgradeWatcher(
+            rum,
+            asg_slugs,
+            poll_interval_s=int(args.watch_interval),
+            control_socket_path=args.control_socket or DEFAULT_CONTROL_SOCKET)
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            print('=== Stopped watching ===')
+    else:
+        print('Starting rolling upgrade for host %s' % (
+            args.limit))
+        rum.perform_rolling_upgrade_where_needed(args.limit)
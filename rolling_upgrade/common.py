@@ -0,0 +1,105 @@
+from collections import namedtuple
+
+
+# Lifecycle states of warm pool instances that have finished warming up
+WARMED_LIFECYCLE_STATES = frozenset([
+    'Warmed:Stopped',
+    'Warmed:Running',
+    'Warmed:Hibernated',
+])
+
+SshEnvConfig = namedtuple('SshEnvConfig', [
+    'username',
+    'private_key_file_path',
+    'remote_port',
+    'environment',
+    'use_bastion_tunnel'
+])
+
+
+class InstanceSnapshot(namedtuple('InstanceSnapshot', [
+    'id',
+    'launch_time',
+    'placement',
+    'private_ip_address',
+    'image_id',
+    'instance_type',
+    'kernel_id',
+    'key_name',
+    'iam_instance_profile',
+    'security_groups',
+    'block_device_mappings',
+    'tags',
+    'lifecycle_state',
+    'launch_configuration_name'
+])):
+    """ The parts of an EC2 instance that the rolling upgrade looks at.
+
+    Attribute names match those of boto3's ec2.Instance, but unlike it a
+    snapshot holds only what we need and never calls AWS when an attribute
+    is read.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_description(
+        cls,
+        description,
+        lifecycle_state=None,
+        launch_configuration_name=None
+    ):
+        """ Builds a snapshot from one of the instance descriptions in a
+        describe_instances response.
+
+        Args:
+            description: the instance description.
+            lifecycle_state: the instance's state in its autoscaling group,
+                             e.g. 'InService', if known.
+            launch_configuration_name: the launch configuration the instance
+                                       was launched with, if known.
+        """
+        return cls(
+            id=description['InstanceId'],
+            launch_time=description['LaunchTime'],
+            placement={'AvailabilityZone': description.get(
+                'Placement', {}).get('AvailabilityZone')},
+            private_ip_address=description.get('PrivateIpAddress'),
+            image_id=description.get('ImageId'),
+            instance_type=description.get('InstanceType'),
+            kernel_id=description.get('KernelId'),
+            key_name=description.get('KeyName'),
+            iam_instance_profile=description.get('IamInstanceProfile'),
+            security_groups=[{'GroupId': sg['GroupId']}
+                             for sg in description.get('SecurityGroups', [])],
+            block_device_mappings=[
+                {'DeviceName': mapping['DeviceName'],
+                 'Ebs': {'VolumeId': mapping['Ebs']['VolumeId']}}
+                for mapping in description.get('BlockDeviceMappings', [])
+                if 'Ebs' in mapping],
+            tags=description.get('Tags', []),
+            lifecycle_state=lifecycle_state,
+            launch_configuration_name=launch_configuration_name
+        )
+
+
+def is_in_service(instance):
+    """ Whether an instance is, or is assumed to be, in service in its
+    autoscaling group. Instances whose lifecycle state is unknown are assumed
+    to be in service.
+    """
+    return getattr(instance, 'lifecycle_state', None) in (None, 'InService')
+
+
+def is_terminating(instance):
+    """ Whether an instance is being terminated by its autoscaling group. """
+    return (getattr(instance, 'lifecycle_state', None) or '').startswith(
+        'Terminat')
+
+
+def is_warmed(warm_instance):
+    """ Whether a warm pool instance, as given by
+    AwsManager.get_warm_pool_instances(), has finished warming up and can
+    replace an instance straight away.
+    """
+    return warm_instance.get('LifecycleState') in WARMED_LIFECYCLE_STATES
+
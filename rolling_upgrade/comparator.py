@@ -0,0 +1,276 @@
+import hashlib
+import threading
+
+
+class InstanceConfigComparator(object):
+    """ Contains methods for comparing an instance to the launch configuration.
+    """
+
+    def compare_to_config(
+        self,
+        instance,
+        asg_launch_config,
+        instance_userdata
+    ):
+        """ Compares an instance config to the autoscaling group launch
+            configuration.
+
+        Does not include any differences between the EBS volumes.
+
+        Compares ImageId, InstanceType, KernelId, KeyName, which are required -
+        an error is raised if these are missing from either the instance or the
+        launch configuration.
+
+        Also compares IamInstanceProfile, but this can be missing from both the
+        instance and launch config. If it is only present in one of them, a
+        difference will be returned.
+
+        Args:
+            instance: the AWS EC2 instance
+            asg_launch_config: the autoscaling launch configuration
+            instance_userdata: the EC2 instance userdata (which sadly does not
+                               come with the rest of the user data)
+        Returns:
+            A list of differences between the instance config and launch config
+            keyed by their launch configuration name, e.g.
+            ['InstanceType', 'KeyName', 'IamInstanceProfile']
+        Raises:
+            AttributeError if the required attributes are missing from the
+            instance configuration or launch configuration
+        """
+        change_list = []
+
+        if instance_userdata != asg_launch_config['UserData']:
+            change_list.append('UserData')
+
+        instance_sg = sorted([sg['GroupId']
+                              for sg in instance.security_groups])
+        config_sg = sorted(asg_launch_config['SecurityGroups'])
+
+        if instance_sg != config_sg:
+            change_list.append('SecurityGroups')
+
+        def check_attr(instance_attr_name, config_attr_name):
+            try:
+                instance_attr = getattr(instance, instance_attr_name) or ''
+                config_attr = asg_launch_config[config_attr_name] or ''
+
+                if config_attr != '' and instance_attr != config_attr:
+                    change_list.append(config_attr_name)
+            except KeyError:
+                raise AttributeError('Launch configuration response was '
+                                     'missing required attribute ' +
+                                     config_attr_name)
+
+        check_attr('image_id', 'ImageId')
+        check_attr('instance_type', 'InstanceType')
+        check_attr('kernel_id', 'KernelId')
+        check_attr('key_name', 'KeyName')
+
+        instance_iam_profile = getattr(
+            instance, 'iam_instance_profile', '') or ''
+        config_iam_profile = asg_launch_config.get(
+            'IamInstanceProfile', '') or ''
+
+        if instance_iam_profile != config_iam_profile:
+            change_list.append('IamInstanceProfile')
+
+        return change_list
+
+    def compare_volumes_config(
+        self,
+        instance_volumes_dict,
+        config_volumes_dict
+    ):
+        """ Compares EBS volume configuration between the instance and launch
+        config.
+
+        If the launch configuration contains no volume mappings, the instance
+        should have a default EBS configuration so if it has one mapping and
+        the config has none, this function will return no difference.
+
+        If there are differences in device names, e.g. devices have been added
+        or removed, this script will return 'DeviceName:sdaX' for each device
+        that is different.
+
+        Otherwise, the VolumeType, VolumeSize and DeleteOnTermination flags
+        will be compared and any differences will be returned.
+
+        Args:
+            instance_volumes_dict: Instance configuration with device names as
+                                   keys and config as values.
+            config_volumes_dict: Config configuration with device names as
+                                 keys and config as values.
+        Returns:
+            A list of differences between the volume configurations.
+        """
+        if not len(config_volumes_dict) and len(instance_volumes_dict) == 1:
+            return []
+
+        device_name_differences = set(instance_volumes_dict.keys()) ^  \
+            set(config_volumes_dict.keys())
+
+        if len(device_name_differences):
+            return ['DeviceName:%s' % dev for dev in
+                    sorted(device_name_differences)]
+
+        change_list = []
+
+        for device_name, instance_volume in instance_volumes_dict.iteritems():
+
+            config_volume = config_volumes_dict[device_name]
+
+            if (instance_volume['VolumeType'] !=
+                    config_volume['Ebs']['VolumeType']):
+                change_list.append(
+                    device_name + '.BlockDeviceMappings.Ebs.VolumeType')
+            if instance_volume['Size'] != config_volume['Ebs']['VolumeSize']:
+                change_list.append(
+                    device_name + '.BlockDeviceMappings.Ebs.Size')
+            if (instance_volume['Attachments'][0]['DeleteOnTermination'] !=
+                    config_volume['Ebs']['DeleteOnTermination']):
+                change_list.append(device_name + '.BlockDeviceMappings' +
+                                   '.Ebs.DeleteOnTermination')
+
+        return change_list
+
+
+_MISSING = object()
+
+_LAUNCH_CONFIG_IDENTITY_FIELDS = frozenset([
+    'LaunchConfigurationName',
+    'LaunchConfigurationARN',
+    'CreatedTime'
+])
+
+
+def get_changed_launch_config_fields(old_config, new_config):
+    """ Gets the fields that differ between two launch configurations,
+    ignoring those that identify the configuration rather than configure
+    instances, such as its name.
+
+    Returns:
+        a sorted list of field names, e.g. ['ImageId']
+    """
+    field_names = (set(old_config) | set(new_config)) - \
+        _LAUNCH_CONFIG_IDENTITY_FIELDS
+    return sorted(name for name in field_names
+                  if old_config.get(name) != new_config.get(name))
+
+
+def _freeze(value):
+    """ Converts nested dicts and lists into hashable tuples. """
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item))
+                            for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def get_userdata_digest(userdata):
+    """ Gets a digest of Base64-encoded userdata, so that large userdata blobs
+    can be compared and used as keys cheaply.
+    """
+    if userdata is None:
+        return None
+    if not isinstance(userdata, bytes):
+        userdata = userdata.encode('utf-8')
+    return hashlib.sha256(userdata).hexdigest()
+
+
+class DeduplicatingConfigComparator(object):
+    """ Compares instances to the launch configuration, comparing each
+    distinct combination of instance settings only once.
+
+    Most instances in a group share the same image, type, kernel, key, IAM
+    profile, security groups, userdata and volume layout. Instances are keyed
+    by exactly the values InstanceConfigComparator looks at, the first
+    instance with a given key is compared, and its result is reused for
+    every later instance with the same key. Userdata is compared by digest.
+    """
+
+    def __init__(self, comparator=None):
+        """
+        Args:
+            comparator: Use to override the InstanceConfigComparator that
+                        does the actual comparisons.
+        """
+        self._comparator = comparator or InstanceConfigComparator()
+        self._lock = threading.Lock()
+        self._config = None
+        self._digested_config = None
+        self._results = {}
+
+    @staticmethod
+    def get_comparison_key(instance, instance_userdata, instance_volumes_dict):
+        """ Gets a hashable key made of everything that is compared to the
+        launch configuration for an instance.
+        """
+        return (
+            get_userdata_digest(instance_userdata),
+            tuple(sorted(sg['GroupId'] for sg in instance.security_groups)),
+            tuple(_freeze(getattr(instance, attr_name, _MISSING))
+                  for attr_name in ('image_id', 'instance_type', 'kernel_id',
+                                    'key_name', 'iam_instance_profile')),
+            None if instance_volumes_dict is None else tuple(sorted(
+                (device_name,
+                 volume.get('VolumeType'),
+                 volume.get('Size'),
+                 volume.get('Attachments', [{}])[0].get('DeleteOnTermination'))
+                for device_name, volume in instance_volumes_dict.items()))
+        )
+
+    def _use_config(self, config):
+        # Results only hold for one launch configuration
+        if config is not self._config:
+            self._config = config
+            self._digested_config = dict(config)
+            if 'UserData' in config:
+                self._digested_config['UserData'] = get_userdata_digest(
+                    config['UserData'])
+            self._results = {}
+        return self._digested_config, self._results
+
+    def compare(
+        self,
+        instance,
+        config,
+        instance_userdata,
+        instance_volumes_dict,
+        config_volumes_dict
+    ):
+        """ Compares an instance and its volumes to the launch configuration.
+
+        Args:
+            instance: the AWS EC2 instance
+            config: the autoscaling launch configuration
+            instance_userdata: the EC2 instance userdata
+            instance_volumes_dict: see
+                                   InstanceConfigComparator.compare_volumes_config()
+                                   or None if the volumes are known to match
+                                   the launch configuration.
+            config_volumes_dict: see
+                                 InstanceConfigComparator.compare_volumes_config()
+        Returns:
+            A list of differences, as given by
+            InstanceConfigComparator.compare_to_config() followed by
+            InstanceConfigComparator.compare_volumes_config()
+        """
+        key = DeduplicatingConfigComparator.get_comparison_key(
+            instance, instance_userdata, instance_volumes_dict)
+
+        with self._lock:
+            digested_config, results = self._use_config(config)
+            if key in results:
+                return list(results[key])
+
+        changes = self._comparator.compare_to_config(
+            instance, digested_config, get_userdata_digest(instance_userdata))
+        if instance_volumes_dict is not None:
+            changes += self._comparator.compare_volumes_config(
+                instance_volumes_dict, config_volumes_dict)
+
+        with self._lock:
+            results[key] = changes
+        return list(changes)
@@ -0,0 +1,260 @@
+from collections import namedtuple
+import json
+import sys
+import threading
+from time import time
+
+
+UPGRADE_STARTED = 'upgrade_started'
+UPGRADE_RESUMED = 'upgrade_resumed'
+WARM_POOL_PREPARED = 'warm_pool_prepared'
+INSTANCE_STALE = 'instance_stale'
+WAIT_ATTEMPT = 'wait_attempt'
+WAIT_GIVEN_UP = 'wait_given_up'
+INSTANCES_BOOTED = 'instances_booted'
+INSTANCES_READY = 'instances_ready'
+INSTANCE_DETACHED = 'instance_detached'
+INSTANCE_TERMINATED = 'instance_terminated'
+UPGRADE_FINISHED = 'upgrade_finished'
+
+EVENT_KINDS = frozenset([
+    UPGRADE_STARTED,
+    UPGRADE_RESUMED,
+    WARM_POOL_PREPARED,
+    INSTANCE_STALE,
+    WAIT_ATTEMPT,
+    WAIT_GIVEN_UP,
+    INSTANCES_BOOTED,
+    INSTANCES_READY,
+    INSTANCE_DETACHED,
+    INSTANCE_TERMINATED,
+    UPGRADE_FINISHED,
+])
+
+
+class ProgressEvent(namedtuple('ProgressEvent', ['kind', 'time', 'fields'])):
+    """ Something that happened during a rolling upgrade.
+
+    kind is one of EVENT_KINDS, time the time it happened and fields a dict of
+    JSON-serialisable details, e.g. instance_id for INSTANCE_TERMINATED, or
+    phase ('boot', 'ready', 'scaling_activities', 'warm_pool' or
+    'draining'), attempt and max_attempts for WAIT_ATTEMPT.
+    """
+    __slots__ = ()
+
+    def to_dict(self):
+        """ Gets the event as a single flat dict, with its kind under 'event'.
+        """
+        event = dict(self.fields)
+        event.update(event=self.kind, time=self.time)
+        return event
+
+
+class ProgressEvents(object):
+    """ Hands progress events to whoever subscribed to them.
+
+    Subscribers are called synchronously, in the thread the event happened
+    in, in the order they subscribed. When nothing is subscribed, emitting an
+    event does nothing at all.
+    """
+
+    def __init__(self, clock=time):
+        """
+        Args:
+            clock: Use to override the time function.
+        """
+        self._clock = clock
+        # Replaced rather than changed, so that emit() needs no lock
+        self._subscribers = ()
+        self._lock = threading.Lock()
+
+    def subscribe(self, subscriber):
+        """ Starts calling a function with every progress event.
+
+        Args:
+            subscriber: a function taking a ProgressEvent.
+        """
+        with self._lock:
+            self._subscribers += (subscriber,)
+
+    def unsubscribe(self, subscriber):
+        """ Stops calling a function given to subscribe(). """
+        with self._lock:
+            self._subscribers = tuple(
+                existing for existing in self._subscribers
+                if existing != subscriber)
+
+    def has_subscribers(self):
+        """ Whether any function is subscribed, e.g. to skip working out the
+        details of an event nobody will see.
+        """
+        return bool(self._subscribers)
+
+    def emit(self, kind, **fields):
+        """ Hands an event to every subscriber.
+
+        Args:
+            kind: one of EVENT_KINDS.
+            fields: JSON-serialisable details of the event.
+        """
+        subscribers = self._subscribers
+        if not subscribers:
+            return
+        event = ProgressEvent(kind, self._clock(), fields)
+        for subscriber in subscribers:
+            subscriber(event)
+
+
+class JsonLinesSink(object):
+    """ A progress event subscriber that writes every event as a line of JSON,
+    e.g. for a deployment pipeline to follow an upgrade.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path: the file to append events to, or '-' for standard output.
+        """
+        if path == '-':
+            self._file = sys.stdout
+            self._owns_file = False
+        else:
+            self._file = open(path, 'a')
+            self._owns_file = True
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event.to_dict(), sort_keys=True, default=str)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        """ Closes the file written to, unless it is standard output. """
+        if self._owns_file:
+            self._file.close()
+
+
+class ConsoleReporter(object):
+    """ A progress event subscriber that writes a line of text for a person to
+    read for every event, e.g. to the console of a command line upgrade.
+
+    The RollingUpgradeManager writes nothing to the console itself, so that
+    code embedding it decides where its progress goes.
+    """
+
+    def __init__(self, stream=None):
+        """
+        Args:
+            stream: the stream to write to, standard output by default.
+        """
+        self._stream = stream or sys.stdout
+
+    def __call__(self, event):
+        lines = self.format(event)
+        if lines:
+            self._stream.write('\n'.join(lines) + '\n')
+            self._stream.flush()
+
+    @staticmethod
+    def _format_wait_attempt(fields):
+        attempt = 'attempt %d of %d' % (fields['attempt'],
+                                        fields['max_attempts'])
+        phase = fields['phase']
+        if phase == 'boot':
+            return '%d instances have booted - Waiting for %d more, %s' % (
+                fields['num_instances'],
+                fields['expected_num_instances'] - fields['num_instances'],
+                attempt)
+        elif phase == 'ready':
+            return 'Waiting for instances to finish cloud-init, ' + attempt
+        elif phase == 'scaling_activities':
+            return 'Waiting for %d scaling activities to finish, %s' % (
+                fields['num_activities'], attempt)
+        elif phase == 'warm_pool':
+            return 'Waiting for %d more instance(s) to warm up in the warm ' \
+                'pool, %s' % (fields['num_needed'] - fields['num_warmed'],
+                              attempt)
+        elif phase == 'draining':
+            return 'Waiting for %d instance(s) to drain and %d to become ' \
+                'healthy in the target groups, %s' % (
+                    len(fields['draining_instance_ids']),
+                    len(fields['unhealthy_instance_ids']), attempt)
+        return 'Waiting for %s, %s' % (phase, attempt)
+
+    @staticmethod
+    def _format_upgrade_finished(fields):
+        batches = fields.get('batches')
+        if batches:
+            return ['%d instance(s) that do not match the configuration' %
+                    sum(len(batch) for batch in batches)] + [
+                'Would replace ' + ', '.join(batch) for batch in batches] + [
+                '=== Dry run, not terminating any instances ===']
+        if not fields.get('instances_replaced'):
+            return ['=== No differences between instances and configuration '
+                    'found ===']
+        return ['=== Upgrade of %s finished, %d instance(s) replaced ===' % (
+            fields['asg_name'], fields['instances_replaced'])]
+
+    @staticmethod
+    def _format_warm_pool_prepared(fields):
+        lines = []
+        if fields['dry_run']:
+            if fields['created']:
+                lines.append('Would create a warm pool of %d instance(s)' %
+                             fields['min_size'])
+            lines.extend('Would terminate warm pool instance ' + instance_id
+                         for instance_id in fields['outdated_instance_ids'])
+        else:
+            if fields['created']:
+                lines.append('Created a warm pool of %d instance(s)' %
+                             fields['min_size'])
+            lines.extend('!!! Terminated warm pool instance ' + instance_id
+                         for instance_id in fields['outdated_instance_ids'])
+        return lines
+
+    def format(self, event):
+        """ Gets the lines of text describing an event.
+
+        Args:
+            event: a ProgressEvent.
+        Returns:
+            a list of lines, empty for events not worth reporting.
+        """
+        fields = event.fields
+        if event.kind == UPGRADE_STARTED:
+            return ['=== Upgrading %s to launch configuration %s ===' % (
+                fields['asg_name'], fields['launch_configuration_name'])]
+        elif event.kind == UPGRADE_RESUMED:
+            lines = ['Resuming interrupted upgrade after "%s": %d instance(s) '
+                     'already compared, %d terminated' % (
+                         fields['phase'], fields['num_compared'],
+                         fields['num_terminated'])]
+            if fields['detached_instance_ids']:
+                lines.append('Finishing the replacement of %d detached '
+                             'instance(s)' %
+                             len(fields['detached_instance_ids']))
+            return lines
+        elif event.kind == WARM_POOL_PREPARED:
+            return self._format_warm_pool_prepared(fields)
+        elif event.kind == INSTANCE_STALE:
+            return ['Instance %s does not match the launch configuration: %s'
+                    % (fields['instance_id'],
+                       ', '.join(fields['differences']))]
+        elif event.kind == WAIT_ATTEMPT:
+            return [self._format_wait_attempt(fields)]
+        elif event.kind == WAIT_GIVEN_UP and fields['phase'] == 'warm_pool':
+            return ['Only %d instance(s) warmed up, replacing without the '
+                    'warm pool' % fields['num_warmed']]
+        elif event.kind == INSTANCES_BOOTED:
+            return ['=== All instances have booted ===']
+        elif event.kind == INSTANCES_READY:
+            return ['=== All instances have completed cloud-init ===']
+        elif event.kind == INSTANCE_DETACHED:
+            return ['!!! Detached %s to drain its connections' %
+                    fields['instance_id']]
+        elif event.kind == INSTANCE_TERMINATED:
+            return ['!!! Terminated ' + fields['instance_id']]
+        elif event.kind == UPGRADE_FINISHED:
+            return self._format_upgrade_finished(fields)
+        return []
@@ -0,0 +1,135 @@
+from collections import namedtuple
+import hashlib
+import json
+import os
+import threading
+from time import time
+
+
+JournalState = namedtuple('JournalState', [
+    'phase',
+    'diffs',
+    'terminated',
+    'ready_instance_ids',
+    'detached'
+])
+
+
+def get_config_fingerprint(config):
+    """ Gets a digest identifying a launch configuration's contents.
+
+    Args:
+        config: the launch configuration, as given by
+                AwsManager.get_launch_config_for_asg()
+    """
+    serialised = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha256(serialised.encode('utf-8')).hexdigest()
+
+
+class UpgradeJournal(object):
+    """ An append-only local record of a rolling upgrade's progress.
+
+    Every step of an upgrade (instances compared, found ready, detached or
+    terminated)
+    is appended to the journal as a JSON line as soon as it happens. If the
+    upgrade is interrupted, rerunning it against the same autoscaling group
+    and launch configuration resumes from the journal instead of starting
+    from scratch. The journal is removed once the upgrade completes.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path: the file to keep the journal in.
+        """
+        self._path = path
+        self._lock = threading.Lock()
+
+    def read(self):
+        """ Reads all entries from the journal.
+
+        A partially written last line, e.g. from a process killed mid-write,
+        is ignored.
+
+        Returns:
+            a list of dicts, oldest first.
+        """
+        if not os.path.exists(self._path):
+            return []
+
+        entries = []
+        with open(self._path) as journal_file:
+            for line in journal_file:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    break
+        return entries
+
+    def record(self, event, **fields):
+        """ Appends an entry to the journal, and makes sure it reaches the
+        disk before returning.
+
+        Args:
+            event: the kind of entry, e.g. 'terminated'
+            fields: extra JSON-serialisable values to record.
+        """
+        fields.update(event=event, time=time())
+        with self._lock:
+            with open(self._path, 'a') as journal_file:
+                journal_file.write(json.dumps(fields, sort_keys=True) + '\n')
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+
+    def clear(self):
+        """ Removes the journal. """
+        with self._lock:
+            if os.path.exists(self._path):
+                os.remove(self._path)
+
+    def resume(self, asg_name, config_fingerprint):
+        """ Starts or resumes the journal for an upgrade.
+
+        If the journal belongs to a different autoscaling group or launch
+        configuration it is discarded and a new one started.
+
+        Args:
+            asg_name: the name of the autoscaling group being upgraded.
+            config_fingerprint: as given by get_config_fingerprint()
+        Returns:
+            a JournalState with what was already done. phase is None if the
+            upgrade starts from scratch. diffs maps instance IDs to their
+            differences from the launch configuration, terminated is a set of
+            instance IDs and ready_instance_ids is the sorted list of instance
+            IDs last found ready, if no instance was detached or terminated
+            since. detached is the set of instance IDs detached from the
+            group but not terminated yet.
+        """
+        entries = self.read()
+        if not entries or entries[0].get('asg_name') != asg_name or \
+                entries[0].get('config_fingerprint') != config_fingerprint:
+            self.clear()
+            self.record('started', asg_name=asg_name,
+                        config_fingerprint=config_fingerprint)
+            return JournalState(None, {}, set(), None, set())
+
+        diffs = {}
+        terminated = set()
+        ready_instance_ids = None
+        detached = set()
+        for entry in entries:
+            if entry['event'] == 'compared':
+                diffs[entry['instance_id']] = entry['diffs']
+            elif entry['event'] == 'terminated':
+                terminated.add(entry['instance_id'])
+                detached.discard(entry['instance_id'])
+                ready_instance_ids = None
+            elif entry['event'] == 'detached':
+                detached.add(entry['instance_id'])
+                ready_instance_ids = None
+            elif entry['event'] == 'ready':
+                ready_instance_ids = entry['instance_ids']
+
+        self.record('resumed')
+        return JournalState(entries[-1]['event'], diffs, terminated,
+                            ready_instance_ids, detached)
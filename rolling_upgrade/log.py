@@ -0,0 +1,96 @@
+import logging
+import pprint
+import sys
+import threading
+from time import time
+
+
+# The logger every module's logger is a child of
+PACKAGE_LOGGER_NAME = __name__.rpartition('.')[0]
+
+# Libraries should not configure logging for their users, but a handler
+# stops Python 2 complaining that there is none
+logging.getLogger(PACKAGE_LOGGER_NAME).addHandler(logging.NullHandler())
+
+
+class LazyPformat(object):
+    """ Pretty-prints an object only if a log message including it is
+    actually written, e.g. logger.debug('Instances: %s', LazyPformat(x)).
+    """
+    __slots__ = ('_obj',)
+
+    def __init__(self, obj):
+        self._obj = obj
+
+    def __str__(self):
+        return pprint.pformat(self._obj)
+
+
+class RateLimitingFilter(logging.Filter):
+    """ Lets the same log message through at most once every interval.
+
+    Messages are the same if they come from the same logger at the same level
+    and read the same once formatted, e.g. an unchanged list of instances
+    logged on every attempt of a wait. How many were held back is added to
+    the next one let through, if it comes within another interval. Messages
+    are forgotten after that, so that a long run of ever-changing messages
+    does not use ever more memory.
+    """
+
+    def __init__(self, interval_s=60, clock=time):
+        """
+        Args:
+            interval_s: time in seconds to hold back repeats of a message for.
+            clock: Use to override the time function.
+        """
+        logging.Filter.__init__(self)
+        self._interval_s = interval_s
+        self._clock = clock
+        self._seen = {}
+        self._forget_at = clock() + interval_s
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        message = record.getMessage()
+        key = (record.name, record.levelno, message)
+        now = self._clock()
+        with self._lock:
+            if now >= self._forget_at:
+                self._forget_old_messages(now)
+            last_time, num_suppressed = self._seen.get(key, (None, 0))
+            if last_time is not None and now - last_time < self._interval_s:
+                self._seen[key] = (last_time, num_suppressed + 1)
+                return False
+            self._seen[key] = (now, 0)
+
+        # Formatted once here, so that handlers do not format it again
+        if num_suppressed:
+            message += ' (repeated %d more time(s))' % num_suppressed
+        record.msg = message
+        record.args = None
+        return True
+
+    def _forget_old_messages(self, now):
+        # Done at most once an interval, so that it costs little per message
+        self._seen = dict(
+            (key, seen) for key, seen in self._seen.iteritems()
+            if now - seen[0] < 2 * self._interval_s)
+        self._forget_at = now + self._interval_s
+
+
+def configure_logging(debug=False, stream=None, interval_s=60):
+    """ Sends the rolling upgrade's log messages to the console.
+
+    Args:
+        debug: whether to include debug messages, rather than only
+               informational ones and worse.
+        stream: the stream to write to, standard output by default.
+        interval_s: time in seconds to hold back repeated messages for.
+    """
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    handler.addFilter(RateLimitingFilter(interval_s))
+
+    logger = logging.getLogger(PACKAGE_LOGGER_NAME)
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG if debug else logging.INFO)
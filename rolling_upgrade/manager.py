@@ -0,0 +1,1188 @@
+from contextlib import contextmanager
+import logging
+import re
+from time import sleep, time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .comparator import (
+    DeduplicatingConfigComparator,
+    InstanceConfigComparator,
+    get_changed_launch_config_fields
+)
+from .common import is_warmed
+from .events import (
+    INSTANCE_DETACHED,
+    INSTANCE_STALE,
+    INSTANCE_TERMINATED,
+    INSTANCES_BOOTED,
+    INSTANCES_READY,
+    UPGRADE_FINISHED,
+    UPGRADE_RESUMED,
+    UPGRADE_STARTED,
+    WAIT_ATTEMPT,
+    WAIT_GIVEN_UP,
+    WARM_POOL_PREPARED,
+    ProgressEvents
+)
+from .log import LazyPformat
+from .journal import get_config_fingerprint
+from .scheduler import (
+    DEFAULT_PRIORITY_TAG,
+    REPLACEMENT_ORDERS,
+    WHOLE_GROUP_ORDERS,
+    ReplacementScheduler,
+    az_balance,
+    get_availability_zone,
+    oldest_first,
+    tag_priority
+)
+
+
+logger = logging.getLogger(__name__)
+
+# Launch configuration fields that can only be checked against an instance
+# by fetching more information about it from AWS
+LOOKUP_FIELDS = frozenset(['UserData', 'BlockDeviceMappings'])
+
+LAUNCH_CONFIGS_BATCH_SIZE = 50
+
+
+class UpgradeFailed(Exception):
+    """ Raised when a rolling upgrade cannot carry on, e.g. because
+    instances did not boot within max_wait_attempts.
+    """
+
+
+class RollingUpgradeManager(object):
+    """ Manages the whole rolling upgrade process.
+
+    Progress is only reported through events, see the events property; the
+    manager writes nothing to the console itself.
+    """
+
+    @staticmethod
+    def get_oldest_instance(instances):
+        """ Given a list of instances, gets the instance that was launched
+        first.
+
+        Args:
+            instances: List of EC2 instances.
+        """
+        return min(instances, key=lambda instance: instance.launch_time)
+
+    def __init__(
+        self,
+        ssh_config,
+        do_dry_run=False,
+        max_wait_attempts=40,
+        sleep_time_s=30,
+        aws_manager=None,
+        instance_manager=None,
+        instance_config_comparator=None,
+        diff_workers=10,
+        aws_concurrency=None,
+        max_parallel_azs=1,
+        replacement_order='oldest',
+        priority_tag=DEFAULT_PRIORITY_TAG,
+        journal=None,
+        diff_cache=None,
+        asg_index=None,
+        warm_pool_size=None,
+        overlap_draining=False,
+        progress_events=None,
+        readiness_checker=None,
+        close_sessions_after_upgrade=True,
+        clock=time,
+        sleeper=sleep
+    ):
+        """
+        Args:
+            ssh_config: SshEnvConfig tuple containing SSH parameters
+            do_dry_run: If enabled, will perform the operation without any side
+                        effects (will not terminate any instances)
+            max_wait_attempts: Number of attempts to wait for instances to boot
+                               up before failing.
+            sleep_time_s: Time in seconds to sleep before waiting for instances
+                          to boot up
+            aws_manager: Use to override the AwsManager instance.
+            instance_manager: Use to override the InstanceManager instance.
+            instance_config_comparator: Use to override the
+                                        InstanceConfigComparator.
+            diff_workers: Number of instances to compare to the launch
+                          configuration concurrently. 1 compares serially.
+            aws_concurrency: Number of concurrent AWS calls to size the
+                             connection pool for. Defaults to diff_workers.
+            max_parallel_azs: Number of Availability Zones in which to
+                              replace an instance at the same time. Never
+                              more than one instance per AZ is replaced at
+                              once.
+            replacement_order: Which stale instances to replace first, one of
+                               REPLACEMENT_ORDERS.
+            priority_tag: Name of the instance tag used by the 'tag'
+                          replacement order.
+            journal: An UpgradeJournal to record progress in and resume
+                     from, or None to always start from scratch.
+            diff_cache: A DiffCache to keep the results of comparing
+                        instances to launch configurations in between runs,
+                        or None to only keep them for this upgrade.
+            asg_index: An AsgNameIndex to find autoscaling groups with, or
+                       None to always list every group in the account.
+            warm_pool_size: Number of instances in the warm pool to create
+                            for autoscaling groups that have none, or None
+                            to only use warm pools that already exist.
+            overlap_draining: If enabled, instances are detached from the
+                              group, so that their connections drain from the
+                              group's target groups while their replacements
+                              boot, and terminated afterwards.
+            progress_events: Use to override the ProgressEvents that progress
+                             is reported through.
+            readiness_checker: An SsmReadinessChecker, or anything else with
+                               an are_ready(instance_ids) method, to check
+                               all instances at once with, instead of SSHing
+                               into each one.
+            close_sessions_after_upgrade: If disabled, SSH sessions opened to
+                                          probe instances, and any bastion
+                                          transport, are kept open between
+                                          upgrades until close_sessions() is
+                                          called, e.g. by a watch.
+            clock: Use to override the time function.
+            sleeper: Use to override the sleep function.
+        """
+        self._do_dry_run = do_dry_run
+        self._sleep_time_s = sleep_time_s
+        self._clock = clock
+        self._sleeper = sleeper
+        self._diff_workers = diff_workers
+        self._max_parallel_azs = max_parallel_azs
+        self._journal = journal
+        self._diff_cache = diff_cache
+        self._warm_pool_size = warm_pool_size
+        self._overlap_draining = overlap_draining
+        self._events = progress_events or ProgressEvents(clock)
+        self._readiness_checker = readiness_checker
+        self._close_sessions_after_upgrade = close_sessions_after_upgrade
+        # Instances found to have finished booting, which they never undo
+        self._ready_instance_ids = set()
+        # Instances looked up to be probed but not found ready yet, by ID
+        self._unready_instances = {}
+        # Instances in the group not being terminated, by ID, as first found
+        self._remaining_instances = {}
+        self._known_diffs = {}
+        self._known_diffs_config = None
+        # Fingerprint of _known_diffs_config, only worked out once per upgrade
+        self._config_fingerprint = None
+        self._pending_diffs = {}
+        self._diff_executor = None
+        self._resumed_ready_instance_ids = None
+        self._resumed_detached_ids = []
+        self._priority_key = self._get_priority_key(replacement_order,
+                                                    priority_tag)
+        self._scheduler = ReplacementScheduler(
+            self._priority_key,
+            rebuild_on_update=replacement_order in WHOLE_GROUP_ORDERS)
+        self._max_wait_attempts = max_wait_attempts
+        if aws_manager is None:
+            from .aws import AwsManager
+            aws_manager = AwsManager(
+                do_dry_run, concurrency=aws_concurrency or diff_workers,
+                asg_index=asg_index)
+        self._aws_manager = aws_manager
+        self._ssh_config = ssh_config
+        self._instance_manager = instance_manager
+        self._instance_config_comparator = (instance_config_comparator or
+                                            InstanceConfigComparator())
+        self._deduplicating_comparator = DeduplicatingConfigComparator(
+            self._instance_config_comparator)
+        self._previous_configs = {}
+
+    @property
+    def events(self):
+        """ The ProgressEvents to subscribe to for progress reports. """
+        return self._events
+
+    def _get_instance_manager(self):
+        # Created on first use, so that paramiko is only loaded when instances
+        # are actually probed
+        if self._instance_manager is None:
+            from .ssh import InstanceSshManager
+            self._instance_manager = InstanceSshManager.get_instance(
+                self._ssh_config)
+        return self._instance_manager
+
+    def close_sessions(self):
+        """ Closes every SSH session kept open to probe instances, and any
+        bastion transport they go through.
+        """
+        if self._instance_manager is not None:
+            self._instance_manager.close_connections()
+
+    def _end_instance_probes(self):
+        # Instances still booting are looked up again by the next upgrade
+        self._unready_instances.clear()
+        if self._close_sessions_after_upgrade:
+            self.close_sessions()
+
+    def _get_priority_key(self, replacement_order, priority_tag):
+        if replacement_order == 'oldest':
+            return oldest_first
+        elif replacement_order == 'tag':
+            return tag_priority(priority_tag)
+        elif replacement_order == 'az_balance':
+            return az_balance()
+        raise ValueError('Unknown replacement order "%s", expected one of %s' %
+                         (replacement_order, ', '.join(REPLACEMENT_ORDERS)))
+
+    def _record(self, event, **fields):
+        if self._journal is not None:
+            self._journal.record(event, **fields)
+
+    def _resume(self, asg, config):
+        # Diffs from an earlier upgrade on this manager may be for another
+        # launch configuration
+        self._known_diffs = {}
+        self._known_diffs_config = config
+        self._config_fingerprint = get_config_fingerprint(config)
+        self._pending_diffs = {}
+        self._remaining_instances = {}
+        self._scheduler.update([])
+        self._resumed_ready_instance_ids = None
+        self._resumed_detached_ids = []
+        if self._journal is None:
+            return
+
+        state = self._journal.resume(asg['AutoScalingGroupName'],
+                                     self._config_fingerprint)
+        if state.phase is None:
+            return
+
+        self._known_diffs.update(state.diffs)
+        self._resumed_ready_instance_ids = state.ready_instance_ids
+        self._resumed_detached_ids = sorted(state.detached)
+        self._events.emit(
+            UPGRADE_RESUMED, phase=state.phase, num_compared=len(state.diffs),
+            num_terminated=len(state.terminated),
+            detached_instance_ids=self._resumed_detached_ids)
+
+    def _were_ready_before_resume(self, instance_ids):
+        ready_instance_ids = self._resumed_ready_instance_ids
+        self._resumed_ready_instance_ids = None
+        return ready_instance_ids is not None and \
+            ready_instance_ids == sorted(instance_ids)
+
+    def connect(self, autoscaling_client=None, ec2_client=None):
+        """ Connects to AWS. """
+        self._aws_manager.connect(autoscaling_client, ec2_client)
+
+    def get_single_asg(self, asg_slug):
+        """ Finds the one autoscaling group whose name starts with a slug.
+
+        Args:
+            asg_slug: Start of the autoscaling group name, as a regex.
+        Returns:
+            the autoscaling group, as given by AwsManager.find_asg_group().
+        """
+        regex_pat = '^%s' % (asg_slug)
+        as_group_list = self._aws_manager.find_asg_group(regex_pat)
+        if len(as_group_list) != 1:
+            raise Exception(
+                'Found %d autoscaling groups with regex "%s", expected 1' % (
+                    len(as_group_list), regex_pat
+                ))
+
+        return as_group_list[0]
+
+    def _on_still_waiting_for_boot(self, current_attempts, expected_num_instances, instance_ids):
+        logger.debug('Instances: %s', LazyPformat(instance_ids))
+        self._events.emit(
+            WAIT_ATTEMPT, phase='boot', attempt=current_attempts,
+            max_attempts=self._max_wait_attempts,
+            num_instances=len(instance_ids),
+            expected_num_instances=expected_num_instances)
+
+    def _get_remaining_instances(self, asg):
+        instance_ids = self._aws_manager.get_remaining_instance_ids(asg)
+        self._update_remaining_instances(asg, instance_ids)
+        return [self._remaining_instances[instance_id]
+                for instance_id in instance_ids
+                if instance_id in self._remaining_instances]
+
+    def _update_remaining_instances(self, asg, instance_ids):
+        """ Brings the instances remaining in the group up to date with their
+        IDs. As instances never change, only those that joined the group
+        since the last update are looked up.
+
+        Returns:
+            the instances that joined the group, in the group's order.
+        """
+        for instance_id in set(self._remaining_instances).difference(
+                instance_ids):
+            del self._remaining_instances[instance_id]
+        joined_ids = [instance_id for instance_id in instance_ids
+                      if instance_id not in self._remaining_instances]
+        if not joined_ids:
+            return []
+
+        joined_instances = self._aws_manager.get_instances_for_asg(
+            asg, joined_ids)
+        for instance in joined_instances:
+            self._remaining_instances[instance.id] = instance
+        return joined_instances
+
+    def wait_for_instances(self, asg, expected_num_instances):
+        """ Waits for the expected number of instances to be available and
+            booted.
+
+        Only instances in service in the autoscaling group are counted, so
+        instances still pending or already terminating are waited out.
+
+        Args:
+            asg: autoscaling group to find instances in
+            expected_num_instances: how many instances to wait for. Typically
+                                    should be the 'DesiredSize' of the ASG
+        Raises:
+            UpgradeFailed if the instances are not ready after
+            max_wait_attempts.
+        """
+        current_attempts = 0
+        booted = False
+        probed_ids = None
+        unready_ids = []
+
+        # Only IDs are polled, and instances are only looked up to be probed
+        instance_ids = self._aws_manager.get_in_service_instance_ids(asg)
+
+        while (current_attempts < self._max_wait_attempts):
+
+            if len(instance_ids) >= expected_num_instances:
+                if not booted and self._events.has_subscribers():
+                    self._events.emit(INSTANCES_BOOTED,
+                                      instance_ids=sorted(instance_ids))
+                booted = True
+
+                if self._were_ready_before_resume(instance_ids):
+                    unready_ids = []
+                else:
+                    # Instances found ready stay ready, so while the group is
+                    # unchanged only those unready at the last poll are
+                    # probed again
+                    if instance_ids != probed_ids:
+                        probed_ids = unready_ids = instance_ids
+                    unready_ids = self._get_unready_instance_ids(unready_ids)
+
+                if not unready_ids:
+                    instance_ids = sorted(instance_ids)
+                    self._record('ready', instance_ids=instance_ids)
+                    self._events.emit(INSTANCES_READY,
+                                      instance_ids=instance_ids)
+                    break
+                else:
+                    self._events.emit(
+                        WAIT_ATTEMPT, phase='ready', attempt=current_attempts,
+                        max_attempts=self._max_wait_attempts)
+            else:
+                self._on_still_waiting_for_boot(current_attempts,
+                                                expected_num_instances,
+                                                instance_ids
+                                                )
+
+            instance_ids = self._aws_manager.get_in_service_instance_ids(asg)
+            self.wait()
+            current_attempts += 1
+
+            if current_attempts >= self._max_wait_attempts:
+                self._events.emit(WAIT_GIVEN_UP, phase='boot',
+                                  attempts=current_attempts)
+                raise UpgradeFailed('Instances did not finish booting after '
+                                    '%d attempts' % current_attempts)
+
+    def wait(self):
+        self._sleeper(self._sleep_time_s)
+
+    def wait_for_scaling_activities(self, asg):
+        """ Waits until the autoscaling group has no scaling activity in
+            progress.
+
+        AWS may terminate an instance at any time to rebalance the group
+        across Availability Zones. Waiting for such activities to settle
+        before terminating anything ourselves stops the two from combining
+        into more instances being out of service than intended.
+
+        Args:
+            asg: autoscaling group to check
+        Raises:
+            UpgradeFailed if activities are still in progress after
+            max_wait_attempts.
+        """
+        current_attempts = 0
+
+        while True:
+            activities = self._aws_manager.get_scaling_activities_in_progress(
+                asg)
+            if not len(activities):
+                return
+
+            logger.debug('Activities: %s', LazyPformat(activities))
+            self._events.emit(
+                WAIT_ATTEMPT, phase='scaling_activities',
+                attempt=current_attempts, max_attempts=self._max_wait_attempts,
+                num_activities=len(activities))
+
+            current_attempts += 1
+            if current_attempts >= self._max_wait_attempts:
+                self._events.emit(WAIT_GIVEN_UP, phase='scaling_activities',
+                                  attempts=current_attempts)
+                raise UpgradeFailed('Scaling activities did not finish after '
+                                    '%d attempts' % current_attempts)
+            self.wait()
+
+    @staticmethod
+    def _is_outdated_warm_instance(warm_instance, config):
+        # Instances without a launch configuration name, e.g. launched from a
+        # launch template, cannot be told apart and are assumed to be current
+        return warm_instance.get('LaunchConfigurationName') not in (
+            None, config['LaunchConfigurationName'])
+
+    def _get_warm_instances(self, asg):
+        return [warm_instance for warm_instance in
+                self._aws_manager.get_warm_pool_instances(asg)
+                if 'Terminat' not in warm_instance.get('LifecycleState', '')]
+
+    def prepare_warm_pool(self, asg, config):
+        """ Gets the warm pool of an autoscaling group ready to supply the
+            replacement instances.
+
+        A warm pool of warm_pool_size instances is created for a group that
+        has none, if asked to. Instances in the pool that were launched with
+        an older launch configuration are terminated, so that the group
+        refills the pool with instances that will not need replacing again.
+
+        Args:
+            asg: the autoscaling group
+            config: the launch configuration the replacements should have
+        Returns:
+            the warm pool configuration, or None if the group has no warm pool.
+        """
+        pool_config = asg.get('WarmPoolConfiguration')
+        created = False
+        if pool_config is None:
+            if not self._warm_pool_size:
+                return None
+            if self._do_dry_run:
+                self._events.emit(
+                    WARM_POOL_PREPARED, min_size=self._warm_pool_size,
+                    created=True, outdated_instance_ids=[], dry_run=True)
+                return None
+            self._aws_manager.put_warm_pool(asg, self._warm_pool_size)
+            pool_config = {'MinSize': self._warm_pool_size}
+            created = True
+
+        outdated_instance_ids = [
+            warm_instance['InstanceId']
+            for warm_instance in self._get_warm_instances(asg)
+            if self._is_outdated_warm_instance(warm_instance, config)]
+        if not self._do_dry_run:
+            for instance_id in outdated_instance_ids:
+                self._aws_manager.terminate_instance(instance_id)
+        self._events.emit(
+            WARM_POOL_PREPARED, min_size=pool_config.get('MinSize', 0),
+            created=created, outdated_instance_ids=outdated_instance_ids,
+            dry_run=self._do_dry_run)
+        return pool_config
+
+    @staticmethod
+    def _get_warm_pool_target_size(asg, pool_config):
+        max_prepared = pool_config.get('MaxGroupPreparedCapacity')
+        if max_prepared is None or max_prepared < 0:
+            max_prepared = asg.get('MaxSize', 0)
+        return max(pool_config.get('MinSize', 0),
+                   max_prepared - asg.get('DesiredCapacity', 0))
+
+    def wait_for_warm_pool(self, asg, config, pool_config, num_instances):
+        """ Waits until the warm pool holds enough warmed up instances of the
+            current launch configuration to replace the instances about to
+            be terminated.
+
+        The group refills its warm pool after every instance taken from it,
+        so this waits for the refill ahead of the next termination. Never
+        more instances are waited for than the pool is sized to hold. After
+        max_wait_attempts the wait is given up and replacements may be
+        launched from scratch instead.
+
+        Args:
+            asg: the autoscaling group
+            config: the launch configuration the replacements should have
+            pool_config: the warm pool configuration from prepare_warm_pool()
+            num_instances: the number of instances about to be terminated
+        Returns:
+            True if enough instances are warmed up, False if given up.
+        """
+        num_needed = min(num_instances,
+                         self._get_warm_pool_target_size(asg, pool_config))
+        current_attempts = 0
+
+        while True:
+            warm_instances = [
+                warm_instance
+                for warm_instance in self._get_warm_instances(asg)
+                if not self._is_outdated_warm_instance(warm_instance, config)]
+            num_warmed = len(filter(is_warmed, warm_instances))
+            if num_warmed >= num_needed:
+                return True
+
+            logger.debug('Warm pool: %s', LazyPformat(warm_instances))
+            self._events.emit(
+                WAIT_ATTEMPT, phase='warm_pool', attempt=current_attempts,
+                max_attempts=self._max_wait_attempts, num_warmed=num_warmed,
+                num_needed=num_needed)
+
+            current_attempts += 1
+            if current_attempts >= self._max_wait_attempts:
+                self._events.emit(WAIT_GIVEN_UP, phase='warm_pool',
+                                  attempts=current_attempts,
+                                  num_warmed=num_warmed, num_needed=num_needed)
+                return False
+            self.wait()
+
+    @staticmethod
+    def _get_target_group_arns(asg):
+        # Without target groups nothing tells when connections have drained,
+        # so instances would be terminated while still serving them
+        target_group_arns = asg.get('TargetGroupARNs')
+        if not target_group_arns:
+            raise UpgradeFailed(
+                '%s has no target groups to drain instances from, so '
+                'overlap_draining cannot be used' % asg['AutoScalingGroupName'])
+        return target_group_arns
+
+    def wait_for_draining(self, asg, detached_instance_ids):
+        """ Waits until detached instances have finished draining from the
+            autoscaling group's target groups, and every instance in service
+            in the group is healthy in them.
+
+        Each target group is checked with a single call per attempt, however
+        many instances there are.
+
+        Args:
+            asg: autoscaling group the instances were detached from
+            detached_instance_ids: IDs of the instances being drained
+        Raises:
+            UpgradeFailed if the group has no target groups, or the instances
+            have not drained after max_wait_attempts.
+        """
+        target_group_arns = self._get_target_group_arns(asg)
+        in_service_ids = self._aws_manager.get_in_service_instance_ids(asg)
+        current_attempts = 0
+
+        while True:
+            draining_ids = set()
+            unhealthy_ids = set()
+            for target_group_arn in target_group_arns:
+                states = self._aws_manager.get_target_states(
+                    target_group_arn,
+                    list(detached_instance_ids) + in_service_ids)
+                draining_ids.update(
+                    instance_id for instance_id in detached_instance_ids
+                    if states.get(instance_id, 'unused') != 'unused')
+                unhealthy_ids.update(
+                    instance_id for instance_id in in_service_ids
+                    if states.get(instance_id) != 'healthy')
+            if not draining_ids and not unhealthy_ids:
+                return
+
+            self._events.emit(
+                WAIT_ATTEMPT, phase='draining', attempt=current_attempts,
+                max_attempts=self._max_wait_attempts,
+                draining_instance_ids=sorted(draining_ids),
+                unhealthy_instance_ids=sorted(unhealthy_ids))
+
+            current_attempts += 1
+            if current_attempts >= self._max_wait_attempts:
+                self._events.emit(WAIT_GIVEN_UP, phase='draining',
+                                  attempts=current_attempts)
+                raise UpgradeFailed('Instances did not finish draining after '
+                                    '%d attempts' % current_attempts)
+            self.wait()
+
+    def replace_instances(self, asg, instance_ids, expected_num_instances):
+        """ Gets instances replaced by the autoscaling group.
+
+        Normally the instances are terminated straight away. With
+        overlap_draining they are detached from the group instead, so that
+        their connections drain from the group's target groups while the
+        group launches and boots their replacements. They are terminated
+        once drained and once the replacements are ready and healthy in the
+        target groups.
+
+        Args:
+            asg: autoscaling group to replace instances in
+            instance_ids: IDs of the instances to replace
+            expected_num_instances: how many instances the group should have
+        Raises:
+            UpgradeFailed if overlap_draining is enabled and the group has no
+            target groups. Nothing is detached then.
+        """
+        if not self._overlap_draining:
+            self._terminate_instances(instance_ids)
+            return
+
+        self._get_target_group_arns(asg)
+        for instance_id in instance_ids:
+            self._aws_manager.detach_instance(asg, instance_id)
+            self._record('detached', instance_id=instance_id)
+            self._events.emit(INSTANCE_DETACHED, instance_id=instance_id)
+        self._terminate_drained_instances(asg, instance_ids,
+                                          expected_num_instances)
+
+    def _terminate_drained_instances(self, asg, instance_ids,
+                                     expected_num_instances):
+        self.wait_for_instances(asg, expected_num_instances)
+        self.wait_for_draining(asg, instance_ids)
+        self._terminate_instances(instance_ids)
+
+    def _terminate_instances(self, instance_ids):
+        for instance_id in instance_ids:
+            self._aws_manager.terminate_instance(instance_id)
+            instance = self._unready_instances.pop(instance_id, None)
+            if instance is not None:
+                # Its session would otherwise stay open until it idled out
+                self._get_instance_manager().close_session(
+                    instance.private_ip_address)
+            self._record('terminated', instance_id=instance_id)
+            self._events.emit(INSTANCE_TERMINATED, instance_id=instance_id)
+
+    def get_instances_to_terminate(self, instances_to_upgrade):
+        """ Chooses the instances to terminate in this cycle.
+
+        Instances are taken from the replacement scheduler in priority order,
+        skipping any in an Availability Zone that already has an instance
+        chosen, until max_parallel_azs instances are chosen. At most one
+        instance per AZ is therefore out of service at a time.
+
+        Args:
+            instances_to_upgrade: List of EC2 instances that need upgrading.
+        Returns:
+            a list of instances, in priority order.
+        """
+        self._scheduler.update(instances_to_upgrade)
+        return self._pop_instances_to_terminate(lambda instance: True)
+
+    def _pop_instances_to_terminate(self, is_stale):
+        """ Takes instances from the replacement scheduler in priority order,
+        until max_parallel_azs stale instances in different Availability
+        Zones are chosen.
+
+        Args:
+            is_stale: function telling whether an instance needs replacing.
+                      Instances that do not are dropped from the scheduler.
+        Returns:
+            a list of instances, in priority order.
+        """
+        chosen = []
+        skipped = []
+        chosen_azs = set()
+        while len(chosen) < max(1, self._max_parallel_azs):
+            instance = self._scheduler.pop()
+            if instance is None:
+                break
+            if not is_stale(instance):
+                continue
+            az = get_availability_zone(instance)
+            if az in chosen_azs:
+                skipped.append(instance)
+            else:
+                chosen_azs.add(az)
+                chosen.append(instance)
+
+        for instance in skipped:
+            self._scheduler.add(instance)
+        return chosen
+
+    def are_all_instances_ready(self, instances):
+        """ Returns whether the instances have booted and are ready.
+
+        See InstanceManager.is_ready() for further details. With a readiness
+        checker, every instance not known to be ready yet is checked in one
+        go.
+
+        Args:
+            instances: list of EC2 instances to check
+        Returns:
+            True if all instances have booted, False if at least one hasn't.
+        """
+        if self._readiness_checker is not None:
+            return self._are_all_ready_at_once(
+                [instance.id for instance in instances])
+
+        # Each attempt of a wait that fails costs no more than finding an
+        # unready instance
+        for instance in instances:
+            if instance.id not in self._ready_instance_ids:
+                if not self._get_instance_manager().is_ready(
+                        instance.private_ip_address):
+                    self._unready_instances[instance.id] = instance
+                    return False
+                self._ready_instance_ids.add(instance.id)
+                self._unready_instances.pop(instance.id, None)
+        return True
+
+    def _get_unready_instance_ids(self, instance_ids):
+        """ Probes the instances with the given IDs that are not known to be
+        ready yet, only looking up those that have not been probed before.
+
+        Returns:
+            the IDs of the instances still not known to be ready, in order.
+        """
+        unready_ids = [instance_id for instance_id in instance_ids
+                       if instance_id not in self._ready_instance_ids]
+        if not unready_ids:
+            return unready_ids
+
+        if self._readiness_checker is not None:
+            self._are_all_ready_at_once(unready_ids)
+        else:
+            # An instance's address never changes, so it is only looked up
+            # once. Instances that are no longer running cannot be probed.
+            unknown_ids = [instance_id for instance_id in unready_ids
+                           if instance_id not in self._unready_instances]
+            if unknown_ids:
+                for instance in self._aws_manager.get_instances(unknown_ids):
+                    self._unready_instances[instance.id] = instance
+            self.are_all_instances_ready(
+                [self._unready_instances[instance_id]
+                 for instance_id in unready_ids
+                 if instance_id in self._unready_instances])
+        return [instance_id for instance_id in unready_ids
+                if instance_id not in self._ready_instance_ids]
+
+    def _are_all_ready_at_once(self, instance_ids):
+        unknown_instance_ids = [instance_id for instance_id in instance_ids
+                                if instance_id not in self._ready_instance_ids]
+        if unknown_instance_ids:
+            readiness = self._readiness_checker.are_ready(unknown_instance_ids)
+            self._ready_instance_ids.update(
+                instance_id for instance_id in unknown_instance_ids
+                if readiness.get(instance_id))
+        return all(instance_id in self._ready_instance_ids
+                   for instance_id in instance_ids)
+
+    def compare_instance_to_config(self, instance, config):
+        """ Compares a single instance to the launch configuration.
+
+        Mostly gets the configuration from AWS and passes it to the
+        InstanceConfigComparator, via a DeduplicatingConfigComparator so that
+        instances configured identically are only compared once.
+
+        If the launch configuration the instance was launched with has been
+        fetched by _prefetch_previous_configs() and has the same userdata or
+        block device mappings as the current one, the instance's userdata or
+        volumes are not fetched from AWS: they match already.
+        Returns:
+            a list of differences between the instance and the configuration.
+        """
+        unchanged_fields = self._get_unchanged_lookup_fields(instance, config)
+
+        if 'UserData' in unchanged_fields:
+            instance_userdata = config['UserData']
+        else:
+            instance_userdata = self._aws_manager.get_userdata_for_instance(
+                instance.id)
+
+        if 'BlockDeviceMappings' in unchanged_fields:
+            instance_volume_dict = None
+        else:
+            instance_volume_dict = \
+                self._aws_manager.get_volumes_dict_for_instance(instance)
+
+        config_volumes_dict = self._aws_manager.config_volumes_to_dict(
+            config['BlockDeviceMappings'])
+
+        return self._deduplicating_comparator.compare(
+            instance, config, instance_userdata, instance_volume_dict,
+            config_volumes_dict)
+
+    def _get_unchanged_lookup_fields(self, instance, config):
+        previous_config_name = getattr(
+            instance, 'launch_configuration_name', None)
+        if previous_config_name is None:
+            return frozenset()
+        if previous_config_name == config.get('LaunchConfigurationName'):
+            return LOOKUP_FIELDS
+
+        previous_config = self._previous_configs.get(previous_config_name)
+        if previous_config is None:
+            return frozenset()
+        return LOOKUP_FIELDS - frozenset(get_changed_launch_config_fields(
+            previous_config, config))
+
+    def _prefetch_previous_configs(self, instances, config):
+        """ Fetches the launch configurations the given instances were
+        launched with, in as few calls as possible, and reports how they
+        differ from the current one.
+        """
+        config_names = sorted(set(
+            getattr(instance, 'launch_configuration_name', None)
+            for instance in instances) - set(self._previous_configs) -
+            set([None, config.get('LaunchConfigurationName')]))
+
+        for start in range(0, len(config_names), LAUNCH_CONFIGS_BATCH_SIZE):
+            batch = config_names[start:start + LAUNCH_CONFIGS_BATCH_SIZE]
+            previous_configs = self._aws_manager.get_launch_configs(batch)
+            for config_name in batch:
+                previous_config = previous_configs.get(config_name)
+                self._previous_configs[config_name] = previous_config
+                if previous_config is not None and \
+                        logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(
+                        'Launch configuration %s differs from %s in: %s',
+                        config_name, config.get('LaunchConfigurationName'),
+                        ', '.join(get_changed_launch_config_fields(
+                            previous_config, config)))
+
+    @contextmanager
+    def _comparing_concurrently(self):
+        """ Compares instances on a bounded thread pool for the duration of
+        the block, if more than one diff worker is configured.
+        """
+        if self._diff_workers <= 1 or self._diff_executor is not None:
+            yield
+            return
+
+        self._diff_executor = ThreadPoolExecutor(max_workers=self._diff_workers)
+        try:
+            yield
+        finally:
+            executor, self._diff_executor = self._diff_executor, None
+            for future in self._pending_diffs.values():
+                if future is not None:
+                    future.cancel()
+            self._pending_diffs = {}
+            executor.shutdown(wait=True)
+
+    def _start_comparisons(self, asg_instances, config):
+        """ Starts comparing the instances that have not been compared to the
+        launch configuration yet, on the diff workers if there are any.
+        Otherwise they are compared when their differences are needed.
+        """
+        if config is not self._known_diffs_config:
+            self._known_diffs = {}
+            self._known_diffs_config = config
+            self._config_fingerprint = get_config_fingerprint(config)
+            self._pending_diffs = {}
+
+        new_instances = [instance for instance in asg_instances
+                         if instance.id not in self._known_diffs and
+                         instance.id not in self._pending_diffs]
+
+        if self._diff_cache is not None:
+            uncached_instances = []
+            for instance in new_instances:
+                diffs = self._diff_cache.get(instance,
+                                             self._config_fingerprint)
+                if diffs is None:
+                    uncached_instances.append(instance)
+                else:
+                    self._known_diffs[instance.id] = diffs
+                    self._report_diffs(instance, diffs)
+            new_instances = uncached_instances
+
+        self._prefetch_previous_configs(new_instances, config)
+        for instance in new_instances:
+            if self._diff_executor is None:
+                self._pending_diffs[instance.id] = None
+            else:
+                self._pending_diffs[instance.id] = self._diff_executor.submit(
+                    self.compare_instance_to_config, instance, config)
+
+    def _get_diffs(self, instance, config):
+        """ Gets an instance's differences from the launch configuration,
+        waiting for its comparison to finish if needed.
+        """
+        # An instance's configuration never changes, so neither do its
+        # differences from the launch configuration of this upgrade
+        if instance.id in self._known_diffs:
+            return self._known_diffs[instance.id]
+
+        future = self._pending_diffs.pop(instance.id, None)
+        # A comparison that has not started yet is done straight away, rather
+        # than after all those queued ahead of it
+        if future is None or future.cancel():
+            diffs = self.compare_instance_to_config(instance, config)
+        else:
+            diffs = future.result()
+
+        self._known_diffs[instance.id] = diffs
+        self._record('compared', instance_id=instance.id, diffs=diffs)
+        if self._diff_cache is not None:
+            self._diff_cache.put(instance, self._config_fingerprint, diffs)
+        self._report_diffs(instance, diffs)
+        return diffs
+
+    def _report_diffs(self, instance, diffs):
+        # Only done once differences are first known, as instances skipped
+        # for their AZ are taken from the scheduler again on later cycles
+        if len(diffs):
+            logger.debug('=== Found differences between instance %s and '
+                         'config:\n%s', instance.id, diffs)
+            self._events.emit(INSTANCE_STALE, instance_id=instance.id,
+                              differences=diffs)
+
+    def _is_stale(self, instance, config):
+        return bool(self._get_diffs(instance, config))
+
+    def iter_stale_instances(self, asg_instances, config):
+        """ Finds the instances that differ from the launch configuration,
+        yielding each as soon as it has been compared.
+
+        Every instance starts being compared straight away, so instances
+        later in the order carry on being compared while the caller acts on
+        those found first.
+
+        Args:
+            asg_instances: the instances to check, in the order to yield them
+            config: the launch configuration to check
+        Returns:
+            a generator of (instance, differences) tuples.
+        """
+        self._start_comparisons(asg_instances, config)
+        for instance in asg_instances:
+            if self._is_stale(instance, config):
+                yield instance, self._known_diffs[instance.id]
+
+    def get_instances_to_upgrade(self, asg, config):
+        """ Gets a list of the instances that need upgrading.
+
+        Gets all the instances for the given ASG and checks them against the
+        configuration. Instances are compared concurrently, but the result
+        keeps the order in which the instances were found. Instances already
+        compared before an interrupted upgrade was resumed are not compared
+        again, as an instance's configuration never changes.
+
+        Args:
+            asg: the autoscaling group to get instances from
+            config: the launch configuration to check
+        Returns:
+            a list of instances that differ from the launch configuration.
+        """
+        asg_instances = self._get_remaining_instances(asg)
+        return [instance for instance, diffs in
+                self._get_stale_instances(asg_instances, config)]
+
+    def _get_stale_instances(self, asg_instances, config):
+        with self._comparing_concurrently():
+            stale_instances = list(self.iter_stale_instances(asg_instances,
+                                                             config))
+        if self._diff_cache is not None:
+            self._diff_cache.save()
+        return stale_instances
+
+    def _schedule_replacement_candidates(self, asg, config):
+        """ Schedules the instances that may need replacing, leaving out
+        those known to match the launch configuration, and starts comparing
+        those not compared yet.
+
+        Only instances that joined or left the group since the last cycle are
+        looked at, so a cycle costs little however large the group is.
+        """
+        instance_ids = self._aws_manager.get_remaining_instance_ids(asg)
+        left_ids = set(self._remaining_instances).difference(instance_ids)
+        joined_candidates = [
+            instance for instance in
+            self._update_remaining_instances(asg, instance_ids)
+            if self._known_diffs.get(instance.id) != []]
+        self._scheduler.change(joined_candidates, left_ids)
+        self._start_comparisons(joined_candidates, config)
+
+    def _take_instances_to_terminate(self, config):
+        """ Takes stale instances from the replacement scheduler, comparing
+        each as it comes up, until max_parallel_azs instances in different
+        Availability Zones are chosen. Instances further down carry on being
+        compared in the background.
+        """
+        return self._pop_instances_to_terminate(
+            lambda instance: self._is_stale(instance, config))
+
+    def get_replacement_batches(self, instances_to_upgrade):
+        """ Splits the instances that need upgrading into the batches they
+        will be terminated in, in order.
+
+        Args:
+            instances_to_upgrade: List of EC2 instances that need upgrading.
+        Returns:
+            a list of lists of instances.
+        """
+        batches = []
+        remaining = list(instances_to_upgrade)
+        while remaining:
+            batch = self.get_instances_to_terminate(remaining)
+            batches.append(batch)
+            batch_ids = set(instance.id for instance in batch)
+            remaining = [instance for instance in remaining
+                         if instance.id not in batch_ids]
+        return batches
+
+    def make_upgrade_plan(self, asg_slug):
+        """ Works out everything a rolling upgrade would do, without doing it.
+
+        All instances are discovered and compared to the launch configuration
+        in a single pass. No instances are waited for or terminated.
+
+        Args:
+            asg_slug: Name of autoscaling group to upgrade, e.g. "RabbitMq"
+        Returns:
+            a JSON-serialisable dict, to be given to execute_upgrade_plan().
+        """
+        asg = self.get_single_asg(asg_slug)
+        config = self._aws_manager.get_launch_config_for_asg(asg)
+
+        asg_instances = self._get_remaining_instances(asg)
+        stale_instances = self._get_stale_instances(asg_instances, config)
+        batches = self.get_replacement_batches(
+            [instance for instance, diffs in stale_instances])
+
+        return {
+            'asg_name': asg['AutoScalingGroupName'],
+            'launch_configuration_name': config['LaunchConfigurationName'],
+            'config_fingerprint': get_config_fingerprint(config),
+            'expected_num_instances':
+                self._aws_manager.get_expected_num_of_instances(asg),
+            'instance_ids': sorted(instance.id for instance in asg_instances),
+            'instances_to_upgrade': [{
+                'id': instance.id,
+                'launch_time': str(instance.launch_time),
+                'availability_zone':
+                    get_availability_zone(instance),
+                'differences': diffs
+            } for instance, diffs in stale_instances],
+            'batches': [[instance.id for instance in batch]
+                        for batch in batches]
+        }
+
+    def execute_upgrade_plan(self, plan):
+        """ Terminates instances as laid out in a plan from
+            make_upgrade_plan(), waiting for replacements between batches.
+
+        Instances are not compared to the launch configuration again. Instead
+        the plan is refused if the launch configuration or the instances in
+        the group have changed since the plan was made.
+
+        Args:
+            plan: dict as given by make_upgrade_plan()
+        Raises:
+            Exception if the autoscaling group has drifted from the plan.
+        """
+        asg = self.get_single_asg(re.escape(plan['asg_name']) + '$')
+        config = self._aws_manager.get_launch_config_for_asg(asg)
+        asg_instances = self._get_remaining_instances(asg)
+
+        if get_config_fingerprint(config) != plan['config_fingerprint']:
+            raise Exception('Launch configuration of %s has changed since the '
+                            'plan was made' % plan['asg_name'])
+        instance_ids = sorted(instance.id for instance in asg_instances)
+        if instance_ids != plan['instance_ids']:
+            raise Exception('Instances in %s have changed since the plan was '
+                            'made' % plan['asg_name'])
+
+        expected_num_instances = plan['expected_num_instances']
+        self._events.emit(
+            UPGRADE_STARTED, asg_name=plan['asg_name'],
+            launch_configuration_name=config.get('LaunchConfigurationName'),
+            expected_num_instances=expected_num_instances)
+        pool_config = self.prepare_warm_pool(asg, config)
+        try:
+            self.wait_for_instances(asg, expected_num_instances)
+
+            for batch in plan['batches']:
+                if pool_config is not None:
+                    self.wait_for_warm_pool(asg, config, pool_config,
+                                            len(batch))
+                self.wait_for_scaling_activities(asg)
+                self.replace_instances(asg, batch, expected_num_instances)
+                self.wait_for_instances(asg, expected_num_instances)
+        finally:
+            self._end_instance_probes()
+
+        self._events.emit(
+            UPGRADE_FINISHED, asg_name=plan['asg_name'], dry_run=False,
+            instances_replaced=sum(len(batch) for batch in plan['batches']),
+            batches=[])
+
+    def perform_rolling_upgrade_where_needed(self, asg_slug):
+        """ Upgrades instances in an autoscaling group if they are different
+            from the launch configuration.
+
+        SSH sessions kept open to probe instances are closed once the upgrade
+        ends, whether or not it succeeded, unless close_sessions_after_upgrade
+        was disabled.
+
+        Args:
+            asg_slug: Name of autoscaling group to upgrade, e.g. "RabbitMq"
+        """
+        try:
+            self._perform_rolling_upgrade(asg_slug)
+        finally:
+            self._end_instance_probes()
+
+    def _perform_rolling_upgrade(self, asg_slug):
+        asg = self.get_single_asg(asg_slug)
+        logger.debug('AutoScalingGroup: %s\n', LazyPformat(asg))
+
+        config = self._aws_manager.get_launch_config_for_asg(asg)
+        expected_num_instances = self._aws_manager.get_expected_num_of_instances(
+            asg)
+        self._events.emit(
+            UPGRADE_STARTED, asg_name=asg['AutoScalingGroupName'],
+            launch_configuration_name=config.get('LaunchConfigurationName'),
+            expected_num_instances=expected_num_instances)
+        self._resume(asg, config)
+        pool_config = self.prepare_warm_pool(asg, config)
+
+        instances_replaced = 0
+        dry_run_batches = []
+        if self._resumed_detached_ids and not self._do_dry_run:
+            self._terminate_drained_instances(
+                asg, self._resumed_detached_ids, expected_num_instances)
+            instances_replaced += len(self._resumed_detached_ids)
+
+        with self._comparing_concurrently():
+            while True:
+                self.wait_for_instances(asg, expected_num_instances)
+
+                if self._do_dry_run:
+                    instances = [instance for instance, diffs in
+                                 self.iter_stale_instances(
+                                     self._get_remaining_instances(asg),
+                                     config)]
+                else:
+                    # Stale instances are acted on as soon as they are found,
+                    # and the rest carry on being compared in the background
+                    self._schedule_replacement_candidates(asg, config)
+                    instances = self._take_instances_to_terminate(config)
+                if self._diff_cache is not None:
+                    self._diff_cache.save()
+
+                if not len(instances):
+                    if self._journal is not None:
+                        self._journal.clear()
+                    break
+
+                if self._do_dry_run:
+                    dry_run_batches = [
+                        [instance.id for instance in batch]
+                        for batch in self.get_replacement_batches(instances)]
+                    break
+
+                if pool_config is not None:
+                    self.wait_for_warm_pool(asg, config, pool_config,
+                                            len(instances))
+                self.wait_for_scaling_activities(asg)
+                self.replace_instances(
+                    asg, [instance.id for instance in instances],
+                    expected_num_instances)
+                instances_replaced += len(instances)
+
+        self._events.emit(UPGRADE_FINISHED,
+                          asg_name=asg['AutoScalingGroupName'],
+                          dry_run=self._do_dry_run,
+                          instances_replaced=instances_replaced,
+                          batches=dry_run_batches)
@@ -0,0 +1,159 @@
+import heapq
+
+
+DEFAULT_PRIORITY_TAG = 'RollingUpgradePriority'
+
+REPLACEMENT_ORDERS = ('oldest', 'tag', 'az_balance')
+
+# Orders whose priorities depend on the candidates as a whole
+WHOLE_GROUP_ORDERS = frozenset(['az_balance'])
+
+
+def get_availability_zone(instance):
+    """ Gets the Availability Zone an EC2 instance is placed in, or None if it
+    is not known.
+    """
+    placement = getattr(instance, 'placement', None) or {}
+    return placement.get('AvailabilityZone')
+
+
+def oldest_first(instance):
+    """ Replacement priority key: the instance launched first goes first. """
+    return (instance.launch_time,)
+
+
+def tag_priority(tag_name=DEFAULT_PRIORITY_TAG):
+    """ Replacement priority key: instances with a lower integer value in the
+    given tag go first, e.g. tag a cluster leader with 1 to replace it last.
+    Untagged instances have priority 0. Ties are broken by age.
+    """
+    def key(instance):
+        tags = {tag['Key']: tag['Value']
+                for tag in getattr(instance, 'tags', None) or []}
+        try:
+            priority = int(tags.get(tag_name, 0))
+        except ValueError:
+            priority = 0
+        return (priority, instance.launch_time)
+    return key
+
+
+def az_balance():
+    """ Replacement priority key: instances in the Availability Zone with the
+    most instances left to replace go first, so the remaining work stays
+    spread across AZs. Ties are broken by age.
+
+    The key's refresh(instances) counts the candidates, so it needs a
+    ReplacementScheduler that rebuilds on every update.
+    """
+    remaining_per_az = {}
+
+    def refresh(instances):
+        remaining_per_az.clear()
+        for instance in instances:
+            az = get_availability_zone(instance)
+            remaining_per_az[az] = remaining_per_az.get(az, 0) + 1
+
+    def key(instance):
+        az = get_availability_zone(instance)
+        return (-remaining_per_az.get(az, 0), instance.launch_time)
+    key.refresh = refresh
+    return key
+
+
+class ReplacementScheduler(object):
+    """ Keeps the instances waiting to be replaced in a heap, ordered by a
+    pluggable priority key.
+
+    The heap is updated incrementally as instances appear and disappear, so
+    choosing the next instance does not mean sorting every candidate again.
+    Keys that depend on the candidates as a whole, e.g. az_balance(), are
+    only supported by rebuilding the heap on every update.
+    """
+
+    _REMOVED = object()
+
+    def __init__(self, priority_key=oldest_first, rebuild_on_update=False):
+        """
+        Args:
+            priority_key: function of an instance returning a sortable value;
+                          the lowest value is replaced first.
+            rebuild_on_update: whether to call the key's refresh(instances)
+                               and recompute every priority on every update,
+                               for keys such as az_balance().
+        """
+        self._priority_key = priority_key
+        self._rebuild_on_update = rebuild_on_update
+        self._heap = []
+        self._entries = {}
+        self._first_seen = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, instance):
+        """ Adds an instance, or refreshes it if it is already scheduled. """
+        if instance.id in self._entries:
+            self.remove(instance.id)
+        sequence = self._first_seen.setdefault(
+            instance.id, len(self._first_seen))
+        entry = [self._priority_key(instance), sequence, instance]
+        self._entries[instance.id] = entry
+        heapq.heappush(self._heap, entry)
+
+    def remove(self, instance_id):
+        """ Removes an instance, if it is scheduled. """
+        entry = self._entries.pop(instance_id, None)
+        if entry is not None:
+            entry[-1] = ReplacementScheduler._REMOVED
+
+    def pop(self):
+        """ Removes and returns the instance to replace next, or None if no
+        instances are scheduled.
+        """
+        while self._heap:
+            instance = heapq.heappop(self._heap)[-1]
+            if instance is not ReplacementScheduler._REMOVED:
+                del self._entries[instance.id]
+                return instance
+        return None
+
+    def update(self, instances):
+        """ Makes the scheduled instances match the given instances.
+
+        Args:
+            instances: all EC2 instances that currently need replacing.
+        """
+        current_ids = set(instance.id for instance in instances)
+        self.change(
+            [instance for instance in instances
+             if instance.id not in self._entries],
+            set(self._entries).difference(current_ids))
+
+    def change(self, added_instances, removed_ids):
+        """ Adds and removes instances, without looking at the others, for
+        callers that know which instances appeared and disappeared.
+
+        Args:
+            added_instances: EC2 instances that now need replacing, in the
+                             order that breaks ties between priorities.
+            removed_ids: IDs of instances that no longer do.
+        """
+        for instance_id in removed_ids:
+            self.remove(instance_id)
+        for instance in added_instances:
+            self.add(instance)
+
+        if self._rebuild_on_update:
+            self._priority_key.refresh(
+                [entry[-1] for entry in self._entries.values()])
+            self._rebuild()
+
+    def _rebuild(self):
+        instances = [entry[-1] for entry in self._entries.values()]
+        self._heap = []
+        self._entries = {}
+        for instance in sorted(
+                instances,
+                key=lambda instance: self._first_seen[instance.id]):
+            self.add(instance)
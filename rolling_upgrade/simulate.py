@@ -0,0 +1,410 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+import heapq
+import random
+
+from .cache import DiffCache
+from .common import InstanceSnapshot
+from .manager import RollingUpgradeManager, UpgradeFailed
+
+
+SimulationReport = namedtuple('SimulationReport', [
+    'completed',
+    'duration_s',
+    'instances_replaced',
+    'min_ready_instances',
+    'reduced_capacity_s',
+    'api_calls',
+    'readiness_probes'
+])
+
+SIMULATED_ASG_NAME = 'simulated-asg'
+
+# Instances ids and launch times are made up relative to this
+_EPOCH = datetime(2016, 1, 1)
+
+_OLD_CONFIG = {
+    'LaunchConfigurationName': 'lc-old',
+    'ImageId': 'ami-old',
+    'InstanceType': 't2.micro',
+    'KernelId': '',
+    'KeyName': 'key',
+    'SecurityGroups': ['sg-1'],
+    'UserData': '',
+    'BlockDeviceMappings': []
+}
+
+_NEW_CONFIG = dict(_OLD_CONFIG, LaunchConfigurationName='lc-new',
+                   ImageId='ami-new')
+
+
+class VirtualClock(object):
+    """ A clock that only moves when slept on, so that waiting takes no real
+    time.
+    """
+
+    def __init__(self, now=0.0):
+        self._now = now
+
+    def time(self):
+        return self._now
+
+    def sleep(self, seconds):
+        self._now += seconds
+
+
+def get_boot_time_sampler(mean_s=300, stddev_s=60, history=None, seed=None):
+    """ Gets a function that picks how long each simulated instance takes from
+    launch until it has finished booting.
+
+    Args:
+        mean_s: the mean boot time, in seconds.
+        stddev_s: the standard deviation of the boot time, in seconds.
+        history: a list of observed boot times in seconds to pick from instead,
+                 or None.
+        seed: seeds the random choices, so that simulations can be repeated.
+    """
+    rand = random.Random(seed)
+    if history:
+        return lambda: rand.choice(history)
+    return lambda: max(1.0, rand.gauss(mean_s, stddev_s))
+
+
+class _SimulatedInstance(object):
+    __slots__ = ('id', 'az', 'config', 'launched_at', 'in_service_at',
+                 'ready_at', 'terminated_at', 'snapshot')
+
+    def __init__(self, instance_id, az, config, launched_at, in_service_at,
+                 ready_at):
+        self.id = instance_id
+        self.az = az
+        self.config = config
+        self.launched_at = launched_at
+        self.in_service_at = in_service_at
+        self.ready_at = ready_at
+        self.terminated_at = None
+        self.snapshot = None
+
+    def get_lifecycle_state(self, now):
+        if self.terminated_at is not None:
+            return 'Terminating'
+        if now < self.in_service_at:
+            return 'Pending'
+        return 'InService'
+
+    def get_snapshot(self, now):
+        # Snapshots only change with the lifecycle state, so are reused
+        lifecycle_state = self.get_lifecycle_state(now)
+        if self.snapshot is None or \
+                self.snapshot.lifecycle_state != lifecycle_state:
+            self.snapshot = InstanceSnapshot(
+                id=self.id,
+                launch_time=_EPOCH + timedelta(seconds=self.launched_at),
+                placement={'AvailabilityZone': self.az},
+                private_ip_address=self.id,
+                image_id=self.config['ImageId'],
+                instance_type=self.config['InstanceType'],
+                kernel_id=self.config['KernelId'],
+                key_name=self.config['KeyName'],
+                iam_instance_profile=None,
+                security_groups=[{'GroupId': group_id} for group_id in
+                                 self.config['SecurityGroups']],
+                block_device_mappings=[],
+                tags={},
+                lifecycle_state=lifecycle_state,
+                launch_configuration_name=self.config[
+                    'LaunchConfigurationName'])
+        return self.snapshot
+
+
+class SimulatedGroup(object):
+    """ A simulated autoscaling group whose launch configuration has changed,
+    standing in for both the AwsManager and the InstanceSshManager.
+
+    Terminated instances are replaced in the same Availability Zone after
+    replacement_delay_s, as the autoscaling group would once its health check
+    notices. Replacements are pending for pending_s, then in service, and
+    finish booting after a time picked by boot_time_sampler. Every AWS call
+    the real AwsManager would make is counted, by AWS operation.
+    """
+
+    def __init__(
+        self,
+        clock,
+        size,
+        boot_time_sampler,
+        azs=('eu-west-1a', 'eu-west-1b', 'eu-west-1c'),
+        replacement_delay_s=30,
+        pending_s=60,
+        terminating_s=60,
+        describe_instances_batch_size=100
+    ):
+        self._clock = clock
+        self._size = size
+        self._boot_time_sampler = boot_time_sampler
+        self._replacement_delay_s = replacement_delay_s
+        self._pending_s = pending_s
+        self._terminating_s = terminating_s
+        self._describe_instances_batch_size = describe_instances_batch_size
+        self._next_id = 0
+        self._instances = {}
+        # The group only changes at known times: when replacements launch,
+        # go into service, and terminated instances leave the group
+        self._changes_at = []
+        self._changes_expire_at = None
+        self._in_service_ids = []
+        self._remaining_ids = []
+        # Instances whose snapshot may be out of date, as they are new, still
+        # pending or were just terminated
+        self._changing_instances = []
+        self._terminated_instances = []
+        self._replacements = []
+        self.all_instances = []
+        self.api_calls = {}
+        self.readiness_probes = 0
+        self.instances_replaced = 0
+
+        # The original instances have long finished booting
+        for index in range(size):
+            launched_at = -86400.0 + index
+            self._add_instance(azs[index % len(azs)], _OLD_CONFIG,
+                               launched_at, launched_at, launched_at)
+
+    def _count(self, operation, calls=1):
+        self.api_calls[operation] = self.api_calls.get(operation, 0) + calls
+
+    def _add_instance(self, az, config, launched_at, in_service_at, ready_at):
+        instance = _SimulatedInstance(
+            'i-%08x' % self._next_id, az, config, launched_at,
+            in_service_at, ready_at)
+        self._next_id += 1
+        self._instances[instance.id] = instance
+        self._remaining_ids.append(instance.id)
+        self._changing_instances.append(instance)
+        self.all_instances.append(instance)
+        heapq.heappush(self._changes_at, in_service_at)
+
+    def _catch_up(self, now):
+        while self._replacements and self._replacements[0][0] <= now:
+            launched_at, az = self._replacements.pop(0)
+            boot_time_s = max(self._pending_s, self._boot_time_sampler())
+            self._add_instance(az, _NEW_CONFIG, launched_at,
+                               launched_at + self._pending_s,
+                               launched_at + boot_time_s)
+        while self._terminated_instances and \
+                self._terminated_instances[0].terminated_at + \
+                self._terminating_s <= now:
+            del self._instances[self._terminated_instances.pop(0).id]
+        changing_instances = []
+        for instance in self._changing_instances:
+            was_in_service = instance.snapshot is not None and \
+                instance.snapshot.lifecycle_state == 'InService'
+            lifecycle_state = instance.get_snapshot(now).lifecycle_state
+            if lifecycle_state == 'Pending':
+                changing_instances.append(instance)
+            elif lifecycle_state == 'InService' and not was_in_service:
+                self._in_service_ids.append(instance.id)
+        self._changing_instances = changing_instances
+
+    def connect(self, autoscaling_client=None, ec2_client=None):
+        pass
+
+    def find_asg_group(self, asg_regex_pat):
+        self._count('DescribeAutoScalingGroups')
+        return [{'AutoScalingGroupName': SIMULATED_ASG_NAME,
+                 'LaunchConfigurationName': 'lc-new',
+                 'DesiredCapacity': self._size}]
+
+    def get_expected_num_of_instances(self, asg):
+        return asg['DesiredCapacity']
+
+    def get_launch_config_for_asg(self, asg):
+        self._count('DescribeLaunchConfigurations')
+        return _NEW_CONFIG
+
+    def get_launch_configs(self, config_names):
+        self._count('DescribeLaunchConfigurations')
+        return dict((config['LaunchConfigurationName'], config)
+                    for config in (_OLD_CONFIG, _NEW_CONFIG)
+                    if config['LaunchConfigurationName'] in config_names)
+
+    def _refresh(self):
+        # Only instances that changed are looked at, and only when the group
+        # next changes
+        now = self._clock.time()
+        if self._changes_expire_at is not None and \
+                now < self._changes_expire_at:
+            return
+        self._catch_up(now)
+        while self._changes_at and self._changes_at[0] <= now:
+            heapq.heappop(self._changes_at)
+        self._changes_expire_at = self._changes_at[0] \
+            if self._changes_at else float('inf')
+
+    def _count_described_instances(self, num_instances):
+        self._count('DescribeInstances', -(-num_instances //
+                                           self._describe_instances_batch_size))
+
+    def get_instances_for_asg(self, asg, instance_ids=None):
+        self._refresh()
+        if instance_ids is None:
+            instance_ids = list(self._instances)
+        self._count('DescribeAutoScalingGroups')
+        return self.get_instances(instance_ids)
+
+    def get_in_service_instance_ids(self, asg):
+        self._refresh()
+        self._count('DescribeAutoScalingGroups')
+        return list(self._in_service_ids)
+
+    def get_remaining_instance_ids(self, asg):
+        self._refresh()
+        self._count('DescribeAutoScalingGroups')
+        return list(self._remaining_ids)
+
+    def get_instances(self, instance_ids):
+        self._refresh()
+        self._count_described_instances(len(instance_ids))
+        return [self._instances[instance_id].snapshot
+                for instance_id in instance_ids
+                if instance_id in self._instances]
+
+    def get_userdata_for_instance(self, instance_id):
+        self._count('DescribeInstanceAttribute')
+        return self._instances[instance_id].config['UserData']
+
+    def get_volumes_dict_for_instance(self, instance):
+        self._count('DescribeVolumes')
+        return {}
+
+    def config_volumes_to_dict(self, block_device_mapping_config):
+        return {}
+
+    def get_scaling_activities_in_progress(self, asg):
+        self._count('DescribeScalingActivities')
+        return []
+
+    def terminate_instance(self, instance_id):
+        self._count('TerminateInstances')
+        now = self._clock.time()
+        instance = self._instances[instance_id]
+        instance.terminated_at = now
+        if instance.id in self._in_service_ids:
+            self._in_service_ids.remove(instance.id)
+        self._remaining_ids.remove(instance.id)
+        self._changing_instances.append(instance)
+        self._terminated_instances.append(instance)
+        self._changes_expire_at = None
+        self.instances_replaced += 1
+        self._replacements.append((now + self._replacement_delay_s,
+                                   instance.az))
+        heapq.heappush(self._changes_at, now + self._replacement_delay_s)
+        heapq.heappush(self._changes_at, now + self._terminating_s)
+
+    def is_ready(self, instance_ip):
+        self.readiness_probes += 1
+        instance = self._instances.get(instance_ip)
+        return instance is not None and \
+            instance.ready_at <= self._clock.time()
+
+    def close_session(self, instance_ip):
+        pass
+
+    def close_connections(self):
+        pass
+
+    def get_ready_capacity(self, until):
+        """ Works out how many instances were in service and ready to serve
+        over the simulation.
+
+        Returns:
+            a tuple of the fewest ready instances at any time, and the time in
+            seconds spent with fewer ready instances than the group's size.
+        """
+        changes = []
+        for instance in self.all_instances:
+            stopped_at = instance.terminated_at
+            if stopped_at is None:
+                stopped_at = until
+            if instance.ready_at < stopped_at:
+                changes.append((max(0, instance.ready_at), 1))
+                changes.append((stopped_at, -1))
+        changes.sort()
+
+        ready = 0
+        min_ready = self._size
+        reduced_capacity_s = 0
+        for index, (changed_at, change) in enumerate(changes):
+            ready += change
+            # Only count the capacity once every change at a time is made
+            if index + 1 < len(changes) and \
+                    changes[index + 1][0] == changed_at:
+                continue
+            next_change_at = changes[index + 1][0] \
+                if index + 1 < len(changes) else until
+            if changed_at < until:
+                min_ready = min(min_ready, ready)
+                if ready < self._size:
+                    reduced_capacity_s += min(next_change_at, until) - \
+                        changed_at
+        return min_ready, reduced_capacity_s
+
+
+def simulate_upgrade(
+    group_size,
+    boot_time_sampler=None,
+    sleep_time_s=30,
+    max_wait_attempts=40,
+    **manager_kwargs
+):
+    """ Runs a rolling upgrade of a simulated autoscaling group on a virtual
+    clock, to predict how long a real one would take.
+
+    Every instance in the group needs replacing. The real
+    RollingUpgradeManager logic does the upgrade; only AWS, SSH and the
+    passing of time are simulated.
+
+    Args:
+        group_size: the number of instances in the group.
+        boot_time_sampler: see get_boot_time_sampler().
+        sleep_time_s: see RollingUpgradeManager.
+        max_wait_attempts: see RollingUpgradeManager.
+        manager_kwargs: the RollingUpgradeManager replacement policy, e.g.
+                        max_parallel_azs and replacement_order.
+    Returns:
+        a SimulationReport.
+    """
+    clock = VirtualClock()
+    group = SimulatedGroup(clock, group_size,
+                           boot_time_sampler or get_boot_time_sampler(seed=0))
+    rolling_upgrade_manager = RollingUpgradeManager(
+        ssh_config=None,
+        sleep_time_s=sleep_time_s,
+        max_wait_attempts=max_wait_attempts,
+        aws_manager=group,
+        instance_manager=group,
+        diff_workers=1,
+        diff_cache=DiffCache(None),
+        clock=clock.time,
+        sleeper=clock.sleep,
+        **manager_kwargs)
+
+    try:
+        rolling_upgrade_manager.perform_rolling_upgrade_where_needed(
+            SIMULATED_ASG_NAME)
+        completed = True
+    except UpgradeFailed:
+        # Gave up waiting for instances
+        completed = False
+
+    duration_s = clock.time()
+    min_ready_instances, reduced_capacity_s = group.get_ready_capacity(
+        duration_s)
+    return SimulationReport(
+        completed=completed,
+        duration_s=duration_s,
+        instances_replaced=group.instances_replaced,
+        min_ready_instances=min_ready_instances,
+        reduced_capacity_s=reduced_capacity_s,
+        api_calls=group.api_calls,
+        readiness_probes=group.readiness_probes)
@@ -0,0 +1,281 @@
+import logging
+import threading
+from time import time
+
+import paramiko
+from paramiko.client import WarningPolicy
+
+
+logger = logging.getLogger(__name__)
+
+BOOT_FINISHED_COMMAND = 'ls /var/lib/cloud/instance/boot-finished'
+
+# Newer key types are only tried if the installed paramiko supports them
+PRIVATE_KEY_CLASS_NAMES = ('RSAKey', 'ECDSAKey', 'Ed25519Key', 'DSSKey')
+
+
+def load_private_key(path):
+    """ Reads and parses a private key file, whatever the type of key.
+
+    Args:
+        path: the private key file.
+    Returns:
+        a paramiko.PKey
+    Raises:
+        paramiko.SSHException: if the file holds no key paramiko can read.
+    """
+    for class_name in PRIVATE_KEY_CLASS_NAMES:
+        key_class = getattr(paramiko, class_name, None)
+        if key_class is None:
+            continue
+        try:
+            return key_class.from_private_key_file(path)
+        except paramiko.SSHException:
+            continue
+    raise paramiko.SSHException('Unable to parse private key %s' % path)
+
+
+class InstanceSshManager(object):
+    """ A simple interface for SSHing into an instance.
+
+    We need to check whether an instance has successfully booted, via SSHing
+    into the instance.
+    """
+
+    @staticmethod
+    def get_instance(ssh_config, ssh_client=None):
+        """ Factory method to get right implementation of InstanceSshManager
+            depending on SSH config.
+
+            E.g. one subclass performs some extra steps to set up an SSH tunnel
+
+        Args:
+            ssh_config: SshEnvConfig tuple containing SSH parameters
+            ssh_client: Use to override the default Paramiko SSHClient
+        """
+        if ssh_config.use_bastion_tunnel:
+            from .tunnel import InstanceSshManagerWithSshTunnel
+            return InstanceSshManagerWithSshTunnel(ssh_config)
+        elif ssh_client is None:
+            return PooledInstanceSshManager(ssh_config)
+        else:
+            return InstanceSshManager(ssh_config, ssh_client)
+
+    def __init__(self, ssh_config, ssh_client=None):
+        """Inits a default InstanceSshManager without SSH tunnelling.
+
+        Args:
+            ssh_config: SshEnvConfig tuple containing SSH parameters
+            ssh_client: Use to override the default Paramiko SSHClient
+        """
+        self._sshclient = ssh_client or paramiko.SSHClient()
+        self._ssh_config = ssh_config
+        self._connected = False
+
+    def connect(self, ip_address):
+        """ Opens an SSH connection to an instance.
+
+        Args:
+            ip_address: IPv4 address of the instance to SSH into.
+        Raises:
+            IOError: if this class already has a connection.
+        """
+        if self._connected:
+            raise IOError("Already connected")
+        self._create_connection(ip_address)
+        self._connected = True
+
+    def _create_connection(self, ip_address):
+        self._sshclient.set_missing_host_key_policy(WarningPolicy())
+        self._sshclient.connect(
+            ip_address,
+            username=self._ssh_config.username,
+            key_filename=self._ssh_config.private_key_file_path
+        )
+
+    def is_ready(self, ip_address):
+        """ Returns whether an instance has successfully booted or not yet.
+
+        The ability to SSH into an instance by itself does not indicate whether
+        it has booted and is ready; EC2 creates a file at
+        /var/lib/cloud/instance/boot-finished when an instance has finished
+        booting. This method simply connects via SSH and checks for that file.
+
+        Args:
+            ip_address: IPv4 address of the instance to SSH into.
+        Returns:
+            boolean indicating whether the instance has booted or not.
+        """
+        try:
+            self.connect(ip_address)
+
+            stdin, stdout, stderr = self._sshclient.exec_command(
+                BOOT_FINISHED_COMMAND
+            )
+            exit_code = stdout.channel.recv_exit_status()
+
+            logger.debug('Received exit code %d from IP %s', exit_code,
+                         ip_address)
+            return exit_code == 0
+        except:
+            logger.debug('Exception raised whilst SSHing into IP %s',
+                         ip_address, exc_info=True)
+            return False
+        finally:
+            self.close_connections()
+
+    def close_connections(self):
+        """ Closes the current SSH connection."""
+        self._sshclient.close()
+        self._connected = False
+
+    def close_session(self, ip_address):
+        """ Closes any SSH session kept open to an instance, e.g. once it has
+        been terminated. This class keeps none open between probes.
+
+        Args:
+            ip_address: IPv4 address of the instance.
+        """
+
+
+class PooledInstanceSshManager(InstanceSshManager):
+    """ Keeps an SSH session open to each instance between readiness probes.
+
+    The private key is parsed once. Every instance gets a single transport,
+    kept alive with keepalive packets, and each probe opens another exec
+    channel on it. A session is closed once its instance is found ready, as
+    it will not be probed again, when it fails, when its instance is
+    terminated, and when its instance has not been probed for max_idle_s,
+    e.g. because it left the group.
+    """
+
+    def __init__(
+        self,
+        ssh_config,
+        ssh_client_factory=paramiko.SSHClient,
+        keepalive_s=30,
+        max_idle_s=300,
+        clock=time
+    ):
+        """
+        Args:
+            ssh_config: SshEnvConfig tuple containing SSH parameters
+            ssh_client_factory: Use to override how Paramiko SSHClients are
+                                created.
+            keepalive_s: time in seconds between keepalive packets on idle
+                         sessions.
+            max_idle_s: time in seconds after which sessions that have not
+                        been used are closed.
+            clock: Use to override the time function.
+        """
+        self._ssh_config = ssh_config
+        self._ssh_client_factory = ssh_client_factory
+        self._keepalive_s = keepalive_s
+        self._max_idle_s = max_idle_s
+        self._clock = clock
+        self._private_key = None
+        # IP address to (SSHClient, time last used)
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _get_private_key(self):
+        if self._private_key is None and \
+                self._ssh_config.private_key_file_path:
+            self._private_key = load_private_key(
+                self._ssh_config.private_key_file_path)
+        return self._private_key
+
+    def connect(self, ip_address):
+        """ Gets the open SSH session to an instance, opening one if there is
+        none or the last one was lost.
+
+        Args:
+            ip_address: IPv4 address of the instance to SSH into.
+        Returns:
+            the connected SSHClient.
+        """
+        now = self._clock()
+        with self._lock:
+            ssh_client, last_used = self._sessions.pop(ip_address,
+                                                       (None, None))
+            idle_ip_addresses = [
+                idle_ip_address for idle_ip_address, (_, idle_last_used)
+                in self._sessions.items()
+                if now - idle_last_used > self._max_idle_s]
+        self._close_sessions(idle_ip_addresses)
+
+        transport = ssh_client and ssh_client.get_transport()
+        if transport is None or not transport.is_active():
+            if ssh_client is not None:
+                ssh_client.close()
+            ssh_client = self._ssh_client_factory()
+            try:
+                ssh_client.set_missing_host_key_policy(WarningPolicy())
+                self._connect(ssh_client, ip_address)
+                ssh_client.get_transport().set_keepalive(self._keepalive_s)
+            except Exception:
+                # A failed connect can leave its socket open
+                ssh_client.close()
+                raise
+
+        with self._lock:
+            self._sessions[ip_address] = (ssh_client, now)
+        return ssh_client
+
+    def _connect(self, ssh_client, ip_address):
+        ssh_client.connect(
+            ip_address,
+            username=self._ssh_config.username,
+            pkey=self._get_private_key()
+        )
+
+    def is_ready(self, ip_address):
+        """ Returns whether an instance has successfully booted or not yet.
+
+        See InstanceSshManager.is_ready(); the check runs on the instance's
+        pooled session.
+
+        Args:
+            ip_address: IPv4 address of the instance to SSH into.
+        Returns:
+            boolean indicating whether the instance has booted or not.
+        """
+        try:
+            ssh_client = self.connect(ip_address)
+            stdin, stdout, stderr = ssh_client.exec_command(
+                BOOT_FINISHED_COMMAND)
+            exit_code = stdout.channel.recv_exit_status()
+
+            logger.debug('Received exit code %d from IP %s', exit_code,
+                         ip_address)
+        except Exception:
+            logger.debug('Exception raised whilst SSHing into IP %s',
+                         ip_address, exc_info=True)
+            self._close_sessions([ip_address])
+            return False
+
+        if exit_code == 0:
+            self._close_sessions([ip_address])
+        return exit_code == 0
+
+    def _close_sessions(self, ip_addresses):
+        for ip_address in ip_addresses:
+            with self._lock:
+                ssh_client, _ = self._sessions.pop(ip_address, (None, None))
+            if ssh_client is not None:
+                ssh_client.close()
+
+    def close_session(self, ip_address):
+        """ Closes the pooled SSH session to an instance, if there is one,
+        e.g. once it has been terminated.
+
+        Args:
+            ip_address: IPv4 address of the instance.
+        """
+        self._close_sessions([ip_address])
+
+    def close_connections(self):
+        """ Closes every pooled SSH session. """
+        with self._lock:
+            ip_addresses = list(self._sessions)
+        self._close_sessions(ip_addresses)
@@ -0,0 +1,155 @@
+from time import sleep, time
+
+import botocore
+
+from .aws import (
+    aws_api_call,
+    get_all_pages,
+    get_aws_client_config,
+    get_aws_session
+)
+
+
+SEND_COMMAND_BATCH_SIZE = 50
+
+BOOT_FINISHED_COMMAND = 'test -f /var/lib/cloud/instance/boot-finished'
+
+# Statuses of a command invocation that will not change any more
+FINISHED_INVOCATION_STATUSES = frozenset([
+    'Success',
+    'Failed',
+    'Cancelled',
+    'TimedOut',
+    'Undeliverable',
+    'Terminated',
+])
+
+
+class SsmReadinessChecker(object):
+    """ Checks whether instances have finished booting by running a single
+    SSM Run Command on all of them, instead of SSHing into each one.
+
+    The command is sent to up to SEND_COMMAND_BATCH_SIZE instances per call,
+    and the outcome for every instance it was sent to is collected with one
+    list_command_invocations call per poll. Instances only need the SSM agent
+    running and an instance profile allowing it, not an SSH path.
+    """
+
+    def __init__(
+        self,
+        region_name=None,
+        endpoint_url=None,
+        ssm_client=None,
+        poll_interval_s=2,
+        timeout_s=60,
+        clock=time,
+        sleeper=sleep
+    ):
+        """
+        Args:
+            region_name: the AWS region, or None for the default region.
+            endpoint_url: Use to override the SSM endpoint, e.g. with a local
+                          stand-in.
+            ssm_client: Use to override the boto3 SSM client.
+            poll_interval_s: time in seconds between checks for the outcome
+                             of a command.
+            timeout_s: time in seconds after which instances the command has
+                       not finished on are taken as not ready.
+            clock: Use to override the time function.
+            sleeper: Use to override the sleep function.
+        """
+        self._region_name = region_name
+        self._endpoint_url = endpoint_url
+        self._ssm_client = ssm_client
+        self._poll_interval_s = poll_interval_s
+        self._timeout_s = timeout_s
+        self._clock = clock
+        self._sleeper = sleeper
+
+    def _get_ssm_client(self):
+        if self._ssm_client is None:
+            self._ssm_client = get_aws_session(self._region_name).client(
+                'ssm', endpoint_url=self._endpoint_url,
+                config=get_aws_client_config())
+        return self._ssm_client
+
+    @aws_api_call('ssm')
+    def _send_command(self, instance_ids):
+        response = self._get_ssm_client().send_command(
+            InstanceIds=instance_ids,
+            DocumentName='AWS-RunShellScript',
+            Comment='Check whether the instance has finished booting',
+            Parameters={'commands': [BOOT_FINISHED_COMMAND]},
+            TimeoutSeconds=max(30, int(self._timeout_s))
+        )
+        return response['Command']['CommandId']
+
+    def _get_online_instance_ids(self, instance_ids):
+        return set(information['InstanceId'] for information in get_all_pages(
+            'ssm', self._get_ssm_client().describe_instance_information,
+            'InstanceInformationList', Filters=[
+                {'Key': 'InstanceIds', 'Values': instance_ids},
+                {'Key': 'PingStatus', 'Values': ['Online']}]))
+
+    def _get_invocation_statuses(self, command_id):
+        return dict(
+            (invocation['InstanceId'], invocation['Status'])
+            for invocation in get_all_pages(
+                'ssm', self._get_ssm_client().list_command_invocations,
+                'CommandInvocations', CommandId=command_id))
+
+    def _send_boot_finished_command(self, instance_ids):
+        """ Sends the command to the instances, or to those the SSM agent is
+        running on if it is not yet running on all of them.
+
+        Returns:
+            the ID of the command, or None if it was sent to no instance, and
+            the IDs of the instances it was sent to.
+        """
+        try:
+            return self._send_command(instance_ids), instance_ids
+        except botocore.exceptions.ClientError as client_error:
+            error_code = client_error.response.get('Error', {}).get('Code')
+            if error_code != 'InvalidInstanceId':
+                raise
+
+        # Instances still booting may not have registered with SSM yet
+        online_instance_ids = self._get_online_instance_ids(instance_ids)
+        instance_ids = [instance_id for instance_id in instance_ids
+                        if instance_id in online_instance_ids]
+        if not instance_ids:
+            return None, []
+        return self._send_command(instance_ids), instance_ids
+
+    def are_ready(self, instance_ids):
+        """ Checks which instances have finished booting.
+
+        See InstanceSshManager.is_ready() for what counts as booted.
+
+        Args:
+            instance_ids: the Amazon instance IDs to check.
+        Returns:
+            a dict of instance ID to whether the instance has booted.
+        """
+        command_ids = []
+        sent_instance_ids = []
+        for start in range(0, len(instance_ids), SEND_COMMAND_BATCH_SIZE):
+            command_id, sent_to = self._send_boot_finished_command(
+                list(instance_ids[start:start + SEND_COMMAND_BATCH_SIZE]))
+            if command_id is not None:
+                command_ids.append(command_id)
+                sent_instance_ids.extend(sent_to)
+
+        deadline = self._clock() + self._timeout_s
+        statuses = {}
+        while command_ids:
+            for command_id in command_ids:
+                statuses.update(self._get_invocation_statuses(command_id))
+            if self._clock() >= deadline or all(
+                    statuses.get(instance_id) in FINISHED_INVOCATION_STATUSES
+                    for instance_id in sent_instance_ids):
+                break
+            self._sleeper(self._poll_interval_s)
+
+        return dict((instance_id, statuses.get(instance_id) == 'Success')
+                    for instance_id in instance_ids)
@@ -0,0 +1,93 @@
+import threading
+from time import time
+
+import paramiko
+from paramiko.client import WarningPolicy
+
+from .ssh import PooledInstanceSshManager
+
+
+class InstanceSshManagerWithSshTunnel(PooledInstanceSshManager):
+    """ Tunnels the SSH sessions to instances through a bastion host.
+
+    When connecting to instances locally we connect through a Bastion host
+    and need to proxy through it. A single SSH transport to the bastion is
+    kept open, and the session to each instance runs over its own
+    direct-tcpip channel on it. Sessions to instances are pooled and closed
+    as by PooledInstanceSshManager, while the bastion transport is only
+    closed by close_connections(), and reopened if it is lost.
+    """
+
+    def __init__(
+        self,
+        ssh_config,
+        ssh_client_factory=paramiko.SSHClient,
+        keepalive_s=30,
+        max_idle_s=300,
+        clock=time
+    ):
+        """
+        Args:
+            ssh_config: SshEnvConfig tuple containing SSH parameters
+            ssh_client_factory: Use to override how Paramiko SSHClients are
+                                created, for the bastion and instances alike.
+            keepalive_s: time in seconds between keepalive packets on idle
+                         sessions.
+            max_idle_s: time in seconds after which sessions to instances
+                        that have not been used are closed.
+            clock: Use to override the time function.
+        """
+        super(InstanceSshManagerWithSshTunnel, self).__init__(
+            ssh_config, ssh_client_factory, keepalive_s, max_idle_s, clock)
+        self._bastion_client = None
+        self._bastion_lock = threading.Lock()
+
+    def _get_bastion_transport(self):
+        with self._bastion_lock:
+            transport = (self._bastion_client and
+                         self._bastion_client.get_transport())
+            if transport is None or not transport.is_active():
+                if self._bastion_client is not None:
+                    self._bastion_client.close()
+                    self._bastion_client = None
+                bastion_client = self._ssh_client_factory()
+                try:
+                    bastion_client.set_missing_host_key_policy(
+                        WarningPolicy())
+                    bastion_client.connect(
+                        self._ssh_config.use_bastion_tunnel,
+                        username=self._ssh_config.username,
+                        pkey=self._get_private_key()
+                    )
+                    transport = bastion_client.get_transport()
+                    transport.set_keepalive(self._keepalive_s)
+                except Exception:
+                    bastion_client.close()
+                    raise
+                self._bastion_client = bastion_client
+            return transport
+
+    def _connect(self, ssh_client, ip_address):
+        channel = self._get_bastion_transport().open_channel(
+            'direct-tcpip',
+            (ip_address, self._ssh_config.remote_port),
+            ('127.0.0.1', 0)
+        )
+        try:
+            ssh_client.connect(
+                ip_address,
+                username=self._ssh_config.username,
+                pkey=self._get_private_key(),
+                sock=channel
+            )
+        except Exception:
+            channel.close()
+            raise
+
+    def close_connections(self):
+        """ Closes every pooled SSH session, and the bastion transport. """
+        super(InstanceSshManagerWithSshTunnel, self).close_connections()
+        with self._bastion_lock:
+            bastion_client, self._bastion_client = self._bastion_client, None
+        if bastion_client is not None:
+            bastion_client.close()
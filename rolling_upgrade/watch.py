@@ -0,0 +1,211 @@
+import json
+import logging
+import os
+import Queue
+import socket
+import SocketServer
+import threading
+from time import time
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONTROL_SOCKET = 'asg-rolling-upgrade.sock'
+
+
+class UpgradeWatcher(object):
+    """ Watches autoscaling groups and upgrades them when their launch
+    configuration changes.
+
+    A single RollingUpgradeManager is used for every upgrade, so its AWS
+    clients, SSH connections and caches stay warm between upgrades. It should
+    be made with close_sessions_after_upgrade disabled; its SSH sessions are
+    closed once watching stops. Upgrades run one at a time. They can also be requested, and the state of each group
+    queried, through a local control socket; see send_watch_command().
+    """
+
+    def __init__(
+        self,
+        rolling_upgrade_manager,
+        asg_slugs,
+        poll_interval_s=60,
+        control_socket_path=None
+    ):
+        """
+        Args:
+            rolling_upgrade_manager: the connected RollingUpgradeManager to
+                                     upgrade groups with.
+            asg_slugs: names of the autoscaling groups to watch, as given to
+                       RollingUpgradeManager.perform_rolling_upgrade_where_needed()
+            poll_interval_s: time in seconds between checks for launch
+                             configuration changes.
+            control_socket_path: path of the Unix socket to accept commands
+                                 on, or None for no control socket.
+        """
+        self._rolling_upgrade_manager = rolling_upgrade_manager
+        self._poll_interval_s = poll_interval_s
+        self._control_socket_path = control_socket_path
+        self._requests = Queue.Queue()
+        self._lock = threading.Lock()
+        self._status = dict((asg_slug, {
+            'launch_configuration_name': None,
+            'state': 'idle',
+            'last_upgrade_started': None,
+            'last_upgrade_finished': None,
+            'last_error': None
+        }) for asg_slug in asg_slugs)
+        self._server = None
+        self._stopped = False
+
+    def get_status(self):
+        """ Gets the state of every watched autoscaling group. """
+        with self._lock:
+            return dict((asg_slug, dict(status))
+                        for asg_slug, status in self._status.items())
+
+    def request_upgrade(self, asg_slug):
+        """ Asks for an autoscaling group to be upgraded as soon as any
+        running upgrade has finished.
+
+        Returns:
+            False if the group is not watched.
+        """
+        if asg_slug not in self._status:
+            return False
+        self._requests.put(asg_slug)
+        return True
+
+    def stop(self):
+        """ Stops watching once any running upgrade has finished. """
+        self._stopped = True
+        self._requests.put(None)
+
+    def _set_status(self, asg_slug, **fields):
+        with self._lock:
+            self._status[asg_slug].update(fields)
+
+    def _has_config_changed(self, asg_slug):
+        asg = self._rolling_upgrade_manager.get_single_asg(asg_slug)
+        config_name = asg.get('LaunchConfigurationName')
+        with self._lock:
+            status = self._status[asg_slug]
+            changed = config_name != status['launch_configuration_name']
+            status['launch_configuration_name'] = config_name
+        return changed
+
+    def upgrade(self, asg_slug):
+        """ Upgrades a watched autoscaling group, recording the outcome rather
+        than raising so that watching carries on.
+        """
+        self._set_status(asg_slug, state='upgrading',
+                         last_upgrade_started=time(), last_error=None)
+        try:
+            self._rolling_upgrade_manager.perform_rolling_upgrade_where_needed(
+                asg_slug)
+        except Exception as e:
+            logger.debug('Upgrade of %s failed', asg_slug, exc_info=True)
+            logger.error('!!! Upgrade of %s failed: %s', asg_slug, e)
+            self._set_status(asg_slug, state='failed',
+                             last_upgrade_finished=time(), last_error=str(e))
+        else:
+            self._set_status(asg_slug, state='idle',
+                             last_upgrade_finished=time())
+
+    def poll(self):
+        """ Upgrades every watched autoscaling group whose launch
+        configuration has changed since the last poll. Every group is
+        upgraded on the first poll, in case it changed while unwatched.
+        """
+        for asg_slug in sorted(self._status):
+            try:
+                changed = self._has_config_changed(asg_slug)
+            except Exception as e:
+                logger.warning('!!! Could not check %s: %s', asg_slug, e)
+                continue
+            if changed:
+                logger.info('=== Launch configuration of %s changed ===',
+                            asg_slug)
+                self.upgrade(asg_slug)
+
+    def run(self):
+        """ Watches until stop() is called, then closes the manager's SSH
+        sessions.
+        """
+        if self._control_socket_path is not None:
+            self._start_control_server()
+        try:
+            next_poll = 0
+            while not self._stopped:
+                if time() >= next_poll:
+                    self.poll()
+                    next_poll = time() + self._poll_interval_s
+                try:
+                    asg_slug = self._requests.get(
+                        timeout=max(0, next_poll - time()))
+                except Queue.Empty:
+                    continue
+                if asg_slug is not None:
+                    self.upgrade(asg_slug)
+        finally:
+            if self._server is not None:
+                self._server.shutdown()
+                self._server.server_close()
+                os.remove(self._control_socket_path)
+            self._rolling_upgrade_manager.close_sessions()
+
+    def handle_command(self, command):
+        """ Runs a control socket command.
+
+        Args:
+            command: "status", or "upgrade <asg_slug>".
+        Returns:
+            a JSON-serialisable response.
+        """
+        words = command.split()
+        if words == ['status']:
+            return {'ok': True, 'groups': self.get_status()}
+        elif len(words) == 2 and words[0] == 'upgrade':
+            if self.request_upgrade(words[1]):
+                return {'ok': True}
+            return {'ok': False, 'error': '%s is not watched' % words[1]}
+        return {'ok': False, 'error': 'Unknown command "%s"' % command}
+
+    def _start_control_server(self):
+        watcher = self
+
+        class ControlHandler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                command = self.rfile.readline().strip()
+                self.wfile.write(json.dumps(watcher.handle_command(command)) +
+                                 '\n')
+
+        if os.path.exists(self._control_socket_path):
+            os.remove(self._control_socket_path)
+        self._server = _ControlServer(self._control_socket_path,
+                                      ControlHandler)
+        server_thread = threading.Thread(target=self._server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+
+class _ControlServer(SocketServer.ThreadingMixIn,
+                     SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def send_watch_command(control_socket_path, command):
+    """ Sends a command to a running UpgradeWatcher.
+
+    Args:
+        control_socket_path: path of the watcher's control socket.
+        command: see UpgradeWatcher.handle_command().
+    Returns:
+        the watcher's response.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(control_socket_path)
+        client.sendall(command + '\n')
+        return json.loads(client.makefile().readline())
+    finally:
+        client.close()
@@ -1,19 +1,84 @@
-from collections import namedtuple
+from collections import Counter, namedtuple
 from datetime import datetime
+import itertools
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
 from mock import mock
 
 import pytest
 import botocore
-from paramiko import SSHClient
+import botocore.config
+import retrying
+from paramiko import DSSKey, ECDSAKey, RSAKey, SSHClient, SSHException
 
-from asg_rolling_upgrade import (
-    RollingUpgradeManager,
+from rolling_upgrade import aws
+from rolling_upgrade.aws import (
+    AdaptiveRateLimiter,
     AwsManager,
-    retry_if_throttled,
-    InstanceSshManager,
+    get_aws_client,
+    get_aws_client_config,
+    has_aws_operation,
+    retry_if_throttled
+)
+from rolling_upgrade.cache import AsgNameIndex, DiffCache, get_literal_prefix
+from rolling_upgrade.common import (
+    InstanceSnapshot,
+    SshEnvConfig,
+    is_in_service,
+    is_terminating
+)
+from rolling_upgrade.cassette import (
+    Cassette,
+    CassetteMismatch,
+    CassetteRecorder,
+    RecordingProxy,
+    ReplayedError,
+    ReplayingProxy,
+    decode_value,
+    encode_value
+)
+from rolling_upgrade.comparator import (
+    DeduplicatingConfigComparator,
     InstanceConfigComparator,
-    SshEnvConfig
+    get_changed_launch_config_fields
+)
+from rolling_upgrade.events import (
+    INSTANCE_STALE,
+    INSTANCE_TERMINATED,
+    INSTANCES_BOOTED,
+    INSTANCES_READY,
+    UPGRADE_FINISHED,
+    UPGRADE_STARTED,
+    WAIT_ATTEMPT,
+    ConsoleReporter,
+    JsonLinesSink,
+    ProgressEvent,
+    ProgressEvents
 )
+from rolling_upgrade import log
+from rolling_upgrade.journal import UpgradeJournal, get_config_fingerprint
+from rolling_upgrade.manager import RollingUpgradeManager, UpgradeFailed
+from rolling_upgrade.scheduler import (
+    ReplacementScheduler,
+    az_balance,
+    tag_priority
+)
+from rolling_upgrade.simulate import (
+    SimulatedGroup,
+    VirtualClock,
+    get_boot_time_sampler,
+    simulate_upgrade
+)
+from rolling_upgrade import ssh
+from rolling_upgrade.ssh import InstanceSshManager, PooledInstanceSshManager
+from rolling_upgrade.ssm import SsmReadinessChecker
+from rolling_upgrade.tunnel import InstanceSshManagerWithSshTunnel
+from rolling_upgrade.watch import UpgradeWatcher, send_watch_command
 
 
 class MockObject:
@@ -23,20 +88,8 @@ class MockObject:
 
 
 @pytest.fixture()
-def mock_paginator():
-    return mock.Mock(spec=botocore.client.Paginator)
-
-
-@pytest.fixture()
-def mock_as_client(mock_paginator):
-    mock_as_client = mock.Mock()
-    mock_as_client.get_paginator.return_value = mock_paginator
-    return mock_as_client
-
-
-@pytest.fixture()
-def mock_ec2():
-    return mock.Mock(spec=botocore.client)
+def mock_as_client():
+    return mock.Mock()
 
 
 @pytest.fixture()
@@ -45,10 +98,10 @@ def mock_ec2_client():
 
 
 @pytest.fixture()
-def aws_manager(mock_as_client, mock_ec2, mock_ec2_client):
+def aws_manager(mock_as_client, mock_ec2_client):
     aws_manager = AwsManager()
     aws_manager.connect(autoscaling_client=mock_as_client,
-                        ec2=mock_ec2, ec2_client=mock_ec2_client)
+                        ec2_client=mock_ec2_client)
     return aws_manager
 
 
@@ -62,8 +115,173 @@ def test_only_retries_on_throttle():
     assert not retry_if_throttled(ex)
 
 
-def test_aws_finds_asg_group_no_match(aws_manager, mock_paginator):
-    mock_paginator.paginate.return_value = [{
+@pytest.mark.parametrize('error_code', [
+    'Throttling', 'RequestLimitExceeded', 'ThrottlingException'])
+def test_retries_on_throttling_error_codes(error_code):
+    ex = botocore.exceptions.ClientError(
+        {'Error': {'Code': error_code, 'Message': 'Rate exceeded'}},
+        'test_connect')
+    assert retry_if_throttled(ex)
+
+    assert not retry_if_throttled(Exception('throttling'))
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_rate_limiter_spaces_out_calls_beyond_burst():
+    clock = FakeClock()
+    limiter = AdaptiveRateLimiter(rate=2.0, burst=2, clock=clock,
+                                  sleeper=clock.sleep)
+
+    for _ in range(4):
+        limiter.acquire()
+
+    assert clock.now == pytest.approx(1.0)
+
+
+def test_rate_limiter_adapts_rate_aimd():
+    clock = FakeClock()
+    limiter = AdaptiveRateLimiter(rate=8.0, min_rate=1.0, max_rate=9.0,
+                                  increase=0.5, decrease_factor=0.5,
+                                  clock=clock, sleeper=clock.sleep)
+
+    limiter.on_throttle()
+    assert limiter.rate == 4.0
+    limiter.on_success()
+    assert limiter.rate == 4.5
+
+    for _ in range(20):
+        limiter.on_success()
+    assert limiter.rate == 9.0
+
+    for _ in range(20):
+        limiter.on_throttle()
+    assert limiter.rate == 1.0
+
+
+@pytest.fixture()
+def mock_limiter(monkeypatch):
+    # Backoff between retried attempts is not waited out
+    monkeypatch.setattr(retrying, 'time', mock.Mock(time=time.time))
+    limiter = mock.Mock(spec=AdaptiveRateLimiter)
+    monkeypatch.setattr(aws, '_rate_limiters', {'autoscaling': limiter})
+    return limiter
+
+
+def throttling_error():
+    return botocore.exceptions.ClientError(
+        {'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'}},
+        'DescribeAutoScalingGroups')
+
+
+def test_aws_rate_limits_and_retries_each_page(
+    aws_manager,
+    mock_as_client,
+    mock_limiter
+):
+    mock_as_client.describe_auto_scaling_groups.side_effect = [
+        {'AutoScalingGroups': [{'AutoScalingGroupName': 'a'}],
+         'NextToken': 'page2'},
+        throttling_error(),
+        {'AutoScalingGroups': [{'AutoScalingGroupName': 'b'}]}]
+
+    assert aws_manager.get_all_as_groups() == [
+        {'AutoScalingGroupName': 'a'}, {'AutoScalingGroupName': 'b'}]
+
+    assert mock_as_client.describe_auto_scaling_groups.call_args_list == [
+        mock.call(), mock.call(NextToken='page2'),
+        mock.call(NextToken='page2')]
+    assert mock_limiter.acquire.call_count == 3
+    assert mock_limiter.on_throttle.call_count == 1
+    assert mock_limiter.on_success.call_count == 2
+
+
+def test_aws_gives_up_on_calls_that_stay_throttled(
+    aws_manager,
+    mock_as_client,
+    mock_limiter
+):
+    mock_as_client.describe_auto_scaling_groups.side_effect = \
+        throttling_error()
+
+    with pytest.raises(botocore.exceptions.ClientError):
+        aws_manager.get_all_as_groups()
+
+    assert mock_as_client.describe_auto_scaling_groups.call_count == \
+        aws.MAX_THROTTLED_ATTEMPTS
+
+
+def test_aws_client_config_sizes_pool_to_concurrency(monkeypatch):
+    monkeypatch.setattr(
+        botocore.config.Config, 'OPTION_DEFAULTS',
+        dict(botocore.config.Config.OPTION_DEFAULTS,
+             max_pool_connections=10))
+
+    config = get_aws_client_config(concurrency=32)
+
+    assert config.max_pool_connections == 32
+    assert get_aws_client_config(concurrency=2).max_pool_connections == 10
+
+
+def test_aws_client_config_leaves_retries_to_rate_limiter(monkeypatch):
+    monkeypatch.setattr(
+        botocore.config.Config, 'OPTION_DEFAULTS',
+        dict(botocore.config.Config.OPTION_DEFAULTS, retries=None))
+
+    config = get_aws_client_config()
+
+    assert config.retries == {'max_attempts': 0}
+
+
+def test_aws_client_config_skips_unsupported_options(monkeypatch):
+    monkeypatch.setattr(
+        botocore.config.Config, 'OPTION_DEFAULTS',
+        {name: value for name, value in
+         botocore.config.Config.OPTION_DEFAULTS.items()
+         if name not in ('max_pool_connections', 'tcp_keepalive')})
+
+    config = get_aws_client_config(concurrency=32)
+
+    assert config.connect_timeout == 5
+    assert not hasattr(config, 'max_pool_connections')
+
+
+def test_aws_knows_operations_of_installed_botocore():
+    assert has_aws_operation('autoscaling', 'PutWarmPool')
+    assert has_aws_operation('autoscaling', 'DescribeWarmPool')
+    assert has_aws_operation('elbv2', 'DescribeTargetHealth')
+    assert not has_aws_operation('autoscaling', 'PutColdPool')
+    assert not has_aws_operation('elbv3', 'DescribeTargetHealth')
+
+
+def test_aws_clients_are_shared_per_service_and_region(monkeypatch):
+    mock_session_class = mock.Mock()
+    monkeypatch.setattr('boto3.session.Session', mock_session_class)
+    monkeypatch.setattr(aws, '_aws_sessions', {})
+    monkeypatch.setattr(aws, '_aws_clients', {})
+
+    client = get_aws_client('ec2', 'eu-west-1', 10)
+
+    assert get_aws_client('ec2', 'eu-west-1', 10) is client
+    mock_session_class.assert_called_once_with(region_name='eu-west-1')
+    assert mock_session_class.return_value.client.call_count == 1
+
+    get_aws_client('autoscaling', 'eu-west-1', 10)
+    assert mock_session_class.call_count == 1
+    assert mock_session_class.return_value.client.call_count == 2
+
+
+def test_aws_finds_asg_group_no_match(aws_manager, mock_as_client):
+    mock_as_client.describe_auto_scaling_groups.return_value = {
         'AutoScalingGroups': [
             {'AutoScalingGroupName': 'foo'},
             {'AutoScalingGroupName': 'bar'},
@@ -71,15 +289,15 @@ def test_aws_finds_asg_group_no_match(aws_manager, mock_paginator):
             {'AutoScalingGroupName': 'ooo'},
             {'AutoScalingGroupName': 'mmm'}
         ]
-    }]
+    }
 
     result = aws_manager.find_asg_group('^no_match')
 
     assert result == []
 
 
-def test_aws_finds_multiple_asg_groups(aws_manager, mock_paginator):
-    mock_paginator.paginate.return_value = [{
+def test_aws_finds_multiple_asg_groups(aws_manager, mock_as_client):
+    mock_as_client.describe_auto_scaling_groups.return_value = {
         'AutoScalingGroups': [
             {'AutoScalingGroupName': 'foo'},
             {'AutoScalingGroupName': 'match1'},
@@ -87,7 +305,7 @@ def test_aws_finds_multiple_asg_groups(aws_manager, mock_paginator):
             {'AutoScalingGroupName': 'match3'},
             {'AutoScalingGroupName': 'test_pat_1'}
         ]
-    }]
+    }
 
     results = aws_manager.find_asg_group('^match')
 
@@ -97,8 +315,8 @@ def test_aws_finds_multiple_asg_groups(aws_manager, mock_paginator):
     assert results[2]['AutoScalingGroupName'] == 'match3'
 
 
-def test_aws_finds_asg_group(aws_manager, mock_paginator):
-    mock_paginator.paginate.return_value = [{
+def test_aws_finds_asg_group(aws_manager, mock_as_client):
+    mock_as_client.describe_auto_scaling_groups.return_value = {
         'AutoScalingGroups': [
             {'AutoScalingGroupName': 'foo'},
             {'AutoScalingGroupName': 'bar'},
@@ -106,7 +324,7 @@ def test_aws_finds_asg_group(aws_manager, mock_paginator):
             {'AutoScalingGroupName': 'ooo'},
             {'AutoScalingGroupName': 'test_pat_1'}
         ]
-    }]
+    }
 
     result = aws_manager.find_asg_group('^test_pat')
 
@@ -162,6 +380,166 @@ def test_aws_converts_volumes_to_dict(aws_manager, mock_ec2_client):
         assert result[key] == ec2_volumes[i]
 
 
+def test_aws_gets_instance_snapshots_for_asg(
+    aws_manager,
+    mock_as_client,
+    mock_ec2_client
+):
+    description = {
+        'InstanceId': 'i-1',
+        'LaunchTime': datetime(2016, 7, 26),
+        'Placement': {'AvailabilityZone': 'eu-west-1a', 'Tenancy': 'default'},
+        'PrivateIpAddress': '10.0.0.1',
+        'ImageId': 'ami-1',
+        'InstanceType': 't2.micro',
+        'KeyName': 'crunch-dev',
+        'SecurityGroups': [{'GroupId': 'sg-1', 'GroupName': 'web'}],
+        'BlockDeviceMappings': [{'DeviceName': '/dev/sda1',
+                                 'Ebs': {'VolumeId': 'vol-1',
+                                         'Status': 'attached'}}],
+        'Tags': [{'Key': 'Name', 'Value': 'rabbit'}],
+        'NetworkInterfaces': [{'Description': 'not needed'}],
+    }
+    mock_as_client.describe_auto_scaling_groups.return_value = {
+        'AutoScalingGroups': [{'Instances': [
+            {'InstanceId': 'i-1', 'LifecycleState': 'InService',
+             'LaunchConfigurationName': 'lc-old'},
+            {'InstanceId': 'i-2', 'LifecycleState': 'Pending',
+             'LaunchConfigurationName': 'lc-new'},
+            {'InstanceId': 'i-stopped', 'LifecycleState': 'InService'},
+        ]}]
+    }
+    mock_ec2_client.describe_instances.return_value = {'Reservations': [
+        {'Instances': [dict(description, InstanceId='i-2')]},
+        {'Instances': [description]},
+    ]}
+
+    result = aws_manager.get_instances_for_asg(
+        {'AutoScalingGroupName': 'test-asg'})
+
+    mock_as_client.describe_auto_scaling_groups.assert_called_once_with(
+        AutoScalingGroupNames=['test-asg'])
+    assert mock_ec2_client.describe_instances.call_count == 1
+    assert mock_ec2_client.describe_instances.call_args[1]['InstanceIds'] == \
+        ['i-1', 'i-2', 'i-stopped']
+    assert [instance.id for instance in result] == ['i-1', 'i-2']
+    assert isinstance(result[0], InstanceSnapshot)
+    assert result[0].placement == {'AvailabilityZone': 'eu-west-1a'}
+    assert result[0].security_groups == [{'GroupId': 'sg-1'}]
+    assert result[0].block_device_mappings == [
+        {'DeviceName': '/dev/sda1', 'Ebs': {'VolumeId': 'vol-1'}}]
+    assert result[0].kernel_id is None
+
+
+def test_aws_describes_instances_in_batches(
+    aws_manager,
+    mock_as_client,
+    mock_ec2_client
+):
+    mock_as_client.describe_auto_scaling_groups.return_value = {
+        'AutoScalingGroups': [{'Instances': [
+            {'InstanceId': 'i-%d' % i} for i in range(250)]}]
+    }
+    mock_ec2_client.describe_instances.return_value = {'Reservations': []}
+
+    aws_manager.get_instances_for_asg({'AutoScalingGroupName': 'test-asg'})
+
+    assert [len(call[1]['InstanceIds']) for call in
+            mock_ec2_client.describe_instances.call_args_list] == \
+        [100, 100, 50]
+
+    mock_ec2_client.describe_instances.reset_mock()
+    mock_as_client.describe_auto_scaling_groups.return_value = {
+        'AutoScalingGroups': [{'Instances': []}]}
+
+    assert aws_manager.get_instances_for_asg(
+        {'AutoScalingGroupName': 'test-asg'}) == []
+    assert not mock_ec2_client.describe_instances.called
+
+
+def test_aws_lists_instance_ids_without_describing_instances(
+    aws_manager,
+    mock_as_client,
+    mock_ec2_client
+):
+    mock_as_client.describe_auto_scaling_groups.return_value = {
+        'AutoScalingGroups': [{'Instances': [
+            {'InstanceId': 'i-1', 'LifecycleState': 'InService'},
+            {'InstanceId': 'i-2', 'LifecycleState': 'Pending'},
+            {'InstanceId': 'i-3', 'LifecycleState': 'Terminating:Wait'},
+        ]}]
+    }
+    asg = {'AutoScalingGroupName': 'test-asg'}
+
+    assert aws_manager.get_in_service_instance_ids(asg) == ['i-1']
+    assert aws_manager.get_remaining_instance_ids(asg) == ['i-1', 'i-2']
+    assert not mock_ec2_client.describe_instances.called
+
+
+def test_aws_only_describes_the_instances_asked_for(
+    aws_manager,
+    mock_as_client,
+    mock_ec2_client
+):
+    mock_as_client.describe_auto_scaling_groups.return_value = {
+        'AutoScalingGroups': [{'Instances': [
+            {'InstanceId': 'i-1', 'LifecycleState': 'InService'},
+            {'InstanceId': 'i-2', 'LifecycleState': 'Pending',
+             'LaunchConfigurationName': 'lc-new'},
+        ]}]
+    }
+    mock_ec2_client.describe_instances.return_value = {'Reservations': [
+        {'Instances': [{'InstanceId': 'i-2', 'LaunchTime': None,
+                        'PrivateIpAddress': '10.0.0.2'}]}]}
+
+    joined = aws_manager.get_instances_for_asg(
+        {'AutoScalingGroupName': 'test-asg'}, ['i-2'])
+    instances = aws_manager.get_instances(['i-2'])
+
+    assert [call[1]['InstanceIds'] for call in
+            mock_ec2_client.describe_instances.call_args_list] == \
+        [['i-2'], ['i-2']]
+    assert [(instance.id, instance.launch_configuration_name)
+            for instance in joined] == [('i-2', 'lc-new')]
+    assert [(instance.id, instance.private_ip_address)
+            for instance in instances] == [('i-2', '10.0.0.2')]
+
+
+def test_aws_skips_instances_ec2_does_not_know_yet(
+    aws_manager,
+    mock_as_client,
+    mock_ec2_client
+):
+    mock_as_client.describe_auto_scaling_groups.return_value = {
+        'AutoScalingGroups': [{'Instances': [
+            {'InstanceId': 'i-1', 'LifecycleState': 'InService'},
+            {'InstanceId': 'i-just-launched', 'LifecycleState': 'Pending'},
+        ]}]
+    }
+    not_found = botocore.exceptions.ClientError(
+        {'Error': {'Code': 'InvalidInstanceID.NotFound',
+                   'Message': "The instance ID 'i-just-launched' does not "
+                              "exist"}},
+        'DescribeInstances')
+    mock_ec2_client.describe_instances.side_effect = [
+        not_found,
+        {'Reservations': [{'Instances': [{
+            'InstanceId': 'i-1',
+            'LaunchTime': datetime(2016, 7, 26),
+            'Placement': {'AvailabilityZone': 'eu-west-1a'},
+        }]}]},
+    ]
+
+    result = aws_manager.get_instances_for_asg(
+        {'AutoScalingGroupName': 'test-asg'})
+
+    assert [instance.id for instance in result] == ['i-1']
+    retry_request = mock_ec2_client.describe_instances.call_args[1]
+    assert 'InstanceIds' not in retry_request
+    assert {'Name': 'instance-id',
+            'Values': ['i-1', 'i-just-launched']} in retry_request['Filters']
+
+
 def test_aws_config_volume_to_dict(aws_manager):
     devs = ('sda1', 'sda2', 'sda3', 'sda4')
 
@@ -227,6 +605,212 @@ def test_instance_manager_returns_false_on_non_zero_exit_code(
     assert not instance_manager.is_ready(Instance('10.0.0.0'))
 
 
+@pytest.fixture
+def pooled_ssh(monkeypatch):
+    clients = []
+    exit_codes = {}
+    clock = FakeClock()
+
+    def make_ssh_client():
+        ssh_client = mock.Mock(spec=SSHClient)
+        transport = mock.Mock()
+        ssh_client.transport = transport
+
+        def connect(ip_address, **kwargs):
+            ssh_client.ip_address = ip_address
+            transport.is_active.return_value = True
+            ssh_client.get_transport.return_value = transport
+
+        def exec_command(command):
+            stdout = mock.Mock()
+            stdout.channel.recv_exit_status.return_value = \
+                exit_codes[ssh_client.ip_address]
+            return None, stdout, None
+
+        def close():
+            transport.is_active.return_value = False
+
+        ssh_client.get_transport.return_value = None
+        ssh_client.connect.side_effect = connect
+        ssh_client.exec_command.side_effect = exec_command
+        ssh_client.close.side_effect = close
+        clients.append(ssh_client)
+        return ssh_client
+
+    mock_load_private_key = mock.Mock(return_value='parsed-key')
+    monkeypatch.setattr(ssh, 'load_private_key', mock_load_private_key)
+    ssh_config = SshEnvConfig(
+        username='test_user',
+        private_key_file_path='/path/to/key',
+        environment='TestEnv',
+        remote_port=22,
+        use_bastion_tunnel=False
+    )
+    instance_manager = PooledInstanceSshManager(
+        ssh_config, ssh_client_factory=make_ssh_client, max_idle_s=60,
+        clock=clock)
+    return instance_manager, clients, exit_codes, clock, mock_load_private_key
+
+
+def test_pooled_ssh_reuses_sessions_until_instances_are_ready(pooled_ssh):
+    instance_manager, clients, exit_codes, clock, load_private_key = \
+        pooled_ssh
+    exit_codes.update({'10.0.0.1': 1, '10.0.0.2': 1})
+
+    for attempt in range(3):
+        assert not instance_manager.is_ready('10.0.0.1')
+        assert not instance_manager.is_ready('10.0.0.2')
+    exit_codes['10.0.0.1'] = 0
+    assert instance_manager.is_ready('10.0.0.1')
+
+    assert [ssh_client.ip_address for ssh_client in clients] == \
+        ['10.0.0.1', '10.0.0.2']
+    assert clients[0].exec_command.call_count == 4
+    clients[0].connect.assert_called_once_with(
+        '10.0.0.1', username='test_user', pkey='parsed-key')
+    clients[0].transport.set_keepalive.assert_called_with(30)
+    load_private_key.assert_called_once_with('/path/to/key')
+    # Ready instances are never probed again
+    assert clients[0].close.called
+    assert not clients[1].close.called
+
+
+def test_pooled_ssh_evicts_failed_and_idle_sessions(pooled_ssh):
+    instance_manager, clients, exit_codes, clock, load_private_key = \
+        pooled_ssh
+    exit_codes.update({'10.0.0.1': 1, '10.0.0.2': 1})
+
+    assert not instance_manager.is_ready('10.0.0.1')
+    assert not instance_manager.is_ready('10.0.0.2')
+    clients[1].exec_command.side_effect = Exception('Connection reset')
+    assert not instance_manager.is_ready('10.0.0.2')
+    assert clients[1].close.called
+
+    # 10.0.0.1 left the group, so it is no longer probed
+    clock.now += 61
+    assert not instance_manager.is_ready('10.0.0.2')
+    assert clients[0].close.called
+    assert len(clients) == 3
+
+
+def test_pooled_ssh_closes_clients_that_fail_to_connect(pooled_ssh):
+    instance_manager = pooled_ssh[0]
+    ssh_client = mock.Mock(spec=SSHClient)
+    ssh_client.connect.side_effect = SSHException('Connection refused')
+    instance_manager._ssh_client_factory = lambda: ssh_client
+
+    with pytest.raises(SSHException):
+        instance_manager.connect('10.0.0.1')
+
+    assert ssh_client.close.called
+    assert not instance_manager.is_ready('10.0.0.1')
+
+
+def test_pooled_ssh_closes_sessions_of_terminated_instances(pooled_ssh):
+    instance_manager, clients, exit_codes, clock, load_private_key = \
+        pooled_ssh
+    exit_codes.update({'10.0.0.1': 1, '10.0.0.2': 1})
+    assert not instance_manager.is_ready('10.0.0.1')
+    assert not instance_manager.is_ready('10.0.0.2')
+
+    instance_manager.close_session('10.0.0.1')
+    assert clients[0].close.called
+    assert not clients[1].close.called
+
+    instance_manager.close_connections()
+    assert clients[1].close.called
+
+
+def test_load_private_key_tries_every_key_type(tmpdir, monkeypatch):
+    path = str(tmpdir.join('id_key'))
+    tmpdir.join('id_key').write('not a key')
+    tried = []
+    parseable_classes = set([DSSKey])
+
+    def from_private_key_file(key_class, key_path):
+        tried.append(key_class.__name__)
+        if key_class not in parseable_classes:
+            raise SSHException('Not a %s' % key_class.__name__)
+        return 'parsed-key'
+
+    for key_class in (RSAKey, ECDSAKey, DSSKey):
+        monkeypatch.setattr(key_class, 'from_private_key_file',
+                            classmethod(from_private_key_file))
+
+    assert ssh.load_private_key(path) == 'parsed-key'
+    assert tried == ['RSAKey', 'ECDSAKey', 'DSSKey']
+
+    parseable_classes.clear()
+    with pytest.raises(SSHException):
+        ssh.load_private_key(path)
+
+
+def test_ssh_manager_pools_sessions_without_bastion(instance_manager):
+    ssh_config = instance_manager._ssh_config
+
+    assert isinstance(InstanceSshManager.get_instance(ssh_config),
+                      PooledInstanceSshManager)
+
+
+def test_tunnelled_ssh_shares_one_bastion_transport(monkeypatch):
+    clients = []
+
+    def make_ssh_client():
+        ssh_client = mock.Mock(spec=SSHClient)
+        transport = mock.Mock()
+
+        def connect(host, **kwargs):
+            ssh_client.host = host
+            transport.is_active.return_value = True
+            ssh_client.get_transport.return_value = transport
+
+        stdout = mock.Mock()
+        stdout.channel.recv_exit_status.return_value = 1
+        ssh_client.get_transport.return_value = None
+        ssh_client.connect.side_effect = connect
+        ssh_client.exec_command.return_value = (None, stdout, None)
+        clients.append(ssh_client)
+        return ssh_client
+
+    monkeypatch.setattr(ssh, 'load_private_key', lambda path: 'parsed-key')
+    ssh_config = SshEnvConfig(
+        username='test_user',
+        private_key_file_path='/path/to/key',
+        environment='TestEnv',
+        remote_port=22,
+        use_bastion_tunnel='bastion.example.com'
+    )
+    assert isinstance(InstanceSshManager.get_instance(ssh_config),
+                      InstanceSshManagerWithSshTunnel)
+    instance_manager = InstanceSshManagerWithSshTunnel(
+        ssh_config, ssh_client_factory=make_ssh_client)
+
+    for attempt in range(3):
+        assert not instance_manager.is_ready('10.0.0.1')
+        assert not instance_manager.is_ready('10.0.0.2')
+
+    clients_by_host = dict((ssh_client.host, ssh_client)
+                           for ssh_client in clients)
+    assert len(clients) == 3
+    bastion = clients_by_host['bastion.example.com']
+    bastion_transport = bastion.get_transport()
+    assert bastion_transport.open_channel.call_args_list == [
+        mock.call('direct-tcpip', ('10.0.0.1', 22), ('127.0.0.1', 0)),
+        mock.call('direct-tcpip', ('10.0.0.2', 22), ('127.0.0.1', 0))]
+    clients_by_host['10.0.0.1'].connect.assert_called_once_with(
+        '10.0.0.1', username='test_user', pkey='parsed-key',
+        sock=bastion_transport.open_channel.return_value)
+
+    # The bastion transport outlives the sessions tunnelled through it
+    instance_manager.close_session('10.0.0.1')
+    assert clients_by_host['10.0.0.1'].close.called
+    assert not bastion.close.called
+
+    instance_manager.close_connections()
+    assert clients_by_host['10.0.0.2'].close.called
+    assert bastion.close.called
+
+
 @pytest.fixture(scope='function')
 def instance_comparator(request):
     return InstanceConfigComparator()
@@ -397,6 +981,86 @@ def test_comparator_security_groups_order_difference(instance_comparator,
 
     assert len(result) == 0
 
+def make_comparable_instance(**attrs):
+    instance = InstanceForConfigComparator()
+    instance.security_groups = [{'GroupId': 'sg-1'}]
+    for name in attrs:
+        setattr(instance, name, attrs[name])
+    return instance
+
+
+def make_volumes_dict(volume_id, size='8'):
+    return {'sda1': {'VolumeId': volume_id,
+                     'VolumeType': 'gp2',
+                     'Size': size,
+                     'Attachments': [{'Device': 'sda1',
+                                      'DeleteOnTermination': True}]}}
+
+
+def test_deduplicating_comparator_compares_identical_instances_once(
+    default_asg_config
+):
+    default_asg_config['SecurityGroups'] = ['sg-1']
+    default_asg_config['ImageId'] = 'ami-new'
+    config_volumes_dict = {'sda1': {'Ebs': {'VolumeType': 'gp2',
+                                            'VolumeSize': '8',
+                                            'DeleteOnTermination': True},
+                                    'DeviceName': 'sda1'}}
+    comparator = mock.Mock(wraps=InstanceConfigComparator())
+    deduplicating_comparator = DeduplicatingConfigComparator(comparator)
+
+    results = [
+        deduplicating_comparator.compare(
+            make_comparable_instance(image_id='ami-old'), default_asg_config,
+            'userdata', make_volumes_dict('vol-%d' % i), config_volumes_dict)
+        for i in range(10)
+    ]
+
+    assert results == [['ImageId']] * 10
+    assert comparator.compare_to_config.call_count == 1
+    assert comparator.compare_volumes_config.call_count == 1
+
+    assert deduplicating_comparator.compare(
+        make_comparable_instance(image_id='ami-new'), default_asg_config,
+        'new userdata',
+        make_volumes_dict('vol-a', size='16'), config_volumes_dict
+    ) == ['UserData', 'sda1.BlockDeviceMappings.Ebs.Size']
+    assert comparator.compare_to_config.call_count == 2
+
+    assert deduplicating_comparator.compare(
+        make_comparable_instance(image_id='ami-new'), default_asg_config,
+        'userdata', make_volumes_dict('vol-b'), config_volumes_dict) == []
+    assert comparator.compare_to_config.call_count == 3
+
+
+def test_deduplicating_comparator_forgets_results_for_new_config(
+    default_asg_config
+):
+    comparator = mock.Mock(wraps=InstanceConfigComparator())
+    deduplicating_comparator = DeduplicatingConfigComparator(comparator)
+    instance = make_comparable_instance(image_id='ami-old')
+    default_asg_config['SecurityGroups'] = ['sg-1']
+    new_config = dict(default_asg_config, ImageId='ami-old')
+
+    assert deduplicating_comparator.compare(
+        instance, default_asg_config, 'userdata', {}, {}) == []
+    assert deduplicating_comparator.compare(
+        instance, new_config, 'userdata', {}, {}) == []
+    assert comparator.compare_to_config.call_count == 2
+
+
+def test_deduplicating_comparator_still_requires_attributes(
+    default_asg_config
+):
+    class Instance(object):
+        security_groups = []
+
+    with pytest.raises(AttributeError):
+        DeduplicatingConfigComparator().compare(
+            Instance(), dict(default_asg_config, ImageId='ami-1'),
+            'userdata', {}, {})
+
+
 ComparatorVolumeDeviceNamesParams = namedtuple(
     'ComparatorVolumeDeviceNamesParams',
     ['instance_device_keys', 'config_device_keys', 'expected_result']
@@ -554,6 +1218,27 @@ def mock_aws_manager():
     return mock.Mock(spec=AwsManager)
 
 
+def fake_group_instances(mock_aws_manager, instances):
+    """ Makes the mocked AwsManager find the given instances in the
+    autoscaling group, or those a function of no arguments gives each time.
+    """
+    get_instances = instances if callable(instances) else lambda: instances
+
+    def get_instances_for_asg(asg, instance_ids=None):
+        return [instance for instance in get_instances()
+                if instance_ids is None or instance.id in instance_ids]
+    mock_aws_manager.get_instances_for_asg.side_effect = get_instances_for_asg
+    mock_aws_manager.get_in_service_instance_ids.side_effect = lambda asg: [
+        instance.id for instance in get_instances()
+        if is_in_service(instance)]
+    mock_aws_manager.get_remaining_instance_ids.side_effect = lambda asg: [
+        instance.id for instance in get_instances()
+        if not is_terminating(instance)]
+    mock_aws_manager.get_instances.side_effect = lambda instance_ids: [
+        instance for instance in get_instances()
+        if instance.id in instance_ids]
+
+
 @pytest.fixture()
 def mock_instance_manager():
     return mock.Mock(spec=InstanceSshManager)
@@ -594,18 +1279,21 @@ def test_rum_waits_for_expected_number_of_instances_to_boot(
     mock_aws_manager
 
 ):
-    class Instance:
-        private_ip_address = '0.0.0.0'
-    mock_aws_manager.get_instances_for_asg.side_effect = (
-        [Instance()],
-        [Instance()],
-        [Instance(), Instance()],
-        [Instance(), Instance(), Instance()]
+    mock_aws_manager.get_in_service_instance_ids.side_effect = (
+        ['i-1'],
+        ['i-1'],
+        ['i-1', 'i-2'],
+        ['i-1', 'i-2', 'i-3']
     )
+    mock_aws_manager.get_instances.side_effect = lambda instance_ids: [
+        InstanceSnapshot.from_description({
+            'InstanceId': instance_id, 'LaunchTime': None,
+            'PrivateIpAddress': '0.0.0.0'})
+        for instance_id in instance_ids]
 
     rolling_upgrade_manager.wait_for_instances('test-asg', 3)
 
-    mock_aws_manager.get_instances_for_asg.assert_has_calls((
+    mock_aws_manager.get_in_service_instance_ids.assert_has_calls((
         mock.call('test-asg'),
         mock.call('test-asg'),
         mock.call('test-asg'),
@@ -613,12 +1301,70 @@ def test_rum_waits_for_expected_number_of_instances_to_boot(
     ))
 
 
+def test_rum_only_counts_instances_in_service_as_booted(
+    rolling_upgrade_manager,
+    mock_aws_manager,
+    mock_instance_manager
+):
+    Instance = namedtuple('Instance', ['id', 'private_ip_address',
+                                       'lifecycle_state'])
+    polls = iter((
+        [Instance('i-1', '10.0.0.1', 'InService'),
+         Instance('i-2', '10.0.0.2', 'Terminating')],
+        [Instance('i-1', '10.0.0.1', 'InService'),
+         Instance('i-3', '10.0.0.3', 'Pending')],
+        [Instance('i-1', '10.0.0.1', 'InService'),
+         Instance('i-3', '10.0.0.3', 'InService')],
+    ))
+    instances = []
+
+    def poll():
+        instances[:] = next(polls)
+        return [instance.id for instance in instances
+                if instance.lifecycle_state == 'InService']
+    fake_group_instances(mock_aws_manager, instances)
+    mock_aws_manager.get_in_service_instance_ids.side_effect = \
+        lambda asg: poll()
+    mock_instance_manager.is_ready.return_value = True
+
+    rolling_upgrade_manager.wait_for_instances('test-asg', 2)
+
+    assert mock_aws_manager.get_in_service_instance_ids.call_count == 3
+    mock_instance_manager.is_ready.assert_has_calls(
+        [mock.call('10.0.0.1'), mock.call('10.0.0.3')])
+
+
+def test_rum_only_looks_up_and_probes_instances_not_ready_yet(
+    rolling_upgrade_manager,
+    mock_aws_manager,
+    mock_instance_manager
+):
+    Instance = namedtuple('Instance', ['id', 'private_ip_address'])
+    instances = [Instance('i-1', '10.0.0.1'), Instance('i-2', '10.0.0.2')]
+    fake_group_instances(mock_aws_manager, instances)
+    mock_instance_manager.is_ready.side_effect = (True, False, False, True)
+
+    rolling_upgrade_manager.wait_for_instances('test-asg', 2)
+
+    assert mock_aws_manager.get_in_service_instance_ids.call_count == 3
+    assert not mock_aws_manager.get_instances_for_asg.called
+    mock_aws_manager.get_instances.assert_called_once_with(['i-1', 'i-2'])
+    assert mock_instance_manager.is_ready.call_args_list == [
+        mock.call('10.0.0.1'), mock.call('10.0.0.2'), mock.call('10.0.0.2'),
+        mock.call('10.0.0.2')]
+
+
 def test_rum_waits_for_instances_to_be_available(
     rolling_upgrade_manager,
     mock_instance_manager
 ):
+    instance_ids = itertools.count()
+
     class Instance:
         private_ip_address = '0.0.0.0'
+
+        def __init__(self):
+            self.id = 'i-%d' % next(instance_ids)
     mock_instance_manager.is_ready.side_effect = (True, True, False)
     assert not rolling_upgrade_manager.are_all_instances_ready(
         [Instance(), Instance(), Instance()]
@@ -639,6 +1385,55 @@ def test_rum_waits_for_instances_to_be_available(
     )
 
 
+def test_rum_only_probes_instances_until_ready(
+    rolling_upgrade_manager,
+    mock_instance_manager
+):
+    Instance = namedtuple('Instance', ['id', 'private_ip_address'])
+    instances = [Instance('i-1', '10.0.0.1'), Instance('i-2', '10.0.0.2')]
+    mock_instance_manager.is_ready.side_effect = (True, False, True)
+
+    assert not rolling_upgrade_manager.are_all_instances_ready(instances)
+    assert rolling_upgrade_manager.are_all_instances_ready(instances)
+    assert rolling_upgrade_manager.are_all_instances_ready(instances)
+
+    assert mock_instance_manager.is_ready.call_args_list == [
+        mock.call('10.0.0.1'), mock.call('10.0.0.2'), mock.call('10.0.0.2')]
+
+
+def test_rum_closes_sessions_of_instances_it_terminates(
+    rolling_upgrade_manager,
+    mock_instance_manager
+):
+    Instance = namedtuple('Instance', ['id', 'private_ip_address'])
+    instances = [Instance('i-1', '10.0.0.1'), Instance('i-2', '10.0.0.2')]
+    mock_instance_manager.is_ready.side_effect = (True, False)
+
+    assert not rolling_upgrade_manager.are_all_instances_ready(instances)
+    rolling_upgrade_manager.replace_instances(
+        {'AutoScalingGroupName': 'test-asg'}, ['i-1', 'i-2'], 2)
+
+    mock_instance_manager.close_session.assert_called_once_with('10.0.0.2')
+
+
+def test_rum_closes_sessions_once_upgrade_ends(
+    streamed_upgrade,
+    mock_instance_manager
+):
+    streamed_upgrade(diff_workers=1)
+
+    mock_instance_manager.close_connections.assert_called_once_with()
+
+
+def test_rum_can_keep_sessions_open_between_upgrades(
+    streamed_upgrade,
+    mock_instance_manager
+):
+    streamed_upgrade(diff_workers=1, close_sessions_after_upgrade=False)
+
+    assert not mock_instance_manager.close_connections.called
+
+
 def test_rum_gets_list_of_instances_to_upgrade(
     rolling_upgrade_manager,
     mock_aws_manager
@@ -649,10 +1444,14 @@ def test_rum_gets_list_of_instances_to_upgrade(
                  Instance('instance2'),
                  Instance('instance3')]
     rolling_upgrade_manager.compare_instance_to_config = mock.Mock()
-    mock_aws_manager.get_instances_for_asg.return_value = instances
+    fake_group_instances(mock_aws_manager, instances)
+
+    def diffs_by_instance(diffs):
+        return lambda instance, config: diffs[instance.id]
 
     rolling_upgrade_manager.compare_instance_to_config.side_effect = \
-        ([], [], ['diff'])
+        diffs_by_instance({'instance1': [], 'instance2': [],
+                           'instance3': ['diff']})
 
     result = rolling_upgrade_manager.get_instances_to_upgrade("test-asg", {})
 
@@ -660,7 +1459,8 @@ def test_rum_gets_list_of_instances_to_upgrade(
     assert instances[2] in result
 
     rolling_upgrade_manager.compare_instance_to_config.side_effect = \
-        (['diff1', 'diff2'], [], ['diff'])
+        diffs_by_instance({'instance1': ['diff1', 'diff2'], 'instance2': [],
+                           'instance3': ['diff']})
     result = rolling_upgrade_manager.get_instances_to_upgrade("test-asg", {})
 
     assert len(result) == 2
@@ -668,18 +1468,36 @@ def test_rum_gets_list_of_instances_to_upgrade(
     assert instances[2] in result
 
     rolling_upgrade_manager.compare_instance_to_config.side_effect = \
-        ([], [], [])
+        diffs_by_instance({'instance1': [], 'instance2': [], 'instance3': []})
     result = rolling_upgrade_manager.get_instances_to_upgrade("test-asg", {})
 
     assert len(result) == 0
 
-    mock_aws_manager.get_instances_for_asg.assert_has_calls((
+    mock_aws_manager.get_remaining_instance_ids.assert_has_calls((
         mock.call('test-asg'),
         mock.call('test-asg'),
         mock.call('test-asg'),
     ))
 
 
+def test_rum_diffs_concurrently_but_keeps_instance_order(
+    rolling_upgrade_manager,
+    mock_aws_manager
+):
+    Instance = namedtuple('Instance', ['id'])
+
+    instances = [Instance('instance%d' % i) for i in range(20)]
+    fake_group_instances(mock_aws_manager, instances)
+    rolling_upgrade_manager.compare_instance_to_config = mock.Mock(
+        side_effect=lambda instance, config:
+            ['diff'] if int(instance.id[8:]) % 2 else [])
+
+    result = rolling_upgrade_manager.get_instances_to_upgrade("test-asg", {})
+
+    assert result == instances[1::2]
+    assert rolling_upgrade_manager.compare_instance_to_config.call_count == 20
+
+
 def test_rum_gets_oldest_instance():
     Instance = namedtuple('Instance', ['launch_time'])
 
@@ -694,3 +1512,1676 @@ def test_rum_gets_oldest_instance():
 
     assert result in instances
     assert result == instances[1]
+
+
+AzInstance = namedtuple('AzInstance', ['id', 'launch_time', 'placement'])
+
+
+@pytest.fixture()
+def instances_in_azs():
+    return [
+        AzInstance('a-new', datetime(2016, 7, 26, 10, 30),
+                   {'AvailabilityZone': 'eu-west-1a'}),
+        AzInstance('a-old', datetime(2016, 7, 24, 5, 30),
+                   {'AvailabilityZone': 'eu-west-1a'}),
+        AzInstance('b-old', datetime(2016, 7, 26, 11, 0),
+                   {'AvailabilityZone': 'eu-west-1b'}),
+        AzInstance('c-old', datetime(2016, 7, 25, 10, 0),
+                   {'AvailabilityZone': 'eu-west-1c'}),
+        AzInstance('c-new', datetime(2016, 7, 27, 10, 0),
+                   {'AvailabilityZone': 'eu-west-1c'}),
+    ]
+
+
+@pytest.mark.parametrize('max_parallel_azs, expected_ids', [
+    (1, ['a-old']),
+    (2, ['a-old', 'c-old']),
+    (5, ['a-old', 'c-old', 'b-old']),
+])
+def test_rum_terminates_one_instance_per_az(
+    rolling_upgrade_manager,
+    instances_in_azs,
+    max_parallel_azs,
+    expected_ids
+):
+    rolling_upgrade_manager._max_parallel_azs = max_parallel_azs
+
+    result = rolling_upgrade_manager.get_instances_to_terminate(
+        instances_in_azs)
+
+    assert [instance.id for instance in result] == expected_ids
+
+
+def test_aws_gets_scaling_activities_in_progress(aws_manager, mock_as_client):
+    mock_as_client.describe_scaling_activities.return_value = {
+        'Activities': [
+            {'ActivityId': '1', 'StatusCode': 'Successful'},
+            {'ActivityId': '2', 'StatusCode': 'InProgress'},
+            {'ActivityId': '3', 'StatusCode': 'Cancelled'},
+            {'ActivityId': '4', 'StatusCode': 'MidLifecycleAction'},
+        ]
+    }
+
+    result = aws_manager.get_scaling_activities_in_progress(
+        {'AutoScalingGroupName': 'test-asg'})
+
+    assert [activity['ActivityId'] for activity in result] == ['2', '4']
+
+
+def test_rum_waits_for_scaling_activities_to_settle(
+    rolling_upgrade_manager,
+    mock_aws_manager
+):
+    mock_aws_manager.get_scaling_activities_in_progress.side_effect = (
+        [{'StatusCode': 'InProgress'}],
+        [{'StatusCode': 'InProgress'}],
+        []
+    )
+
+    rolling_upgrade_manager.wait_for_scaling_activities('test-asg')
+
+    assert mock_aws_manager.get_scaling_activities_in_progress.call_count == 3
+
+
+def test_rum_fails_when_scaling_activities_do_not_settle(
+    rolling_upgrade_manager,
+    mock_aws_manager
+):
+    mock_aws_manager.get_scaling_activities_in_progress.return_value = [
+        {'StatusCode': 'InProgress'}]
+
+    with pytest.raises(UpgradeFailed):
+        rolling_upgrade_manager.wait_for_scaling_activities('test-asg')
+
+    assert mock_aws_manager.get_scaling_activities_in_progress.call_count == \
+        40
+
+
+def test_aws_gets_warm_pool_instances_page_by_page(aws_manager,
+                                                  mock_as_client):
+    mock_as_client.describe_warm_pool.side_effect = (
+        {'Instances': [{'InstanceId': 'i-1'}], 'NextToken': 'page-2'},
+        {'Instances': [{'InstanceId': 'i-2'}]}
+    )
+
+    result = aws_manager.get_warm_pool_instances(
+        {'AutoScalingGroupName': 'test-asg'})
+
+    assert [warm['InstanceId'] for warm in result] == ['i-1', 'i-2']
+    assert mock_as_client.describe_warm_pool.call_args_list[1] == mock.call(
+        AutoScalingGroupName='test-asg', MaxRecords=100, NextToken='page-2')
+
+
+WARM_POOL_ASG = {
+    'AutoScalingGroupName': 'test-asg',
+    'DesiredCapacity': 3,
+    'MaxSize': 3,
+    'WarmPoolConfiguration': {'MinSize': 2, 'PoolState': 'Stopped'}
+}
+
+
+def test_rum_terminates_outdated_warm_pool_instances(
+    rolling_upgrade_manager,
+    mock_aws_manager
+):
+    mock_aws_manager.get_warm_pool_instances.return_value = [
+        {'InstanceId': 'i-old', 'LifecycleState': 'Warmed:Stopped',
+         'LaunchConfigurationName': 'lc-1'},
+        {'InstanceId': 'i-leaving', 'LifecycleState': 'Warmed:Terminating',
+         'LaunchConfigurationName': 'lc-1'},
+        {'InstanceId': 'i-new', 'LifecycleState': 'Warmed:Pending',
+         'LaunchConfigurationName': 'lc-2'},
+    ]
+
+    pool_config = rolling_upgrade_manager.prepare_warm_pool(
+        WARM_POOL_ASG, {'LaunchConfigurationName': 'lc-2'})
+
+    assert pool_config == WARM_POOL_ASG['WarmPoolConfiguration']
+    mock_aws_manager.terminate_instance.assert_called_once_with('i-old')
+    assert not mock_aws_manager.put_warm_pool.called
+
+
+@pytest.mark.parametrize('warm_pool_size,do_dry_run,expected_pool_config', [
+    (None, False, None),
+    (2, True, None),
+    (2, False, {'MinSize': 2}),
+])
+def test_rum_creates_warm_pool_only_if_asked(
+    rolling_upgrade_manager,
+    mock_aws_manager,
+    warm_pool_size,
+    do_dry_run,
+    expected_pool_config
+):
+    rolling_upgrade_manager._warm_pool_size = warm_pool_size
+    rolling_upgrade_manager._do_dry_run = do_dry_run
+    mock_aws_manager.get_warm_pool_instances.return_value = []
+    asg = {'AutoScalingGroupName': 'test-asg'}
+
+    pool_config = rolling_upgrade_manager.prepare_warm_pool(
+        asg, {'LaunchConfigurationName': 'lc-2'})
+
+    assert pool_config == expected_pool_config
+    assert mock_aws_manager.put_warm_pool.called == \
+        (expected_pool_config is not None)
+
+
+def test_rum_waits_for_warm_pool_to_refill(
+    rolling_upgrade_manager,
+    mock_aws_manager
+):
+    def warm_instance(instance_id, lifecycle_state, config_name='lc-2'):
+        return {'InstanceId': instance_id, 'LifecycleState': lifecycle_state,
+                'LaunchConfigurationName': config_name}
+
+    mock_aws_manager.get_warm_pool_instances.side_effect = (
+        [warm_instance('i-1', 'Warmed:Pending'),
+         warm_instance('i-2', 'Warmed:Stopped', 'lc-1')],
+        [warm_instance('i-1', 'Warmed:Stopped'),
+         warm_instance('i-3', 'Warmed:Pending')],
+        [warm_instance('i-1', 'Warmed:Stopped'),
+         warm_instance('i-3', 'Warmed:Hibernated')],
+    )
+
+    # Only 2 instances are kept in the pool, so no more are waited for
+    assert rolling_upgrade_manager.wait_for_warm_pool(
+        WARM_POOL_ASG, {'LaunchConfigurationName': 'lc-2'},
+        WARM_POOL_ASG['WarmPoolConfiguration'], 3)
+    assert mock_aws_manager.get_warm_pool_instances.call_count == 3
+
+
+def test_rum_gives_up_on_warm_pool_that_does_not_refill(
+    rolling_upgrade_manager,
+    mock_aws_manager
+):
+    rolling_upgrade_manager._max_wait_attempts = 3
+    mock_aws_manager.get_warm_pool_instances.return_value = []
+
+    assert not rolling_upgrade_manager.wait_for_warm_pool(
+        WARM_POOL_ASG, {'LaunchConfigurationName': 'lc-2'},
+        WARM_POOL_ASG['WarmPoolConfiguration'], 1)
+    assert mock_aws_manager.get_warm_pool_instances.call_count == 3
+
+
+def test_aws_gets_target_states_in_one_call(mock_as_client, mock_ec2_client):
+    mock_elb_client = mock.Mock()
+    mock_elb_client.describe_target_health.return_value = {
+        'TargetHealthDescriptions': [
+            {'Target': {'Id': 'i-1'}, 'TargetHealth': {'State': 'draining'}},
+            {'Target': {'Id': 'i-2'}, 'TargetHealth': {'State': 'healthy'}},
+        ]
+    }
+    aws_manager = AwsManager()
+    aws_manager.connect(autoscaling_client=mock_as_client,
+                        ec2_client=mock_ec2_client,
+                        elb_client=mock_elb_client)
+
+    result = aws_manager.get_target_states('tg-arn', ['i-1', 'i-2'])
+
+    assert result == {'i-1': 'draining', 'i-2': 'healthy'}
+    mock_elb_client.describe_target_health.assert_called_once_with(
+        TargetGroupArn='tg-arn', Targets=[{'Id': 'i-1'}, {'Id': 'i-2'}])
+
+
+def test_aws_detaches_instance_keeping_desired_capacity(aws_manager,
+                                                        mock_as_client):
+    aws_manager.detach_instance({'AutoScalingGroupName': 'test-asg'}, 'i-1')
+
+    mock_as_client.detach_instances.assert_called_once_with(
+        AutoScalingGroupName='test-asg', InstanceIds=['i-1'],
+        ShouldDecrementDesiredCapacity=False)
+
+
+def test_rum_terminates_instances_straight_away_by_default(
+    rolling_upgrade_manager,
+    mock_aws_manager
+):
+    rolling_upgrade_manager.replace_instances(
+        {'AutoScalingGroupName': 'test-asg'}, ['i-1'], 1)
+
+    mock_aws_manager.terminate_instance.assert_called_once_with('i-1')
+    assert not mock_aws_manager.detach_instance.called
+
+
+def test_rum_drains_instances_while_replacements_boot(
+    rolling_upgrade_manager,
+    mock_aws_manager,
+    mock_instance_manager
+):
+    Instance = namedtuple('Instance', ['id', 'private_ip_address'])
+    asg = {'AutoScalingGroupName': 'test-asg',
+           'TargetGroupARNs': ['tg-1', 'tg-2']}
+    events = []
+    mock_aws_manager.detach_instance.side_effect = \
+        lambda asg, instance_id: events.append('detach ' + instance_id)
+    mock_aws_manager.terminate_instance.side_effect = \
+        lambda instance_id: events.append('terminate ' + instance_id)
+    fake_group_instances(mock_aws_manager, [
+        Instance('i-2', '10.0.0.2')])
+    mock_instance_manager.is_ready.side_effect = \
+        lambda ip: events.append('ready ' + ip) or True
+    mock_aws_manager.get_target_states.side_effect = (
+        {'i-1': 'draining', 'i-2': 'healthy'},
+        {'i-1': 'unused', 'i-2': 'initial'},
+        {'i-1': 'unused', 'i-2': 'healthy'},
+        {'i-1': 'unused', 'i-2': 'healthy'},
+    )
+    rolling_upgrade_manager._overlap_draining = True
+
+    rolling_upgrade_manager.replace_instances(asg, ['i-1'], 1)
+
+    assert events == ['detach i-1', 'ready 10.0.0.2', 'terminate i-1']
+    assert mock_aws_manager.get_target_states.call_args_list == [
+        mock.call('tg-1', ['i-1', 'i-2']), mock.call('tg-2', ['i-1', 'i-2'])
+    ] * 2
+
+
+def test_rum_refuses_to_drain_without_target_groups(
+    rolling_upgrade_manager,
+    mock_aws_manager
+):
+    rolling_upgrade_manager._overlap_draining = True
+
+    with pytest.raises(UpgradeFailed):
+        rolling_upgrade_manager.replace_instances(
+            {'AutoScalingGroupName': 'test-asg', 'TargetGroupARNs': []},
+            ['i-1'], 1)
+    with pytest.raises(UpgradeFailed):
+        rolling_upgrade_manager.wait_for_draining(
+            {'AutoScalingGroupName': 'test-asg'}, ['i-1'])
+
+    assert not mock_aws_manager.detach_instance.called
+    assert not mock_aws_manager.terminate_instance.called
+
+
+def test_progress_events_are_only_built_for_subscribers():
+    clock = mock.Mock(return_value=12.5)
+    events = ProgressEvents(clock=clock)
+
+    events.emit(INSTANCE_TERMINATED, instance_id='i-1')
+    assert not clock.called
+
+    received = []
+    events.subscribe(received.append)
+    events.emit(INSTANCE_TERMINATED, instance_id='i-2')
+    events.unsubscribe(received.append)
+    events.emit(INSTANCE_TERMINATED, instance_id='i-3')
+
+    assert received == [
+        ProgressEvent(INSTANCE_TERMINATED, 12.5, {'instance_id': 'i-2'})]
+    assert not events.has_subscribers()
+
+
+def test_json_lines_sink_writes_one_event_per_line(tmpdir):
+    path = str(tmpdir.join('events.jsonl'))
+    sink = JsonLinesSink(path)
+
+    sink(ProgressEvent(INSTANCE_STALE, 1.0,
+                       {'instance_id': 'i-1', 'differences': ['ImageId']}))
+    sink(ProgressEvent(INSTANCE_TERMINATED, 2.0, {'instance_id': 'i-1'}))
+    sink.close()
+
+    with open(path) as events_file:
+        assert [json.loads(line) for line in events_file] == [
+            {'event': 'instance_stale', 'time': 1.0, 'instance_id': 'i-1',
+             'differences': ['ImageId']},
+            {'event': 'instance_terminated', 'time': 2.0,
+             'instance_id': 'i-1'},
+        ]
+
+
+def test_console_reporter_writes_a_line_per_reported_event():
+    stream = mock.Mock()
+    reporter = ConsoleReporter(stream)
+
+    reporter(ProgressEvent(INSTANCE_STALE, 1.0,
+                           {'instance_id': 'i-1', 'differences': ['ImageId']}))
+    reporter(ProgressEvent(WAIT_ATTEMPT, 2.0, {
+        'phase': 'boot', 'attempt': 1, 'max_attempts': 40,
+        'num_instances': 2, 'expected_num_instances': 3}))
+    reporter(ProgressEvent(INSTANCES_READY, 3.0, {'instance_ids': ['i-2']}))
+    reporter(ProgressEvent(UPGRADE_FINISHED, 4.0, {
+        'asg_name': 'test-asg', 'dry_run': False, 'instances_replaced': 1,
+        'batches': []}))
+
+    assert [call[0][0] for call in stream.write.call_args_list] == [
+        'Instance i-1 does not match the launch configuration: ImageId\n',
+        '2 instances have booted - Waiting for 1 more, attempt 1 of 40\n',
+        '=== All instances have completed cloud-init ===\n',
+        '=== Upgrade of test-asg finished, 1 instance(s) replaced ===\n',
+    ]
+
+
+def test_rum_writes_nothing_to_stdout(streamed_upgrade, capsys):
+    streamed_upgrade(diff_workers=1)
+
+    assert capsys.readouterr() == ('', '')
+
+
+def test_rum_reports_progress_events(streamed_upgrade):
+    received = []
+
+    streamed_upgrade(diff_workers=1, subscriber=received.append)
+
+    assert [(event.kind, event.fields.get('instance_id'))
+            for event in received] == [
+        (UPGRADE_STARTED, None),
+        (INSTANCES_BOOTED, None), (INSTANCES_READY, None),
+        (INSTANCE_STALE, 'i-2'), (INSTANCE_TERMINATED, 'i-2'),
+        (INSTANCES_BOOTED, None), (INSTANCES_READY, None),
+        (INSTANCE_STALE, 'i-3'), (INSTANCE_TERMINATED, 'i-3'),
+        (INSTANCES_BOOTED, None), (INSTANCES_READY, None),
+        (UPGRADE_FINISHED, None),
+    ]
+    assert received[-2].fields['instance_ids'] == ['i-1', 'new-i-2', 'new-i-3']
+
+
+def test_rum_only_formats_debug_messages_when_debugging(
+    rolling_upgrade_manager,
+    mock_aws_manager,
+    monkeypatch
+):
+    mock_pformat = mock.Mock(return_value='[activity]')
+    monkeypatch.setattr(log.pprint, 'pformat', mock_pformat)
+    mock_aws_manager.get_scaling_activities_in_progress.side_effect = (
+        [{'StatusCode': 'InProgress'}], [],
+        [{'StatusCode': 'InProgress'}], [],
+    )
+    manager_logger = logging.getLogger(RollingUpgradeManager.__module__)
+
+    rolling_upgrade_manager.wait_for_scaling_activities('test-asg')
+    assert not mock_pformat.called
+
+    messages = []
+    handler = logging.Handler()
+    handler.emit = lambda record: messages.append(record.getMessage())
+    monkeypatch.setattr(manager_logger, 'level', logging.DEBUG)
+    manager_logger.addHandler(handler)
+    try:
+        rolling_upgrade_manager.wait_for_scaling_activities('test-asg')
+    finally:
+        manager_logger.removeHandler(handler)
+    assert messages == ['Activities: [activity]']
+
+
+def test_rate_limiting_filter_holds_back_repeated_messages():
+    clock = FakeClock()
+    rate_limiting_filter = log.RateLimitingFilter(interval_s=60, clock=clock)
+
+    def make_record(*args):
+        return logging.LogRecord('manager', logging.DEBUG,
+                                 __file__, 1, 'Instances: %s', args, None)
+
+    assert rate_limiting_filter.filter(make_record('[i-1]'))
+    clock.now += 30
+    assert not rate_limiting_filter.filter(make_record('[i-1]'))
+    assert not rate_limiting_filter.filter(make_record('[i-1]'))
+    assert rate_limiting_filter.filter(make_record('[i-2]'))
+    clock.now += 30
+
+    record = make_record('[i-1]')
+    assert rate_limiting_filter.filter(record)
+    assert record.getMessage() == 'Instances: [i-1] (repeated 2 more time(s))'
+
+
+def test_rate_limiting_filter_forgets_old_messages():
+    clock = FakeClock()
+    rate_limiting_filter = log.RateLimitingFilter(interval_s=60, clock=clock)
+
+    for index in range(1000):
+        assert rate_limiting_filter.filter(logging.LogRecord(
+            'manager', logging.DEBUG, __file__, 1, 'Instance %d', (index,),
+            None))
+        clock.now += 1
+
+    assert len(rate_limiting_filter._seen) <= 3 * 60
+
+
+def test_scheduler_pops_in_priority_order_and_tracks_changes(
+    instances_in_azs
+):
+    scheduler = ReplacementScheduler()
+    scheduler.update(instances_in_azs)
+
+    assert len(scheduler) == 5
+    assert scheduler.pop().id == 'a-old'
+
+    # a-old has gone, c-old was replaced, and a newcomer is now stale
+    newcomer = AzInstance('b-oldest', datetime(2016, 7, 1),
+                          {'AvailabilityZone': 'eu-west-1b'})
+    scheduler.update([instance for instance in instances_in_azs
+                      if instance.id not in ('a-old', 'c-old')] + [newcomer])
+
+    assert [scheduler.pop().id for _ in range(4)] == \
+        ['b-oldest', 'a-new', 'b-old', 'c-new']
+    assert scheduler.pop() is None
+
+
+def test_scheduler_orders_by_tag_priority():
+    TaggedInstance = namedtuple('TaggedInstance', ['id', 'launch_time',
+                                                   'tags'])
+    instances = [
+        TaggedInstance('leader', datetime(2016, 7, 1),
+                       [{'Key': 'RollingUpgradePriority', 'Value': '1'}]),
+        TaggedInstance('follower-new', datetime(2016, 7, 3), None),
+        TaggedInstance('follower-old', datetime(2016, 7, 2),
+                       [{'Key': 'Name', 'Value': 'rabbit'}]),
+    ]
+    scheduler = ReplacementScheduler(tag_priority())
+    scheduler.update(instances)
+
+    assert [scheduler.pop().id for _ in range(3)] == \
+        ['follower-old', 'follower-new', 'leader']
+
+
+def test_scheduler_orders_by_az_balance(instances_in_azs):
+    scheduler = ReplacementScheduler(az_balance(), rebuild_on_update=True)
+    scheduler.update(instances_in_azs)
+
+    assert [scheduler.pop().id for _ in range(2)] == ['a-old', 'c-old']
+
+    # AZ b now has as many instances left as the others
+    scheduler.update([instances_in_azs[0], instances_in_azs[2],
+                      instances_in_azs[4]])
+    assert scheduler.pop().id == 'a-new'
+
+
+def test_rum_balances_azs_when_asked_to(mock_instance_manager):
+    rolling_upgrade_manager = RollingUpgradeManager(
+        ssh_config=None,
+        aws_manager=mock.Mock(spec=AwsManager),
+        instance_manager=mock_instance_manager,
+        replacement_order='az_balance'
+    )
+    instances = [
+        AzInstance('b-oldest', datetime(2016, 7, 1),
+                   {'AvailabilityZone': 'eu-west-1b'}),
+        AzInstance('a-older', datetime(2016, 7, 2),
+                   {'AvailabilityZone': 'eu-west-1a'}),
+        AzInstance('a-newer', datetime(2016, 7, 3),
+                   {'AvailabilityZone': 'eu-west-1a'}),
+    ]
+
+    result = rolling_upgrade_manager.get_instances_to_terminate(instances)
+
+    assert result[0].id == 'a-older'
+
+
+def test_rum_rejects_unknown_replacement_order(mock_instance_manager):
+    with pytest.raises(ValueError):
+        RollingUpgradeManager(
+            ssh_config=None,
+            aws_manager=mock.Mock(spec=AwsManager),
+            instance_manager=mock_instance_manager,
+            replacement_order='random'
+        )
+
+
+@pytest.fixture()
+def journal(tmpdir):
+    return UpgradeJournal(str(tmpdir.join('upgrade.journal')))
+
+
+def test_journal_starts_from_scratch(journal):
+    state = journal.resume('test-asg', 'fingerprint')
+
+    assert state.phase is None
+    assert state.diffs == {}
+    assert journal.read()[0]['event'] == 'started'
+
+
+def test_journal_resumes_recorded_progress(journal):
+    journal.resume('test-asg', 'fingerprint')
+    journal.record('compared', instance_id='i-1', diffs=['ImageId'])
+    journal.record('compared', instance_id='i-2', diffs=[])
+    journal.record('ready', instance_ids=['i-1', 'i-2'])
+    journal.record('terminated', instance_id='i-1')
+
+    state = journal.resume('test-asg', 'fingerprint')
+
+    assert state.phase == 'terminated'
+    assert state.diffs == {'i-1': ['ImageId'], 'i-2': []}
+    assert state.terminated == set(['i-1'])
+    assert state.ready_instance_ids is None
+
+    journal.record('ready', instance_ids=['i-2', 'i-3'])
+    assert journal.resume('test-asg', 'fingerprint').ready_instance_ids == \
+        ['i-2', 'i-3']
+
+
+def test_journal_resumes_instances_detached_but_not_terminated(journal):
+    journal.resume('test-asg', 'fingerprint')
+    journal.record('detached', instance_id='i-1')
+    journal.record('detached', instance_id='i-2')
+    journal.record('terminated', instance_id='i-1')
+
+    assert journal.resume('test-asg', 'fingerprint').detached == set(['i-2'])
+
+
+@pytest.mark.parametrize('asg_name, fingerprint', [
+    ('other-asg', 'fingerprint'),
+    ('test-asg', 'new-fingerprint'),
+])
+def test_journal_discards_progress_for_other_upgrade(
+    journal,
+    asg_name,
+    fingerprint
+):
+    journal.resume('test-asg', 'fingerprint')
+    journal.record('compared', instance_id='i-1', diffs=['ImageId'])
+
+    state = journal.resume(asg_name, fingerprint)
+
+    assert state.phase is None
+    assert state.diffs == {}
+    assert len(journal.read()) == 1
+
+
+def test_journal_ignores_partially_written_entry(journal, tmpdir):
+    journal.resume('test-asg', 'fingerprint')
+    journal.record('compared', instance_id='i-1', diffs=[])
+    tmpdir.join('upgrade.journal').write('{"event": "comp', mode='a')
+
+    assert [entry['event'] for entry in journal.read()] == \
+        ['started', 'compared']
+
+
+def test_config_fingerprint_depends_on_contents():
+    config = {'ImageId': 'ami-1', 'CreatedTime': datetime(2016, 7, 26)}
+
+    assert get_config_fingerprint(config) == \
+        get_config_fingerprint(dict(config))
+    assert get_config_fingerprint(config) != \
+        get_config_fingerprint(dict(config, ImageId='ami-2'))
+
+
+def test_rum_resumes_without_repeating_finished_work(
+    mock_aws_manager,
+    mock_instance_manager,
+    journal
+):
+    Instance = namedtuple('Instance', ['id', 'private_ip_address',
+                                       'launch_time'])
+    instances = [Instance('i-1', '10.0.0.1', datetime(2016, 7, 1)),
+                 Instance('i-2', '10.0.0.2', datetime(2016, 7, 2))]
+    asg = {'AutoScalingGroupName': 'test-asg'}
+    config = {'ImageId': 'ami-new'}
+
+    journal.resume('test-asg', get_config_fingerprint(config))
+    journal.record('compared', instance_id='i-1', diffs=[])
+    journal.record('ready', instance_ids=['i-1', 'i-2'])
+
+    mock_aws_manager.find_asg_group.return_value = [asg]
+    mock_aws_manager.get_launch_config_for_asg.return_value = config
+    mock_aws_manager.get_expected_num_of_instances.return_value = 2
+    fake_group_instances(mock_aws_manager, instances)
+
+    rolling_upgrade_manager = RollingUpgradeManager(
+        ssh_config=None,
+        aws_manager=mock_aws_manager,
+        instance_manager=mock_instance_manager,
+        sleep_time_s=0,
+        journal=journal
+    )
+    rolling_upgrade_manager.compare_instance_to_config = mock.Mock(
+        return_value=[])
+
+    rolling_upgrade_manager.perform_rolling_upgrade_where_needed('test-asg')
+
+    rolling_upgrade_manager.compare_instance_to_config.assert_called_once_with(
+        instances[1], config)
+    assert not mock_instance_manager.is_ready.called
+    assert journal.read() == []
+
+
+PlanInstance = namedtuple('PlanInstance', ['id', 'launch_time', 'placement',
+                                           'private_ip_address'])
+
+
+@pytest.fixture()
+def planned_upgrade(mock_aws_manager, mock_instance_manager):
+    instances = [
+        PlanInstance('i-1', datetime(2016, 7, 25),
+                     {'AvailabilityZone': 'eu-west-1a'}, '10.0.0.1'),
+        PlanInstance('i-2', datetime(2016, 7, 24),
+                     {'AvailabilityZone': 'eu-west-1a'}, '10.0.0.2'),
+        PlanInstance('i-3', datetime(2016, 7, 26),
+                     {'AvailabilityZone': 'eu-west-1b'}, '10.0.0.3'),
+        PlanInstance('i-4', datetime(2016, 7, 23),
+                     {'AvailabilityZone': 'eu-west-1b'}, '10.0.0.4'),
+    ]
+    config = {'LaunchConfigurationName': 'test-lc', 'ImageId': 'ami-new'}
+    mock_aws_manager.find_asg_group.return_value = [
+        {'AutoScalingGroupName': 'test-asg'}]
+    mock_aws_manager.get_launch_config_for_asg.return_value = config
+    mock_aws_manager.get_expected_num_of_instances.return_value = 4
+    fake_group_instances(mock_aws_manager, instances)
+    mock_aws_manager.get_scaling_activities_in_progress.return_value = []
+    mock_instance_manager.is_ready.return_value = True
+
+    rolling_upgrade_manager = RollingUpgradeManager(
+        ssh_config=None,
+        aws_manager=mock_aws_manager,
+        instance_manager=mock_instance_manager,
+        sleep_time_s=0,
+        max_parallel_azs=2
+    )
+    rolling_upgrade_manager.compare_instance_to_config = mock.Mock(
+        side_effect=lambda instance, config:
+            [] if instance.id == 'i-3' else ['ImageId'])
+    return rolling_upgrade_manager
+
+
+def test_rum_makes_upgrade_plan(planned_upgrade):
+    plan = planned_upgrade.make_upgrade_plan('test-asg')
+
+    assert plan['asg_name'] == 'test-asg'
+    assert plan['instance_ids'] == ['i-1', 'i-2', 'i-3', 'i-4']
+    assert [instance['id'] for instance in plan['instances_to_upgrade']] == \
+        ['i-1', 'i-2', 'i-4']
+    assert plan['instances_to_upgrade'][0]['differences'] == ['ImageId']
+    assert plan['batches'] == [['i-4', 'i-2'], ['i-1']]
+
+
+def test_rum_executes_upgrade_plan_without_comparing_again(
+    planned_upgrade,
+    mock_aws_manager
+):
+    plan = planned_upgrade.make_upgrade_plan('test-asg')
+    planned_upgrade.compare_instance_to_config.reset_mock()
+
+    planned_upgrade.execute_upgrade_plan(plan)
+
+    mock_aws_manager.terminate_instance.assert_has_calls(
+        [mock.call('i-4'), mock.call('i-2'), mock.call('i-1')])
+    assert not planned_upgrade.compare_instance_to_config.called
+
+
+@pytest.mark.parametrize('drift', [
+    {'config_fingerprint': 'other'},
+    {'instance_ids': ['i-1', 'i-2', 'i-3', 'i-5']},
+])
+def test_rum_refuses_plan_if_asg_has_drifted(
+    planned_upgrade,
+    mock_aws_manager,
+    drift
+):
+    plan = planned_upgrade.make_upgrade_plan('test-asg')
+    plan.update(drift)
+
+    with pytest.raises(Exception):
+        planned_upgrade.execute_upgrade_plan(plan)
+
+    assert not mock_aws_manager.terminate_instance.called
+
+
+def test_rum_streamed_upgrade_replaces_in_plan_order(
+    planned_upgrade,
+    mock_aws_manager
+):
+    plan = planned_upgrade.make_upgrade_plan('test-asg')
+    instances = mock_aws_manager.get_instances_for_asg(
+        {'AutoScalingGroupName': 'test-asg'})
+
+    def terminate_instance(instance_id):
+        terminated, = [instance for instance in instances
+                       if instance.id == instance_id]
+        instances.remove(terminated)
+        instances.append(terminated._replace(id='new-' + instance_id))
+
+    mock_aws_manager.terminate_instance.side_effect = terminate_instance
+    planned_upgrade.compare_instance_to_config.side_effect = \
+        lambda instance, config: [] if instance.id == 'i-3' or \
+        instance.id.startswith('new-') else ['ImageId']
+
+    planned_upgrade.perform_rolling_upgrade_where_needed('test-asg')
+
+    assert [call[0][0] for call in
+            mock_aws_manager.terminate_instance.call_args_list] == \
+        [instance_id for batch in plan['batches'] for instance_id in batch]
+
+
+def test_rum_dry_run_stops_after_first_cycle(planned_upgrade,
+                                             mock_aws_manager):
+    planned_upgrade._do_dry_run = True
+
+    planned_upgrade.perform_rolling_upgrade_where_needed('test-asg')
+
+    assert not mock_aws_manager.terminate_instance.called
+
+
+@pytest.fixture()
+def streamed_upgrade(mock_aws_manager, mock_instance_manager):
+    instances = [PlanInstance('i-%d' % day, datetime(2016, 7, day),
+                              {'AvailabilityZone': 'eu-west-1a'}, None)
+                 for day in (1, 2, 3)]
+    events = []
+
+    def terminate_instance(instance_id):
+        events.append('terminate ' + instance_id)
+        instances[:] = [instance for instance in instances
+                        if instance.id != instance_id] + [
+            PlanInstance('new-' + instance_id, datetime(2016, 8, 1),
+                         {'AvailabilityZone': 'eu-west-1a'}, None)]
+
+    def compare_instance_to_config(instance, config):
+        events.append('compare ' + instance.id)
+        if instance.id.startswith('new-') or instance.id == 'i-1':
+            return []
+        return ['ImageId']
+
+    mock_aws_manager.find_asg_group.return_value = [
+        {'AutoScalingGroupName': 'test-asg'}]
+    mock_aws_manager.get_launch_config_for_asg.return_value = {}
+    mock_aws_manager.get_expected_num_of_instances.return_value = 3
+    fake_group_instances(mock_aws_manager, lambda: list(instances))
+    mock_aws_manager.get_scaling_activities_in_progress.return_value = []
+    mock_aws_manager.terminate_instance.side_effect = terminate_instance
+    mock_instance_manager.is_ready.return_value = True
+
+    def upgrade(diff_workers, subscriber=None, max_parallel_azs=1,
+                **options):
+        rolling_upgrade_manager = RollingUpgradeManager(
+            ssh_config=None,
+            aws_manager=mock_aws_manager,
+            instance_manager=mock_instance_manager,
+            sleep_time_s=0,
+            diff_workers=diff_workers,
+            max_parallel_azs=max_parallel_azs,
+            **options
+        )
+        rolling_upgrade_manager.compare_instance_to_config = mock.Mock(
+            side_effect=compare_instance_to_config)
+        if subscriber is not None:
+            rolling_upgrade_manager.events.subscribe(subscriber)
+        rolling_upgrade_manager.perform_rolling_upgrade_where_needed(
+            'test-asg')
+        return events
+    return upgrade
+
+
+def test_rum_reports_each_stale_instance_once(streamed_upgrade):
+    received = []
+
+    # i-3 is skipped on the first cycle, as i-2 is in the same AZ
+    streamed_upgrade(diff_workers=1, subscriber=received.append,
+                     max_parallel_azs=2)
+
+    assert [event.fields['instance_id'] for event in received
+            if event.kind == INSTANCE_STALE] == ['i-2', 'i-3']
+
+
+def test_rum_terminates_stale_instances_as_soon_as_they_are_found(
+    streamed_upgrade
+):
+    assert streamed_upgrade(diff_workers=1) == [
+        'compare i-1', 'compare i-2', 'terminate i-2',
+        'compare i-3', 'terminate i-3',
+        'compare new-i-2', 'compare new-i-3']
+
+
+def test_rum_streams_concurrent_comparisons_in_priority_order(
+    streamed_upgrade
+):
+    events = streamed_upgrade(diff_workers=4)
+
+    assert [event for event in events if event.startswith('terminate')] == \
+        ['terminate i-2', 'terminate i-3']
+    assert sorted(events).count('compare i-1') == 1
+
+
+IMPORT_TIME_BUDGET_S = 0.25
+
+HEAVY_MODULES = ('boto3', 'botocore', 'paramiko', 'cryptography')
+
+
+def test_cli_import_stays_within_budget():
+    script = (
+        'import sys, time\n'
+        'start = time.time()\n'
+        'import rolling_upgrade.cli\n'
+        'print(time.time() - start)\n'
+        'print(",".join(name for name in %r if name in sys.modules))\n'
+        % (HEAVY_MODULES,)
+    )
+    output = subprocess.check_output(
+        [sys.executable, '-c', script],
+        cwd=os.path.dirname(os.path.abspath(__file__))
+    ).decode('utf-8').splitlines()
+
+    assert output[1] == ''
+    assert float(output[0]) < IMPORT_TIME_BUDGET_S
+
+
+def test_rum_only_loads_ssh_when_probing(mock_aws_manager):
+    rolling_upgrade_manager = RollingUpgradeManager(
+        ssh_config=SshEnvConfig(
+            username='test_user',
+            private_key_file_path='/path/to/key',
+            environment='TestEnv',
+            remote_port=22,
+            use_bastion_tunnel=False
+        ),
+        aws_manager=mock_aws_manager
+    )
+
+    assert rolling_upgrade_manager._instance_manager is None
+    assert isinstance(rolling_upgrade_manager._get_instance_manager(),
+                      InstanceSshManager)
+
+
+def test_changed_launch_config_fields_ignore_identity():
+    old_config = {'LaunchConfigurationName': 'lc-1', 'ImageId': 'ami-1',
+                  'UserData': 'userdata', 'CreatedTime': datetime(2016, 7, 1)}
+    new_config = {'LaunchConfigurationName': 'lc-2', 'ImageId': 'ami-2',
+                  'UserData': 'userdata', 'CreatedTime': datetime(2016, 7, 2),
+                  'KeyName': 'crunch-dev'}
+
+    assert get_changed_launch_config_fields(old_config, new_config) == \
+        ['ImageId', 'KeyName']
+
+
+@pytest.fixture()
+def delta_upgrade(mock_aws_manager):
+    mock_aws_manager.config_volumes_to_dict.return_value = {}
+    mock_aws_manager.get_userdata_for_instance.return_value = 'userdata'
+    mock_aws_manager.get_volumes_dict_for_instance.return_value = {}
+    return RollingUpgradeManager(
+        ssh_config=None,
+        aws_manager=mock_aws_manager,
+        instance_manager=mock.Mock(spec=InstanceSshManager)
+    )
+
+
+DeltaInstance = namedtuple('DeltaInstance', [
+    'id', 'launch_configuration_name', 'security_groups', 'image_id',
+    'instance_type', 'kernel_id', 'key_name'])
+
+
+def make_delta_instance(instance_id, config_name):
+    return DeltaInstance(instance_id, config_name, [], 'ami-1', 't2.micro',
+                         '', 'key')
+
+
+@pytest.fixture()
+def delta_configs():
+    old_config = {'LaunchConfigurationName': 'lc-old', 'ImageId': 'ami-1',
+                  'InstanceType': 't2.micro', 'KernelId': '', 'KeyName': 'key',
+                  'SecurityGroups': [], 'UserData': 'userdata',
+                  'BlockDeviceMappings': []}
+    new_config = dict(old_config, LaunchConfigurationName='lc-new',
+                      ImageId='ami-2')
+    return old_config, new_config
+
+
+def test_rum_skips_lookups_for_unchanged_config_fields(
+    delta_upgrade,
+    mock_aws_manager,
+    delta_configs
+):
+    old_config, new_config = delta_configs
+    mock_aws_manager.get_launch_configs.return_value = {'lc-old': old_config}
+    instances = [make_delta_instance('i-%d' % i, 'lc-old') for i in range(3)]
+    fake_group_instances(mock_aws_manager, instances)
+
+    result = delta_upgrade.get_instances_to_upgrade('test-asg', new_config)
+
+    assert result == instances
+    mock_aws_manager.get_launch_configs.assert_called_once_with(['lc-old'])
+    assert not mock_aws_manager.get_userdata_for_instance.called
+    assert not mock_aws_manager.get_volumes_dict_for_instance.called
+
+
+def test_rum_looks_up_only_changed_config_fields(
+    delta_upgrade,
+    mock_aws_manager,
+    delta_configs
+):
+    old_config, new_config = delta_configs
+    new_config['UserData'] = 'new userdata'
+    mock_aws_manager.get_launch_configs.return_value = {'lc-old': old_config}
+    instances = [make_delta_instance('i-1', 'lc-old'),
+                 make_delta_instance('i-2', 'lc-deleted'),
+                 make_delta_instance('i-3', None)]
+    fake_group_instances(mock_aws_manager, instances)
+
+    delta_upgrade.get_instances_to_upgrade('test-asg', new_config)
+
+    mock_aws_manager.get_launch_configs.assert_called_once_with(
+        ['lc-deleted', 'lc-old'])
+    assert mock_aws_manager.get_userdata_for_instance.call_count == 3
+    mock_aws_manager.get_volumes_dict_for_instance.assert_has_calls(
+        [mock.call(instances[1]), mock.call(instances[2])], any_order=True)
+    assert mock_aws_manager.get_volumes_dict_for_instance.call_count == 2
+
+
+def test_rum_trusts_instances_launched_with_current_config(
+    delta_upgrade,
+    mock_aws_manager,
+    delta_configs
+):
+    old_config, new_config = delta_configs
+    instance = make_delta_instance('i-1', 'lc-new')
+    fake_group_instances(mock_aws_manager, [instance])
+
+    assert delta_upgrade.get_instances_to_upgrade('test-asg', new_config) == \
+        [instance]
+
+    assert not mock_aws_manager.get_launch_configs.called
+    assert not mock_aws_manager.get_userdata_for_instance.called
+    assert not mock_aws_manager.get_volumes_dict_for_instance.called
+
+
+CachedInstance = namedtuple('CachedInstance', ['id', 'launch_time'])
+
+
+def test_diff_cache_persists_between_runs(tmpdir):
+    instance = CachedInstance('i-1', datetime(2016, 7, 26))
+    cache = DiffCache(str(tmpdir.join('cache')))
+    cache.put(instance, 'fingerprint', ['ImageId'])
+    cache.save()
+
+    cache = DiffCache(str(tmpdir.join('cache')))
+    assert cache.get(instance, 'fingerprint') == ['ImageId']
+    assert cache.get(instance, 'new-fingerprint') is None
+    assert cache.get(instance._replace(launch_time=datetime(2016, 7, 27)),
+                     'fingerprint') is None
+
+
+def test_diff_cache_is_not_rewritten_when_nothing_was_added(tmpdir):
+    instance = CachedInstance('i-1', datetime(2016, 7, 26))
+    cache = DiffCache(str(tmpdir))
+    cache.put(instance, 'fingerprint', ['ImageId'])
+    cache.save()
+    cache_file = tmpdir.join(DiffCache.FILE_NAME)
+    cache_file.setmtime(0)
+
+    cache = DiffCache(str(tmpdir))
+    assert cache.get(instance, 'fingerprint') == ['ImageId']
+    cache.save()
+
+    assert cache_file.mtime() == 0
+
+
+def test_diff_cache_evicts_least_recently_used(tmpdir, monkeypatch):
+    from rolling_upgrade import cache as cache_module
+    now = [0]
+    monkeypatch.setattr(cache_module, 'time', lambda: now[0])
+    instances = [CachedInstance('i-%d' % i, None) for i in range(3)]
+    cache = DiffCache(str(tmpdir), max_entries=2)
+    for instance in instances:
+        now[0] += 1
+        cache.put(instance, 'fingerprint', [])
+    now[0] += 1
+    cache.get(instances[0], 'fingerprint')
+    cache.save()
+
+    cache = DiffCache(str(tmpdir), max_entries=2)
+    assert cache.get(instances[0], 'fingerprint') == []
+    assert cache.get(instances[1], 'fingerprint') is None
+    assert cache.get(instances[2], 'fingerprint') == []
+
+
+def test_diff_cache_ignores_corrupt_file(tmpdir):
+    tmpdir.join(DiffCache.FILE_NAME).write('{"i-1|')
+
+    assert DiffCache(str(tmpdir)).get(CachedInstance('i-1', None), 'f') is None
+
+
+def test_rum_skips_comparisons_for_cached_instances(
+    mock_aws_manager,
+    delta_configs,
+    tmpdir
+):
+    old_config, new_config = delta_configs
+    mock_aws_manager.config_volumes_to_dict.return_value = {}
+    mock_aws_manager.get_userdata_for_instance.return_value = 'userdata'
+    mock_aws_manager.get_volumes_dict_for_instance.return_value = {}
+    mock_aws_manager.get_launch_configs.return_value = {'lc-old': old_config}
+    Instance = namedtuple('Instance', DeltaInstance._fields + ('launch_time',))
+    instances = [Instance(*make_delta_instance('i-%d' % i, 'lc-old'),
+                          launch_time=datetime(2016, 7, 26))
+                 for i in range(3)]
+    fake_group_instances(mock_aws_manager, instances)
+
+    def upgrade():
+        return RollingUpgradeManager(
+            ssh_config=None,
+            aws_manager=mock_aws_manager,
+            instance_manager=mock.Mock(spec=InstanceSshManager),
+            diff_cache=DiffCache(str(tmpdir))
+        ).get_instances_to_upgrade('test-asg', new_config)
+
+    assert upgrade() == instances
+    mock_aws_manager.reset_mock()
+
+    assert upgrade() == instances
+    assert not mock_aws_manager.get_launch_configs.called
+    assert not mock_aws_manager.get_userdata_for_instance.called
+    assert not mock_aws_manager.get_volumes_dict_for_instance.called
+
+
+@pytest.mark.parametrize('regex_pat, prefix', [
+    ('^test_pat', 'test_pat'),
+    ('test-asg.*', 'test-asg'),
+    ('^test-asgs?', 'test-asg'),
+    ('^test[0-9]', 'test'),
+    ('^foo|bar', ''),
+    ('.*', ''),
+])
+def test_literal_prefix_of_regex(regex_pat, prefix):
+    assert get_literal_prefix(regex_pat) == prefix
+
+
+INDEXED_ASGS = [{'AutoScalingGroupName': name,
+                 'AutoScalingGroupARN': 'arn:' + name,
+                 'LaunchConfigurationName': 'lc-' + name,
+                 'Tags': [{'Key': 'Env', 'Value': 'dev'}]}
+                for name in ['match2', 'foo', 'match1', 'matchless', 'zzz']]
+
+
+@pytest.fixture()
+def asg_index(tmpdir):
+    asg_index = AsgNameIndex(str(tmpdir.join('asg-index.json')))
+    asg_index.update(INDEXED_ASGS)
+    return asg_index
+
+
+def test_asg_index_finds_names_by_prefix(asg_index, tmpdir):
+    asg_index = AsgNameIndex(str(tmpdir.join('asg-index.json')))
+
+    assert asg_index.find_names('^match[0-9]') == ['match1', 'match2']
+    assert asg_index.find_names('^nothing') == []
+    assert asg_index.get('foo') == {
+        'name': 'foo', 'arn': 'arn:foo', 'launch_configuration_name': 'lc-foo',
+        'tags': {'Env': 'dev'}}
+    assert not asg_index.is_stale()
+
+
+def test_aws_finds_indexed_asg_groups_without_listing_all(
+    aws_manager,
+    mock_as_client,
+    asg_index
+):
+    aws_manager._asg_index = asg_index
+    mock_as_client.describe_auto_scaling_groups.return_value = {
+        'AutoScalingGroups': [INDEXED_ASGS[0], INDEXED_ASGS[2]]}
+
+    results = aws_manager.find_asg_group('^match[0-9]')
+
+    assert [asg['AutoScalingGroupName'] for asg in results] == \
+        ['match1', 'match2']
+    mock_as_client.describe_auto_scaling_groups.assert_called_once_with(
+        AutoScalingGroupNames=['match1', 'match2'])
+
+
+def test_aws_lists_all_asg_groups_when_index_is_out_of_date(
+    aws_manager,
+    mock_as_client,
+    asg_index
+):
+    aws_manager._asg_index = asg_index
+    created_asg = {'AutoScalingGroupName': 'new_asg'}
+    mock_as_client.describe_auto_scaling_groups.return_value = {
+        'AutoScalingGroups': [INDEXED_ASGS[1], created_asg]}
+
+    assert aws_manager.find_asg_group('^new_asg') == [created_asg]
+    mock_as_client.describe_auto_scaling_groups.assert_called_once_with()
+    assert asg_index.find_names('^match') == []
+    assert asg_index.find_names('^new') == ['new_asg']
+
+
+def test_asg_index_refreshes_in_background_when_stale(
+    aws_manager,
+    mock_as_client,
+    tmpdir
+):
+    asg_index = AsgNameIndex(str(tmpdir.join('asg-index.json')), ttl_s=-1)
+    asg_index.update(INDEXED_ASGS)
+    aws_manager._asg_index = asg_index
+    mock_as_client.describe_auto_scaling_groups.side_effect = \
+        lambda **kwargs: {
+            'AutoScalingGroups': [INDEXED_ASGS[1]] if kwargs else []}
+
+    assert aws_manager.find_asg_group('^foo') == [INDEXED_ASGS[1]]
+    asg_index.wait_for_refresh()
+
+    assert asg_index.find_names('^foo') == []
+
+
+@pytest.fixture()
+def watched_manager():
+    watched_manager = mock.Mock(spec=RollingUpgradeManager)
+    watched_manager.get_single_asg.return_value = {
+        'AutoScalingGroupName': 'test-asg-1',
+        'LaunchConfigurationName': 'lc-1'
+    }
+    return watched_manager
+
+
+def test_watcher_upgrades_only_when_launch_config_changes(watched_manager):
+    watcher = UpgradeWatcher(watched_manager, ['test-asg'])
+
+    watcher.poll()
+    watcher.poll()
+    watched_manager.get_single_asg.return_value = {
+        'AutoScalingGroupName': 'test-asg-1',
+        'LaunchConfigurationName': 'lc-2'
+    }
+    watcher.poll()
+
+    assert watched_manager.perform_rolling_upgrade_where_needed.call_args_list \
+        == [mock.call('test-asg'), mock.call('test-asg')]
+    status = watcher.get_status()['test-asg']
+    assert status['launch_configuration_name'] == 'lc-2'
+    assert status['state'] == 'idle'
+
+
+def test_watcher_keeps_watching_after_failed_upgrade(watched_manager):
+    watched_manager.perform_rolling_upgrade_where_needed.side_effect = \
+        Exception('Timed out')
+    watcher = UpgradeWatcher(watched_manager, ['test-asg'])
+
+    watcher.poll()
+
+    status = watcher.get_status()['test-asg']
+    assert status['state'] == 'failed'
+    assert status['last_error'] == 'Timed out'
+
+
+def test_watcher_keeps_watching_after_upgrade_times_out(
+    mock_aws_manager,
+    mock_instance_manager
+):
+    mock_aws_manager.find_asg_group.return_value = [{
+        'AutoScalingGroupName': 'test-asg-1',
+        'LaunchConfigurationName': 'lc-1'
+    }]
+    mock_aws_manager.get_expected_num_of_instances.return_value = 2
+    fake_group_instances(mock_aws_manager, [])
+    rolling_upgrade_manager = RollingUpgradeManager(
+        ssh_config=None,
+        aws_manager=mock_aws_manager,
+        instance_manager=mock_instance_manager,
+        max_wait_attempts=2,
+        sleep_time_s=0
+    )
+    watcher = UpgradeWatcher(rolling_upgrade_manager, ['test-asg'])
+
+    watcher.poll()
+
+    status = watcher.get_status()['test-asg']
+    assert status['state'] == 'failed'
+    assert status['last_error'] == \
+        'Instances did not finish booting after 2 attempts'
+    assert mock_aws_manager.get_in_service_instance_ids.call_count == 3
+
+
+def test_watcher_is_controlled_through_socket(watched_manager, tmpdir):
+    socket_path = str(tmpdir.join('control.sock'))
+    watcher = UpgradeWatcher(watched_manager, ['test-asg'],
+                             poll_interval_s=3600,
+                             control_socket_path=socket_path)
+    upgraded = []
+
+    def perform_rolling_upgrade_where_needed(asg_slug):
+        upgraded.append(asg_slug)
+        if len(upgraded) == 2:
+            watcher.stop()
+    watched_manager.perform_rolling_upgrade_where_needed.side_effect = \
+        perform_rolling_upgrade_where_needed
+
+    watch_thread = threading.Thread(target=watcher.run)
+    watch_thread.start()
+    try:
+        while not os.path.exists(socket_path) or not upgraded:
+            time.sleep(0.01)
+        assert send_watch_command(socket_path, 'upgrade other-asg') == \
+            {'ok': False, 'error': 'other-asg is not watched'}
+        assert send_watch_command(socket_path, 'status')['groups'][
+            'test-asg']['launch_configuration_name'] == 'lc-1'
+        assert send_watch_command(socket_path, 'upgrade test-asg') == \
+            {'ok': True}
+    finally:
+        watch_thread.join(5)
+        watcher.stop()
+
+    assert upgraded == ['test-asg', 'test-asg']
+    assert not os.path.exists(socket_path)
+    watched_manager.close_sessions.assert_called_once_with()
+
+
+def test_simulation_replaces_every_instance():
+    report = simulate_upgrade(
+        12, boot_time_sampler=lambda: 300, sleep_time_s=30)
+
+    assert report.completed
+    assert report.instances_replaced == 12
+    assert report.min_ready_instances == 11
+    # Each replacement takes the 30s for the group to notice, plus the boot
+    # time, plus up to one sleep to see it
+    assert 12 * 330 <= report.duration_s <= 12 * 360
+    assert report.reduced_capacity_s <= report.duration_s
+    assert report.api_calls['TerminateInstances'] == 12
+    assert 'DescribeVolumes' not in report.api_calls
+
+
+def test_simulation_shows_parallel_replacement_trade_off():
+    serial = simulate_upgrade(12, max_parallel_azs=1)
+    parallel = simulate_upgrade(12, max_parallel_azs=3)
+
+    assert parallel.duration_s < serial.duration_s / 2
+    assert parallel.min_ready_instances == 9
+
+
+def test_simulation_gives_up_like_a_real_upgrade():
+    report = simulate_upgrade(
+        3, boot_time_sampler=lambda: 3600, max_wait_attempts=5)
+
+    assert not report.completed
+    assert report.instances_replaced == 1
+
+
+def test_simulation_of_a_large_group_takes_little_real_time(capsys):
+    started_at = time.time()
+    report = simulate_upgrade(500)
+
+    assert report.completed
+    assert report.instances_replaced == 500
+    # Every attempt of a wait polls all 500 instances, so the simulation
+    # is only quick if unchanged instances are not checked again
+    assert time.time() - started_at < 1
+    assert capsys.readouterr() == ('', '')
+
+
+def test_boot_time_sampler_picks_from_history():
+    sampler = get_boot_time_sampler(history=[100, 200], seed=1)
+
+    assert set(sampler() for _ in range(20)) == set([100, 200])
+
+
+def test_virtual_clock_only_moves_when_slept_on():
+    clock = VirtualClock()
+    clock.sleep(30)
+
+    assert clock.time() == 30
+
+
+def test_cassette_encodes_aws_responses():
+    from dateutil.tz import tzutc
+    snapshot = InstanceSnapshot.from_description({
+        'InstanceId': 'i-1',
+        'LaunchTime': datetime(2016, 7, 26, 12, 30, tzinfo=tzutc()),
+        'Placement': {'AvailabilityZone': 'eu-west-1a'},
+        'SecurityGroups': [{'GroupId': 'sg-1'}]
+    }, lifecycle_state='InService')
+    response = {'instances': [snapshot], 'names': ('a', 'b')}
+
+    assert decode_value(encode_value(response)) == \
+        {'instances': [snapshot], 'names': ['a', 'b']}
+
+
+class Recorded(object):
+    def __init__(self):
+        self.calls = 0
+
+    def poll(self, name):
+        self.calls += 1
+        return '%s-%d' % (name, self.calls)
+
+    def fail(self):
+        raise IOError('Connection refused')
+
+
+@pytest.fixture()
+def recorded_cassette(tmpdir):
+    path = str(tmpdir.join('test.cassette'))
+    recorder = CassetteRecorder(path)
+    recorded = RecordingProxy(Recorded(), recorder, 'test')
+    recorded.poll('a')
+    recorded.poll('b')
+    recorded.poll('a')
+    with pytest.raises(IOError):
+        recorded.fail()
+    recorder.close()
+    return path
+
+
+def test_cassette_replays_recorded_calls(recorded_cassette):
+    replayed = ReplayingProxy(Cassette(recorded_cassette), 'test')
+
+    assert replayed.poll('a') == 'a-1'
+    assert replayed.poll('b') == 'b-2'
+    assert replayed.poll('a') == 'a-3'
+    # Polling more often than recorded repeats the last response
+    assert replayed.poll('a') == 'a-3'
+    with pytest.raises(ReplayedError) as error:
+        replayed.fail()
+    assert error.value.error_type == 'IOError'
+    with pytest.raises(CassetteMismatch):
+        replayed.poll('c')
+
+
+def test_replayed_upgrade_matches_recording(tmpdir):
+    path = str(tmpdir.join('upgrade.cassette'))
+    clock = VirtualClock()
+    group = SimulatedGroup(clock, 4, lambda: 120)
+    recorder = CassetteRecorder(path)
+    proxy = RecordingProxy(group, recorder, 'aws')
+
+    def upgrade(aws_manager, instance_manager, clock):
+        return RollingUpgradeManager(
+            ssh_config=None,
+            aws_manager=aws_manager,
+            instance_manager=instance_manager,
+            diff_workers=1,
+            clock=clock.time,
+            sleeper=clock.sleep
+        ).perform_rolling_upgrade_where_needed('simulated-asg')
+
+    upgrade(proxy, proxy, clock)
+    recorder.close()
+
+    replayed_clock = VirtualClock()
+    replayed = ReplayingProxy(Cassette(path), 'aws')
+    upgrade(replayed, replayed, replayed_clock)
+
+    assert group.instances_replaced == 4
+    assert replayed_clock.time() == clock.time()
+
+
+BUDGET_OLD_CONFIG = {
+    'LaunchConfigurationName': 'lc-old', 'ImageId': 'ami-old',
+    'InstanceType': 't2.micro', 'KernelId': '', 'KeyName': 'key',
+    'SecurityGroups': ['sg-1'], 'UserData': 'userdata',
+    'BlockDeviceMappings': [{'DeviceName': '/dev/sda1', 'Ebs': {
+        'VolumeSize': 8, 'VolumeType': 'gp2', 'DeleteOnTermination': True}}]
+}
+
+
+class FakeAwsApi(object):
+    """ Fake autoscaling and EC2 clients for one autoscaling group whose
+    launch configuration has changed, counting calls by AWS operation.
+    Terminated instances are replaced by in service instances straight away.
+    """
+
+    def __init__(self, size, new_config):
+        self.calls = Counter()
+        self._configs = {'lc-old': BUDGET_OLD_CONFIG, 'lc-new': new_config}
+        self._launched = 0
+        self._members = []
+        for _ in range(size):
+            self._launch('lc-old')
+
+    def _launch(self, config_name):
+        self._launched += 1
+        self._members.append({
+            'InstanceId': 'i-%d' % self._launched,
+            'LifecycleState': 'InService',
+            'LaunchConfigurationName': config_name,
+            'AvailabilityZone': 'eu-west-1%s' % 'abc'[self._launched % 3],
+            'LaunchTime': datetime(2016, 7, 26, 0, 0, self._launched % 60,
+                                   self._launched)
+        })
+
+    def describe_auto_scaling_groups(self, **kwargs):
+        self.calls['DescribeAutoScalingGroups'] += 1
+        return {'AutoScalingGroups': [{
+            'AutoScalingGroupName': 'budget-asg',
+            'LaunchConfigurationName': 'lc-new',
+            'DesiredCapacity': len(self._members),
+            'Instances': [dict((key, member[key]) for key in (
+                'InstanceId', 'LifecycleState', 'LaunchConfigurationName'))
+                for member in self._members]
+        }]}
+
+    def describe_launch_configurations(self, LaunchConfigurationNames):
+        self.calls['DescribeLaunchConfigurations'] += 1
+        return {'LaunchConfigurations': [
+            self._configs[name] for name in LaunchConfigurationNames]}
+
+    def describe_scaling_activities(self, **kwargs):
+        self.calls['DescribeScalingActivities'] += 1
+        return {'Activities': []}
+
+    def describe_instances(self, InstanceIds, Filters):
+        self.calls['DescribeInstances'] += 1
+        members = dict((member['InstanceId'], member)
+                       for member in self._members)
+        return {'Reservations': [{'Instances': [{
+            'InstanceId': instance_id,
+            'LaunchTime': members[instance_id]['LaunchTime'],
+            'Placement': {
+                'AvailabilityZone': members[instance_id]['AvailabilityZone']},
+            'PrivateIpAddress': instance_id,
+            'ImageId': self._configs[
+                members[instance_id]['LaunchConfigurationName']]['ImageId'],
+            'InstanceType': 't2.micro',
+            'KeyName': 'key',
+            'SecurityGroups': [{'GroupId': 'sg-1'}],
+            'BlockDeviceMappings': [
+                {'DeviceName': '/dev/sda1', 'Ebs': {'VolumeId': 'vol-1'}}]
+        } for instance_id in InstanceIds]}]}
+
+    def describe_volumes(self, VolumeIds):
+        self.calls['DescribeVolumes'] += 1
+        return {'Volumes': [{
+            'VolumeId': volume_id, 'VolumeType': 'gp2', 'Size': 8,
+            'Attachments': [
+                {'Device': '/dev/sda1', 'DeleteOnTermination': True}]
+        } for volume_id in VolumeIds]}
+
+    def describe_instance_attribute(self, InstanceId, Attribute):
+        self.calls['DescribeInstanceAttribute'] += 1
+        member = [member for member in self._members
+                  if member['InstanceId'] == InstanceId][0]
+        return {'UserData': {'Value': self._configs[
+            member['LaunchConfigurationName']]['UserData']}}
+
+    def terminate_instances(self, DryRun, InstanceIds):
+        self.calls['TerminateInstances'] += 1
+        self._members = [member for member in self._members
+                         if member['InstanceId'] not in InstanceIds]
+        for _ in InstanceIds:
+            self._launch('lc-new')
+
+
+@pytest.fixture()
+def unthrottled(monkeypatch):
+    monkeypatch.setattr(aws, '_rate_limiters', dict(
+        (api_family, AdaptiveRateLimiter(rate=1e9, max_rate=1e9, burst=1e9))
+        for api_family in aws.RATE_LIMITER_DEFAULTS))
+
+
+def run_budgeted_upgrade(size, new_config, **manager_kwargs):
+    """ Upgrades a fake group of the given size through the real AwsManager
+    and InstanceSshManager.
+
+    Returns:
+        the number of calls made per AWS operation, and the number of SSH
+        connections made.
+    """
+    api = FakeAwsApi(size, new_config)
+    ssh_client = mock.Mock(spec=SSHClient)
+    ssh_client.exec_command.return_value = (
+        None, mock.Mock(**{'channel.recv_exit_status.return_value': 0}), None)
+    ssh_config = SshEnvConfig(username='centos', private_key_file_path=None,
+                              remote_port=22, environment=None,
+                              use_bastion_tunnel=None)
+    rolling_upgrade_manager = RollingUpgradeManager(
+        ssh_config=ssh_config,
+        aws_manager=AwsManager(),
+        instance_manager=InstanceSshManager(ssh_config, ssh_client),
+        sleeper=lambda seconds: None,
+        **manager_kwargs)
+    rolling_upgrade_manager.connect(api, api)
+    rolling_upgrade_manager.perform_rolling_upgrade_where_needed('budget-asg')
+    return api.calls, ssh_client.connect.call_count
+
+
+@pytest.mark.parametrize('size', [3, 40, 150])
+@pytest.mark.parametrize('changed_fields, lookups_per_instance', [
+    ({'ImageId': 'ami-new'}, 0),
+    ({'UserData': 'new userdata'}, 1),
+    ({'BlockDeviceMappings': [{'DeviceName': '/dev/sda1', 'Ebs': {
+        'VolumeSize': 16, 'VolumeType': 'gp2', 'DeleteOnTermination': True}}]},
+     1),
+])
+def test_upgrade_api_calls_stay_within_budget(
+    unthrottled,
+    size,
+    changed_fields,
+    lookups_per_instance
+):
+    new_config = dict(BUDGET_OLD_CONFIG, LaunchConfigurationName='lc-new',
+                      **changed_fields)
+
+    calls, ssh_connections = run_budgeted_upgrade(size, new_config)
+
+    # One instance is replaced per cycle, and the group is described three
+    # times per cycle: to wait for it, to list it and to get the instances
+    # that joined it. Only instances not seen before are described, to
+    # compare them and to find their addresses.
+    cycles = size + 1
+    describe_instances_batches = -(-size // aws.DESCRIBE_INSTANCES_BATCH_SIZE)
+    assert calls['TerminateInstances'] == size
+    assert calls['DescribeAutoScalingGroups'] <= 1 + 3 * cycles
+    assert calls['DescribeInstances'] <= \
+        2 * (cycles + describe_instances_batches)
+    assert calls['DescribeScalingActivities'] <= size
+    assert calls['DescribeLaunchConfigurations'] <= 2
+    # Each instance is looked up at most once, however many cycles it lasts
+    lookups = calls['DescribeInstanceAttribute'] + calls['DescribeVolumes']
+    assert lookups <= lookups_per_instance * size
+    # Each instance, original or replacement, is probed until ready only
+    assert ssh_connections <= 2 * size
+
+
+class FakeSsmEndpoint(object):
+    """ A local stand-in for the SSM API, running commands on instances whose
+    boot state is set by the test.
+    """
+
+    def __init__(self, booted, online=None, page_size=2):
+        self.booted = booted
+        self.online = set(booted) if online is None else online
+        self.page_size = page_size
+        self.commands = {}
+        self.calls = Counter()
+
+    def send_command(self, InstanceIds, **kwargs):
+        self.calls['SendCommand'] += 1
+        if not self.online.issuperset(InstanceIds):
+            raise botocore.exceptions.ClientError(
+                {'Error': {'Code': 'InvalidInstanceId', 'Message': ''}},
+                'SendCommand')
+        command_id = 'command-%d' % len(self.commands)
+        self.commands[command_id] = [InstanceIds, 0]
+        return {'Command': {'CommandId': command_id}}
+
+    def describe_instance_information(self, Filters, NextToken='0'):
+        self.calls['DescribeInstanceInformation'] += 1
+        online_instance_ids = [instance_id
+                               for instance_id in Filters[0]['Values']
+                               if instance_id in self.online]
+        start = int(NextToken)
+        end = start + self.page_size
+        response = {'InstanceInformationList': [
+            {'InstanceId': instance_id, 'PingStatus': 'Online'}
+            for instance_id in online_instance_ids[start:end]]}
+        if end < len(online_instance_ids):
+            response['NextToken'] = str(end)
+        return response
+
+    def list_command_invocations(self, CommandId):
+        self.calls['ListCommandInvocations'] += 1
+        command = self.commands[CommandId]
+        command[1] += 1
+        # Invocations are listed late, and take a poll to finish
+        if command[1] == 1:
+            return {'CommandInvocations': []}
+        return {'CommandInvocations': [
+            {'InstanceId': instance_id,
+             'Status': 'InProgress' if command[1] == 2 else
+             'Success' if self.booted[instance_id] else 'Failed'}
+            for instance_id in command[0]]}
+
+
+def test_ssm_checks_readiness_of_all_instances_in_one_command(unthrottled):
+    endpoint = FakeSsmEndpoint({'i-1': True, 'i-2': False, 'i-3': True},
+                               online=set(['i-1', 'i-2']))
+    clock = FakeClock()
+    checker = SsmReadinessChecker(ssm_client=endpoint, clock=clock,
+                                  sleeper=clock.sleep)
+
+    assert checker.are_ready(['i-1', 'i-2', 'i-3']) == {
+        'i-1': True, 'i-2': False, 'i-3': False}
+    assert endpoint.calls == Counter({
+        'SendCommand': 2,
+        'DescribeInstanceInformation': 1,
+        'ListCommandInvocations': 3})
+
+
+def test_ssm_pages_through_instances_registered_with_it(unthrottled):
+    endpoint = FakeSsmEndpoint(
+        {'i-1': True, 'i-2': True, 'i-3': True, 'i-4': True, 'i-5': True},
+        online=set(['i-1', 'i-2', 'i-3', 'i-5']))
+    clock = FakeClock()
+    checker = SsmReadinessChecker(ssm_client=endpoint, clock=clock,
+                                  sleeper=clock.sleep)
+
+    assert checker.are_ready(['i-1', 'i-2', 'i-3', 'i-4', 'i-5']) == {
+        'i-1': True, 'i-2': True, 'i-3': True, 'i-4': False, 'i-5': True}
+    assert endpoint.calls['DescribeInstanceInformation'] == 2
+
+
+def test_ssm_call_count_does_not_grow_with_instances(unthrottled):
+    instance_ids = ['i-%03d' % index for index in range(120)]
+    endpoint = FakeSsmEndpoint(dict.fromkeys(instance_ids, True))
+    clock = FakeClock()
+    checker = SsmReadinessChecker(ssm_client=endpoint, clock=clock,
+                                  sleeper=clock.sleep)
+
+    assert all(checker.are_ready(instance_ids).values())
+    assert endpoint.calls == Counter({
+        'SendCommand': 3, 'ListCommandInvocations': 9})
+
+
+def test_ssm_gives_up_on_commands_that_do_not_finish(unthrottled):
+    endpoint = FakeSsmEndpoint({'i-1': True})
+    endpoint.list_command_invocations = lambda CommandId: {
+        'CommandInvocations': [{'InstanceId': 'i-1', 'Status': 'Pending'}]}
+    clock = FakeClock()
+    checker = SsmReadinessChecker(ssm_client=endpoint, timeout_s=10,
+                                  poll_interval_s=2, clock=clock,
+                                  sleeper=clock.sleep)
+
+    assert checker.are_ready(['i-1']) == {'i-1': False}
+    assert clock.now == 10
+
+
+def test_rum_checks_readiness_in_one_batch(
+    mock_aws_manager,
+    mock_instance_manager
+):
+    Instance = namedtuple('Instance', ['id', 'private_ip_address'])
+    readiness_checker = mock.Mock()
+    readiness_checker.are_ready.side_effect = (
+        {'i-1': True, 'i-2': False, 'i-3': True},
+        {'i-2': True},
+    )
+    rolling_upgrade_manager = RollingUpgradeManager(
+        ssh_config=None,
+        aws_manager=mock_aws_manager,
+        instance_manager=mock_instance_manager,
+        readiness_checker=readiness_checker
+    )
+    instances = [Instance('i-%d' % index, None) for index in (1, 2, 3)]
+
+    assert not rolling_upgrade_manager.are_all_instances_ready(instances)
+    assert rolling_upgrade_manager.are_all_instances_ready(instances)
+    assert rolling_upgrade_manager.are_all_instances_ready(instances)
+
+    assert readiness_checker.are_ready.call_args_list == [
+        mock.call(['i-1', 'i-2', 'i-3']), mock.call(['i-2'])]
+    assert not mock_instance_manager.is_ready.called